@@ -1,16 +1,39 @@
 from django.contrib import admin
-from saas.models import StripeInfo, BillingEvent, StripeEvent, Acquisition
+from saas.models import StripeInfo, BillingEvent, StripeEvent, Acquisition, AcquisitionDaily, CustomerSnapshot, Dunning, Membership, Organization, PaymentMethod, PlanEntitlement, RevenueDaily, SubscriptionPeriod, UserAgent
 
 @admin.register(StripeInfo)
 class StripeInfoAdmin(admin.ModelAdmin):
     ordering = ['-created_at']
-    list_display = ['short_id', 'user', 'customer_id', 'plan_id', 'subscription_id', 'subscription_end', 'created_at']
+    list_display = ['short_id', 'user', 'customer_id', 'plan_id', 'subscription_id', 'subscription_end', 'grace_until', 'created_at']
 
 
 @admin.register(StripeEvent)
 class StripeEventAdmin(admin.ModelAdmin):
     ordering = ['-created_at']
-    list_display = ['short_id', 'event', 'created_at']
+    list_display = ['short_id', 'event', 'created_at', 'processed_at', 'failed']
+    list_filter = ['failed']
+
+
+@admin.register(CustomerSnapshot)
+class CustomerSnapshotAdmin(admin.ModelAdmin):
+    ordering = ['-modified_at']
+    list_display = ['short_id', 'customer_id', 'modified_at']
+    search_fields = ['customer_id']
+
+
+@admin.register(PaymentMethod)
+class PaymentMethodAdmin(admin.ModelAdmin):
+    ordering = ['-created_at']
+    list_display = ['short_id', 'customer_id', 'brand', 'last4', 'exp_month', 'exp_year', 'is_default']
+    search_fields = ['customer_id']
+
+
+@admin.register(Dunning)
+class DunningAdmin(admin.ModelAdmin):
+    ordering = ['-failed_at']
+    list_display = ['short_id', 'user', 'status', 'step', 'failed_at', 'grace_until', 'next_action_at']
+    list_filter = ['status']
+    list_select_related = ['user']
 
 
 @admin.register(BillingEvent)
@@ -22,4 +45,52 @@ class BillingEventAdmin(admin.ModelAdmin):
 @admin.register(Acquisition)
 class AcquisitionAdmin(admin.ModelAdmin):
     ordering = ['-created_at']
-    list_display = ['short_id', 'user', 'referer', 'campaign', 'content', 'agent']
+    list_display = ['short_id', 'user', 'referer', 'campaign', 'content', 'user_agent']
+    list_select_related = ['user', 'user_agent']
+
+
+@admin.register(AcquisitionDaily)
+class AcquisitionDailyAdmin(admin.ModelAdmin):
+    ordering = ['-day']
+    list_display = ['day', 'normalized_campaign', 'referer_domain', 'currency', 'signups', 'trials', 'conversions', 'revenue']
+    list_select_related = ['normalized_campaign', 'referer_domain']
+
+
+@admin.register(SubscriptionPeriod)
+class SubscriptionPeriodAdmin(admin.ModelAdmin):
+    ordering = ['-started_at']
+    list_display = ['short_id', 'user', 'subscription_id', 'plan_id', 'currency', 'mrr', 'started_at', 'ended_at']
+    list_select_related = ['user']
+
+
+@admin.register(RevenueDaily)
+class RevenueDailyAdmin(admin.ModelAdmin):
+    ordering = ['-day']
+    list_display = ['day', 'currency', 'mrr_change', 'new', 'churned', 'reactivated']
+
+
+@admin.register(UserAgent)
+class UserAgentAdmin(admin.ModelAdmin):
+    ordering = ['browser', 'os', 'device']
+    list_display = ['short_id', 'browser', 'os', 'device', 'created_at']
+    list_filter = ['device', 'os', 'browser']
+
+
+@admin.register(PlanEntitlement)
+class PlanEntitlementAdmin(admin.ModelAdmin):
+    ordering = ['plan_id']
+    list_display = ['plan_id', 'features', 'limits', 'modified_at']
+
+
+class MembershipInline(admin.TabularInline):
+    model = Membership
+    raw_id_fields = ['user']
+    extra = 0
+
+
+@admin.register(Organization)
+class OrganizationAdmin(admin.ModelAdmin):
+    ordering = ['name']
+    list_display = ['short_id', 'name', 'seats', 'created_at']
+    search_fields = ['name']
+    inlines = [MembershipInline]
@@ -0,0 +1,288 @@
+"""
+Acquisition funnel analytics.
+
+Signups are attributed to a normalized campaign and referer domain, and
+AcquisitionDaily rows are incremented as signups, trials, conversions and
+payments happen, so reports read the rollup instead of scanning Acquisition.
+"""
+import json
+
+from collections import defaultdict
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from saas.models import (
+    DIRECT_REFERER_ID,
+    NO_CAMPAIGN_ID,
+    Acquisition,
+    AcquisitionDaily,
+    BillingEvent,
+    Campaign,
+    RefererDomain,
+    StripeEvent,
+    StripeInfo,
+)
+
+DIMENSION_MAX_LENGTH = 255
+
+
+def normalize_referer(referer):
+    """
+    Return the domain of a referer URL without `www.`, or the lowercased
+    value itself for referers given as a `ref` tag rather than a URL.
+    """
+    if not referer:
+        return ''
+    referer = referer.strip().lower()
+    if '://' in referer:
+        referer = urlsplit(referer).hostname or ''
+    if referer.startswith('www.'):
+        referer = referer[4:]
+    return referer[:DIMENSION_MAX_LENGTH]
+
+
+def normalize_campaign(campaign):
+    if not campaign:
+        return ''
+    return campaign.strip()[:DIMENSION_MAX_LENGTH]
+
+
+def _dimension(model, field, value, empty_id):
+    if not value:
+        return empty_id
+    try:
+        return model.objects.only('id').get(**{field: value}).id
+    except model.DoesNotExist:
+        try:
+            with transaction.atomic():
+                return model.objects.create(**{field: value}).id
+        except IntegrityError:
+            # Created concurrently
+            return model.objects.only('id').get(**{field: value}).id
+
+
+def campaign_id_for(campaign):
+    return _dimension(Campaign, 'name', normalize_campaign(campaign), NO_CAMPAIGN_ID)
+
+
+def referer_domain_id_for(referer):
+    return _dimension(RefererDomain, 'domain', normalize_referer(referer), DIRECT_REFERER_ID)
+
+
+def increment(day, campaign_id, referer_domain_id, currency='', **counts):
+    """
+    Atomically add `counts` to the AcquisitionDaily row of the given key,
+    creating it when needed.
+    """
+    key = {
+        'day': day,
+        'normalized_campaign_id': campaign_id,
+        'referer_domain_id': referer_domain_id,
+        'currency': currency,
+    }
+    updates = {name: F(name) + value for name, value in counts.items()}
+    if AcquisitionDaily.objects.filter(**key).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            AcquisitionDaily.objects.create(**key, **counts)
+    except IntegrityError:
+        AcquisitionDaily.objects.filter(**key).update(**updates)
+
+
+def _dimensions_of(user):
+    dimensions = Acquisition.objects.filter(user=user).values_list(
+        'normalized_campaign_id', 'referer_domain_id').first()
+    if dimensions is None or None in dimensions:
+        return NO_CAMPAIGN_ID, DIRECT_REFERER_ID
+    return dimensions
+
+
+def record_signup(acquisition):
+    """
+    Normalize the dimensions of a new Acquisition and count the signup (and
+    the trial when django-saas handles trials itself, see SAAS_ENABLE_TRIAL).
+    """
+    acquisition.normalized_campaign_id = campaign_id_for(acquisition.campaign)
+    acquisition.referer_domain_id = referer_domain_id_for(acquisition.referer)
+    acquisition.save(update_fields=['normalized_campaign', 'referer_domain'])
+    increment(
+        timezone.localdate(acquisition.created_at),
+        acquisition.normalized_campaign_id,
+        acquisition.referer_domain_id,
+        signups=1,
+        trials=1 if trials_at_signup() else 0,
+    )
+
+
+def trials_at_signup():
+    """
+    Whether django-saas handles trials itself, counting them at signup rather
+    than when Stripe starts a trialing subscription.
+    """
+    return settings.SAAS_ENABLE_TRIAL if hasattr(settings, 'SAAS_ENABLE_TRIAL') else True
+
+
+def record_trial_started(user):
+    """
+    Count the trial of a trialing Stripe subscription, unless trials are
+    counted at signup.
+    """
+    if trials_at_signup():
+        return
+    campaign_id, referer_domain_id = _dimensions_of(user)
+    increment(timezone.localdate(), campaign_id, referer_domain_id, trials=1)
+
+
+def record_payment(user, invoice):
+    """
+    Count the revenue of a paid invoice, and a conversion the first time a
+    user pays. Conversions are only tracked for users with an Acquisition.
+    """
+    amount = (invoice['amount_paid'] if 'amount_paid' in invoice else 0) or 0
+    if amount <= 0:
+        return
+    currency = (invoice['currency'] if 'currency' in invoice else None) or ''
+    now = timezone.now()
+    acquisition = Acquisition.objects.filter(user=user).values_list(
+        'normalized_campaign_id', 'referer_domain_id', 'converted_at').first()
+    converted = 0
+    campaign_id, referer_domain_id = NO_CAMPAIGN_ID, DIRECT_REFERER_ID
+    if acquisition is not None:
+        campaign_id = acquisition[0] or NO_CAMPAIGN_ID
+        referer_domain_id = acquisition[1] or DIRECT_REFERER_ID
+        if acquisition[2] is None:
+            converted = Acquisition.objects.filter(user=user, converted_at=None).update(converted_at=now)
+    increment(
+        timezone.localdate(now),
+        campaign_id,
+        referer_domain_id,
+        currency=currency[:3],
+        conversions=converted,
+        revenue=amount,
+    )
+
+
+def funnel(start, end, group_by=('normalized_campaign__name',)):
+    """
+    Return the funnel between the `start` and `end` days (inclusive) grouped
+    by `group_by`, e.g. `('referer_domain__domain', 'currency')`, with
+    `total_signups`, `total_trials`, `total_conversions` and `total_revenue`.
+    """
+    return (
+        AcquisitionDaily.objects.filter(day__gte=start, day__lte=end)
+        .values(*group_by)
+        .annotate(
+            total_signups=Sum('signups'),
+            total_trials=Sum('trials'),
+            total_conversions=Sum('conversions'),
+            total_revenue=Sum('revenue'),
+        )
+        .order_by(*group_by)
+    )
+
+
+def backfill_dimensions():
+    """
+    Set the campaign and referer domain of Acquisition rows recorded before
+    they were normalized, one UPDATE per distinct raw value.
+    """
+    pending = Acquisition.objects.filter(normalized_campaign=None)
+    for campaign in list(pending.values_list('campaign', flat=True).distinct()):
+        pending.filter(campaign=campaign).update(normalized_campaign_id=campaign_id_for(campaign))
+    pending = Acquisition.objects.filter(referer_domain=None)
+    for referer in list(pending.values_list('referer', flat=True).distinct()):
+        pending.filter(referer=referer).update(referer_domain_id=referer_domain_id_for(referer))
+
+
+def _paid_invoices(chunk_size=2000):
+    rows = (
+        BillingEvent.objects.filter(success=True)
+        .order_by('created_at')
+        .values_list('user_id', 'created_at', 'stripe_object')
+        .iterator(chunk_size=chunk_size)
+    )
+    for user_id, created_at, stripe_object in rows:
+        try:
+            invoice = json.loads(stripe_object)
+        except ValueError:
+            continue
+        if (invoice.get('amount_paid') or 0) > 0:
+            yield user_id, created_at, invoice
+
+
+def rebuild_funnel(chunk_size=2000):
+    """
+    Recompute every AcquisitionDaily row from Acquisition, BillingEvent and
+    StripeEvent in bulk. Also sets the missing dimensions and conversion dates.
+    """
+    backfill_dimensions()
+    dimensions = {
+        user_id: (campaign_id, referer_domain_id)
+        for user_id, campaign_id, referer_domain_id in Acquisition.objects.values_list(
+            'user_id', 'normalized_campaign_id', 'referer_domain_id').iterator(chunk_size=chunk_size)
+    }
+    default = (NO_CAMPAIGN_ID, DIRECT_REFERER_ID)
+    rows = defaultdict(lambda: defaultdict(int))
+    enable_trial = trials_at_signup()
+
+    signups = (
+        Acquisition.objects.annotate(day=TruncDate('created_at'))
+        .values('day', 'normalized_campaign_id', 'referer_domain_id')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    for row in signups:
+        key = (row['day'], row['normalized_campaign_id'], row['referer_domain_id'], '')
+        rows[key]['signups'] += row['count']
+        if enable_trial:
+            rows[key]['trials'] += row['count']
+
+    users = dict(StripeInfo.objects.values_list('customer_id', 'user_id').iterator(chunk_size=chunk_size))
+    trials = () if enable_trial else (
+        StripeEvent.objects.filter(event='customer.subscription.created')
+        .order_by('created_at')
+        .values_list('event_id', 'created_at', 'object')
+        .iterator(chunk_size=chunk_size)
+    )
+    # Events redelivered by Stripe are recorded once per delivery.
+    seen = set()
+    for event_id, created_at, stripe_object in trials:
+        if event_id:
+            if event_id in seen:
+                continue
+            seen.add(event_id)
+        try:
+            subscription = json.loads(stripe_object)
+        except ValueError:
+            continue
+        if subscription.get('status') == 'trialing':
+            campaign_id, referer_domain_id = dimensions.get(users.get(subscription.get('customer')), default)
+            rows[(timezone.localdate(created_at), campaign_id, referer_domain_id, '')]['trials'] += 1
+
+    converted = set()
+    for user_id, created_at, invoice in _paid_invoices(chunk_size):
+        campaign_id, referer_domain_id = dimensions.get(user_id, default)
+        key = (timezone.localdate(created_at), campaign_id, referer_domain_id, (invoice.get('currency') or '')[:3])
+        rows[key]['revenue'] += invoice['amount_paid']
+        if user_id in dimensions and user_id not in converted:
+            converted.add(user_id)
+            rows[key]['conversions'] += 1
+            Acquisition.objects.filter(user_id=user_id, converted_at=None).update(converted_at=created_at)
+
+    with transaction.atomic():
+        AcquisitionDaily.objects.all().delete()
+        AcquisitionDaily.objects.bulk_create([
+            AcquisitionDaily(
+                day=day,
+                normalized_campaign_id=campaign_id,
+                referer_domain_id=referer_domain_id,
+                currency=currency,
+                **counts,
+            )
+            for (day, campaign_id, referer_domain_id, currency), counts in rows.items()
+        ], batch_size=chunk_size)
+    return len(rows)
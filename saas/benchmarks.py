@@ -0,0 +1,385 @@
+"""
+Benchmarks for the django-saas hot paths.
+
+Run standalone against an in-memory SQLite database:
+
+    python -m saas.benchmarks
+
+or against the database configured by a project (a test database is created
+and destroyed, exactly like `manage.py test` does):
+
+    DJANGO_SETTINGS_MODULE=myproject.settings python -m saas.benchmarks
+
+Every benchmark reports wall time and the number of database queries per
+operation. No request is ever made to Stripe: webhook payloads are signed
+locally and users are created with SAAS_USE_CHECKOUT so that no customer is
+created on Stripe.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from saas.fake_stripe import sign_payload
+
+BENCHMARK_ENDPOINT_SECRET = 'whsec_benchmark'
+BENCHMARK_CUSTOMER_ID = 'cus_benchmark'
+
+BENCHMARK_TEMPLATES = {
+    'saas/benchmark/subject.txt': 'Receipt for {{ billing.invoice }}\n',
+    'saas/benchmark/email.txt': (
+        'Hi {{ user.email }},\n'
+        '{% for line in payment.lines.data %}{{ line.description }} {{ line.currency }}\n{% endfor %}'
+        'Paid: {{ payment.amount_paid }}\n'
+    ),
+    'saas/benchmark/email.html': (
+        '<html><body><p>Hi {{ user.email }},</p><table>'
+        '{% for line in payment.lines.data %}<tr><td>{{ line.description }}</td><td>{{ line.currency }}</td></tr>{% endfor %}'
+        '</table><p>Paid: {{ payment.amount_paid }}</p></body></html>'
+    ),
+}
+
+
+class BenchmarkResult:
+    def __init__(self, name, iterations, elapsed, queries):
+        self.name = name
+        self.iterations = iterations
+        self.elapsed = elapsed
+        self.queries = queries
+
+    @property
+    def us_per_op(self):
+        return self.elapsed / self.iterations * 1e6
+
+    @property
+    def ops_per_second(self):
+        return self.iterations / self.elapsed if self.elapsed else float('inf')
+
+    @property
+    def queries_per_op(self):
+        return self.queries / self.iterations
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'iterations': self.iterations,
+            'elapsed': self.elapsed,
+            'us_per_op': self.us_per_op,
+            'ops_per_second': self.ops_per_second,
+            'queries_per_op': self.queries_per_op,
+        }
+
+
+def measure(name, func, iterations):
+    from django.db import connection
+    from saas.instrumentation import QueryCounter
+
+    # Warm up caches (templates, content types, prepared statements...)
+    func()
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+    return BenchmarkResult(name, iterations, elapsed, counter.count)
+
+
+def subscription_fixture(customer_id=BENCHMARK_CUSTOMER_ID):
+    return {
+        'id': 'sub_benchmark',
+        'object': 'subscription',
+        'customer': customer_id,
+        'current_period_end': int(time.time()) + 30 * 24 * 3600,
+        'plan': {'id': 'plan_benchmark', 'object': 'plan'},
+    }
+
+
+def invoice_fixture(customer_id=BENCHMARK_CUSTOMER_ID, amount=1000, invoice_id='in_benchmark'):
+    return {
+        'id': invoice_id,
+        'object': 'invoice',
+        'customer': customer_id,
+        'created': int(time.time()),
+        'amount_due': amount,
+        'amount_paid': amount,
+        'currency': 'usd',
+        'lines': {'data': [{'description': '1 × Benchmark plan', 'currency': 'usd'}]},
+    }
+
+
+def customer_fixture(email, customer_id=BENCHMARK_CUSTOMER_ID):
+    return {
+        'id': customer_id,
+        'object': 'customer',
+        'email': email,
+        'subscriptions': {'object': 'list', 'data': [subscription_fixture(customer_id)]},
+    }
+
+
+def event_fixtures(email):
+    """
+    Return a `{event type: data.object}` mapping for every event type handled
+    by StripeWebhook.
+    """
+    return {
+        'customer.created': customer_fixture(email),
+        'customer.updated': customer_fixture(email),
+        'customer.subscription.created': subscription_fixture(),
+        'customer.subscription.updated': subscription_fixture(),
+        'customer.subscription.deleted': subscription_fixture(),
+        'customer.subscription.trial_will_end': subscription_fixture(),
+        'invoice.payment_succeeded': invoice_fixture(),
+        'invoice.payment_failed': invoice_fixture(),
+        'invoice.payment_action_required': invoice_fixture(),
+        'invoice.upcoming': invoice_fixture(),
+    }
+
+
+def event_payload(event_type, stripe_object, sequence=0):
+    return json.dumps({
+        'id': 'evt_benchmark_{}'.format(sequence),
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'data': {'object': stripe_object},
+    })
+
+
+def create_user(email='benchmark@example.com', customer_id=BENCHMARK_CUSTOMER_ID):
+    from django.contrib.auth import get_user_model
+    from django.test import override_settings
+    from saas.models import StripeInfo
+
+    User = get_user_model()
+    # SAAS_USE_CHECKOUT prevents on_new_user from creating a Stripe customer.
+    with override_settings(SAAS_USE_CHECKOUT=True):
+        user = User.objects.create_user(username=email, email=email, password='benchmark')
+    StripeInfo.objects.create(user=user, customer_id=customer_id)
+    return user
+
+
+def bench_webhooks(iterations):
+    from django.test import RequestFactory
+    from saas.views import StripeWebhook
+
+    user = create_user()
+    view = StripeWebhook.as_view(endpoint_secret=BENCHMARK_ENDPOINT_SECRET)
+    factory = RequestFactory()
+    results = []
+    for event_type, stripe_object in event_fixtures(user.email).items():
+        payload = event_payload(event_type, stripe_object)
+        signature = sign_payload(payload, BENCHMARK_ENDPOINT_SECRET)
+
+        def post():
+            request = factory.post(
+                '/stripe', data=payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=signature,
+            )
+            response = view(request)
+            assert response.status_code == 200, response.status_code
+
+        results.append(measure('webhook {}'.format(event_type), post, iterations))
+    return results
+
+
+def bench_subscription_required(iterations):
+    from django.contrib.auth import get_user_model
+    from django.http import HttpResponse
+    from django.test import RequestFactory, override_settings
+    from saas.decorators import subscription_required
+
+    User = get_user_model()
+    user = create_user()
+    factory = RequestFactory()
+
+    def view(request):
+        return HttpResponse()
+
+    gated = subscription_required(upgrade_url='/upgrade')(view)
+
+    def request_for(view_func):
+        def call():
+            request = factory.get('/')
+            # AuthenticationMiddleware loads a fresh user on every request.
+            request.user = User.objects.get(pk=user.pk)
+            view_func(request)
+        return call
+
+    with override_settings(SAAS_UPGRADE_URL='/upgrade'):
+        baseline = measure('subscription_required baseline', request_for(view), iterations)
+        decorated = measure('subscription_required', request_for(gated), iterations)
+    overhead = BenchmarkResult(
+        'subscription_required overhead',
+        iterations,
+        max(decorated.elapsed - baseline.elapsed, 0),
+        decorated.queries - baseline.queries,
+    )
+    return [baseline, decorated, overhead]
+
+
+def bench_customer(iterations):
+    from django.contrib.auth import get_user_model
+    from saas.subscription import Customer
+
+    User = get_user_model()
+    user = create_user()
+
+    def evaluate(customer):
+        return (
+            customer.subscribed,
+            customer.actively_subscribed,
+            customer.previously_subscribed,
+            customer.trialing,
+            customer.trial_left_in_days,
+        )
+
+    def fresh():
+        evaluate(Customer.of(User.objects.get(pk=user.pk)))
+
+    cached_user = User.objects.get(pk=user.pk)
+
+    def cached():
+        evaluate(Customer.of(cached_user))
+
+    return [
+        measure('Customer properties (fresh user)', fresh, iterations),
+        measure('Customer properties (cached user)', cached, iterations),
+    ]
+
+
+def bench_send_multi_mail(iterations):
+    from django.core import mail
+    from django.test import override_settings
+    from saas.mailer import send_multi_mail
+
+    templates = [{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [('django.template.loaders.locmem.Loader', BENCHMARK_TEMPLATES)],
+        },
+    }]
+    context = {
+        'user': {'email': 'benchmark@example.com'},
+        'billing': {'invoice': 'in_benchmark'},
+        'payment': invoice_fixture(),
+    }
+
+    def send(html_email_template_name=None):
+        def call():
+            send_multi_mail(
+                'saas/benchmark/subject.txt',
+                'saas/benchmark/email.txt',
+                context,
+                'billing@example.com',
+                'benchmark@example.com',
+                html_email_template_name=html_email_template_name,
+            )
+        return call
+
+    with override_settings(
+            TEMPLATES=templates, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+        mail.outbox = []
+        results = [
+            measure('send_multi_mail text', send(), iterations),
+            measure('send_multi_mail text+html', send('saas/benchmark/email.html'), iterations),
+        ]
+        mail.outbox = []
+    return results
+
+
+BENCHMARKS = [
+    ('webhook', bench_webhooks),
+    ('subscription_required', bench_subscription_required),
+    ('customer', bench_customer),
+    ('mail', bench_send_multi_mail),
+]
+
+
+def run_benchmarks(iterations=200, only=None):
+    """
+    Run the benchmarks against the current default database.
+
+    Every benchmark runs inside a transaction that is rolled back, so the
+    database is left untouched.
+    """
+    from django.db import transaction
+
+    results = []
+    for name, bench in BENCHMARKS:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        with transaction.atomic():
+            results.extend(bench(iterations))
+            transaction.set_rollback(True)
+    return results
+
+
+def format_results(results):
+    lines = ['{:<52} {:>8} {:>12} {:>12} {:>10}'.format(
+        'benchmark', 'n', 'µs/op', 'ops/s', 'queries/op')]
+    for result in results:
+        lines.append('{:<52} {:>8} {:>12.1f} {:>12.1f} {:>10.2f}'.format(
+            result.name, result.iterations, result.us_per_op,
+            result.ops_per_second, result.queries_per_op))
+    return '\n'.join(lines)
+
+
+def configure_standalone():
+    from django.conf import settings
+
+    settings.configure(
+        SECRET_KEY='saas-benchmark',
+        USE_TZ=True,
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.messages',
+            'saas',
+        ],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+        ROOT_URLCONF='saas.urls',
+        STRIPE_SECRET_KEY='sk_test_benchmark',
+        STRIPE_PUBLISHABLE_KEY='pk_test_benchmark',
+        STRIPE_ENDPOINT_SECRET=BENCHMARK_ENDPOINT_SECRET,
+        SAAS_UPGRADE_URL='/upgrade',
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark django-saas hot paths.')
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--only', action='append', help='Only run benchmarks starting with this name.')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON.')
+    args = parser.parse_args(argv)
+
+    if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        configure_standalone()
+
+    import django
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    django.setup()
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        results = run_benchmarks(args.iterations, only=args.only)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    if args.json:
+        print(json.dumps([result.as_dict() for result in results], indent=2))
+    else:
+        print(format_results(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
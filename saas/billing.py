@@ -0,0 +1,106 @@
+"""
+Paginated billing history.
+
+Pages are selected with a keyset on `(created_at, id)` (the BillingEvent
+`(user, created_at)` index), so every page costs the same whatever its depth.
+The first page of every user is cached until one of their BillingEvent
+changes, for SAAS_BILLING_HISTORY_CACHE_TIMEOUT seconds (300 by default,
+0 to disable).
+"""
+import base64
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from saas.models import BillingEvent
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(created_at, id):
+    value = f'{created_at.isoformat()}|{id}'
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        created_at = parse_datetime(created_at)
+        id = uuid.UUID(id)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if created_at is None:
+        raise ValueError('Invalid cursor')
+    return created_at, id
+
+
+def cache_key(user_id):
+    # First pages of every page size, by page size.
+    return f'saas:billing-history:{user_id}'
+
+
+def cache_timeout():
+    return settings.SAAS_BILLING_HISTORY_CACHE_TIMEOUT if hasattr(settings, 'SAAS_BILLING_HISTORY_CACHE_TIMEOUT') else 300
+
+
+def invalidate(user_id):
+    cache.delete(cache_key(user_id))
+
+
+def serialize(billing):
+    invoice = billing.stripe
+    lines = (invoice.get('lines') or {}).get('data') or [{}]
+    return {
+        'id': str(billing.id),
+        'created_at': billing.created_at.isoformat(),
+        'success': billing.success,
+        'invoice': invoice.get('id'),
+        'number': invoice.get('number'),
+        'currency': invoice.get('currency') or lines[0].get('currency'),
+        'amount_due': invoice.get('amount_due'),
+        'amount_paid': invoice.get('amount_paid'),
+        'description': lines[0].get('description'),
+        'hosted_invoice_url': invoice.get('hosted_invoice_url'),
+    }
+
+
+def billing_page(user, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return `(billing events, next cursor)`, most recent first, the cursor
+    being None on the last page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    events = BillingEvent.objects.filter(user=user)
+    if cursor is not None:
+        created_at, id = decode_cursor(cursor)
+        events = events.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=id))
+    events = list(events.order_by('-created_at', '-id')[:limit + 1])
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(events[-1].created_at, events[-1].id)
+    return events, next_cursor
+
+
+def billing_history(user, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return a page of the billing history of `user` as a JSON serializable
+    `{"results": [...], "next": cursor}`, see billing_page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    timeout = cache_timeout()
+    cached = None
+    if cursor is None and timeout:
+        cached = cache.get(cache_key(user.pk)) or {}
+        if limit in cached:
+            return cached[limit]
+    events, next_cursor = billing_page(user, cursor, limit)
+    page = {'results': [serialize(billing) for billing in events], 'next': next_cursor}
+    if cached is not None:
+        cached[limit] = page
+        cache.set(cache_key(user.pk), cached, timeout)
+    return page
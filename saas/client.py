@@ -0,0 +1,107 @@
+import types
+import warnings
+
+from functools import wraps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from saas.instrumentation import InstrumentedStripe, is_enabled
+from saas.tenants import current_tenant, tenant_config
+
+_stripe = None
+_instrumented_stripe = None
+# TenantStripe proxies by (tenant, instrumented), created once.
+_tenant_stripes = {}
+
+
+class TenantStripe:
+    """
+    Proxy around the `stripe` module passing the `api_key` of a tenant to
+    every API call, e.g. `Customer.create`.
+    """
+    def __init__(self, target, api_key, path=None):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_api_key', api_key)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        path = f'{self._path}.{attr}' if self._path else attr
+        if isinstance(value, type) and issubclass(value, BaseException):
+            return value
+        if isinstance(value, type) or isinstance(value, types.ModuleType):
+            return TenantStripe(value, self._api_key, path)
+        if callable(value):
+            if self._path is None:
+                # Module level helpers, not API calls.
+                return value
+            @wraps(value)
+            def _call(*args, **kwargs):
+                kwargs.setdefault('api_key', self._api_key)
+                return value(*args, **kwargs)
+            return _call
+        if hasattr(value, '__dict__'):
+            # Resource namespaces of alternative backends and instrumented proxies.
+            return TenantStripe(value, self._api_key, path)
+        return value
+
+    def __setattr__(self, attr, value):
+        setattr(self._target, attr, value)
+
+
+def get_stripe():
+    """
+    Return the `stripe` module configured with STRIPE_SECRET_KEY.
+
+    `stripe` is only imported the first time it is needed so that booting a
+    worker or running a management command does not pay for it. When
+    SAAS_INSTRUMENTATION is enabled, API calls made through the returned
+    module are timed.
+
+    SAAS_STRIPE_BACKEND replaces the `stripe` module by another implementation
+    of the same interface, such as saas.fake_stripe.FakeStripe, instantiated
+    once per process.
+
+    Within saas.tenants.use_tenant(), API calls use the secret key of the
+    tenant. The HTTP client of `stripe`, which keeps its connections to the
+    Stripe API alive, is shared by all tenants.
+    """
+    global _stripe, _instrumented_stripe
+    if _stripe is None:
+        if getattr(settings, 'SAAS_STRIPE_BACKEND', None):
+            stripe = import_string(settings.SAAS_STRIPE_BACKEND)()
+        else:
+            import stripe
+
+        if hasattr(settings, 'STRIPE_SECRET_KEY'):
+            stripe.api_key = settings.STRIPE_SECRET_KEY
+        else:
+            warnings.warn(
+                """
+                In order for django-saas to function properly, you need to set STRIPE_SECRET_KEY in settings.py
+            """
+            )
+        _stripe = stripe
+    stripe = _stripe
+    instrumented = is_enabled()
+    if instrumented:
+        if _instrumented_stripe is None:
+            _instrumented_stripe = InstrumentedStripe(_stripe)
+        stripe = _instrumented_stripe
+    tenant = current_tenant()
+    if tenant is None:
+        return stripe
+    key = (tenant, instrumented)
+    if key not in _tenant_stripes:
+        _tenant_stripes[key] = TenantStripe(stripe, tenant_config(tenant)['secret_key'])
+    return _tenant_stripes[key]
+
+
+@receiver(setting_changed)
+def reset_stripe(setting, **kwargs):
+    global _stripe, _instrumented_stripe
+    if setting in ('SAAS_STRIPE_BACKEND', 'STRIPE_SECRET_KEY', 'SAAS_STRIPE_TENANTS'):
+        _stripe = None
+        _instrumented_stripe = None
+        _tenant_stripes.clear()
@@ -1,5 +1,6 @@
 from django.conf import settings
 from saas.subscription import Customer
+from saas.tenants import tenant_setting
 
 def referer(request):
     ref = request.GET.get('ref', None)
@@ -13,7 +14,7 @@ def referer(request):
 def current_customer(request):
     context = {
         'customer': None,
-        'STRIPE_PUBLISHABLE_KEY': settings.STRIPE_PUBLISHABLE_KEY,
+        'STRIPE_PUBLISHABLE_KEY': tenant_setting('publishable_key'),
     }
     if hasattr(settings, 'SAAS_USE_CHECKOUT') and settings.SAAS_USE_CHECKOUT:
         if hasattr(settings, 'SAAS_CHECKOUT_PRICE_ID'):
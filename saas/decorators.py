@@ -4,6 +4,7 @@ from django.http import HttpResponseRedirect
 from django.shortcuts import resolve_url
 from django.utils.decorators import method_decorator
 from functools import wraps
+from saas.instrumentation import timed
 from saas.subscription import Customer
 
 def subscription_required(upgrade_url=None, include_trial=True):
@@ -13,12 +14,30 @@ def subscription_required(upgrade_url=None, include_trial=True):
             resolved_upgrade_url = resolve_url(upgrade_url or settings.SAAS_UPGRADE_URL)
             if not request.user.is_authenticated:
                 return HttpResponseRedirect(resolved_upgrade_url)
-            customer = Customer.of(request.user)
+            with timed('subscription_required'):
+                customer = Customer.of(request.user)
+                allowed = customer.subscribed or (include_trial and customer.trialing)
             # If subscribed or not ignoring trial and within trial then execute view
-            if customer.subscribed or (include_trial and customer.trialing):
+            if allowed:
                 return view_func(request, *args, **kwargs)
             # Otherwise redirect to upgrade_url
             return HttpResponseRedirect(resolved_upgrade_url)
         return _wrapped_view
     return decorator
+
+def feature_required(feature, upgrade_url=None):
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            resolved_upgrade_url = resolve_url(upgrade_url or settings.SAAS_UPGRADE_URL)
+            if not request.user.is_authenticated:
+                return HttpResponseRedirect(resolved_upgrade_url)
+            with timed('feature_required', feature=feature):
+                allowed = Customer.of(request.user).has_feature(feature)
+            if allowed:
+                return view_func(request, *args, **kwargs)
+            # Otherwise redirect to upgrade_url so that the user can pick a plan granting it
+            return HttpResponseRedirect(resolved_upgrade_url)
+        return _wrapped_view
+    return decorator
         
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+Dunning: reminders and grace period after a failed payment.
+
+`invoice.payment_failed` opens a Dunning row for the user (unless one is
+already active) and `invoice.payment_succeeded` or the deletion of the
+subscription closes it. While it is active, the user keeps access until
+`grace_until` (see Customer.active_info), and `run_dunning()` (see the
+`run_dunning` command, to run periodically) sends the reminders that are due:
+
+    SAAS_DUNNING_SCHEDULE = [1, 3, 5]  # Days after the failure a reminder is sent
+    SAAS_DUNNING_GRACE_DAYS = 7  # 0 by default, access ends with the subscription
+    SAAS_DUNNING_SUBJECT_TEMPLATE = 'saas/dunning_subject.txt'
+    SAAS_DUNNING_EMAIL_TEMPLATE = 'saas/dunning_email.txt'
+    SAAS_DUNNING_HTML_EMAIL_TEMPLATE = None
+    SAAS_DUNNING_FROM_EMAIL = None  # DEFAULT_FROM_EMAIL
+
+Nothing happens when neither a schedule nor a grace period is set. Due rows
+are read through the `next_action_at` index in batches locked with SKIP
+LOCKED, so several workers can run at once, and every email of a run goes
+through a single connection. A reminder that is already late when the
+worker runs replaces the ones before it: users never get several reminders
+at once.
+"""
+import logging
+
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
+from saas.mailer import build_multi_mail
+from saas.models import Dunning, StripeInfo
+from saas.routers import stick
+
+logger = logging.getLogger("saas")
+
+User = get_user_model()
+
+# Delay before retrying a batch whose emails could not be sent.
+RETRY_DELAY = timedelta(hours=1)
+
+
+def dunning_schedule():
+    return [timedelta(days=days) for days in getattr(settings, 'SAAS_DUNNING_SCHEDULE', [])]
+
+
+def grace_period():
+    return timedelta(days=getattr(settings, 'SAAS_DUNNING_GRACE_DAYS', 0))
+
+
+def dunning_enabled():
+    return bool(dunning_schedule()) or grace_period() > timedelta(0)
+
+
+def _set_grace(user_id, grace_until):
+    StripeInfo.objects.filter(user_id=user_id).update(grace_until=grace_until)
+    stick(user_id)
+
+
+def _hosted_invoice_url(invoice):
+    return invoice['hosted_invoice_url'] if 'hosted_invoice_url' in invoice else None
+
+
+def open_dunning(user, invoice, now=None):
+    """
+    Start the dunning of `user` after the failure of `invoice`, or only
+    record the invoice when it is already in progress. Returns the Dunning.
+    """
+    if not dunning_enabled():
+        return None
+    now = timezone.now() if now is None else now
+    schedule = dunning_schedule()
+    grace = grace_period()
+    with transaction.atomic():
+        dunning = Dunning.objects.select_for_update().filter(user=user).first()
+        if dunning is None:
+            dunning = Dunning(user=user)
+        elif dunning.status == Dunning.ACTIVE:
+            dunning.invoice_id = invoice['id']
+            dunning.hosted_invoice_url = _hosted_invoice_url(invoice)
+            dunning.save(update_fields=['invoice_id', 'hosted_invoice_url', 'modified_at'])
+            return dunning
+        dunning.status = Dunning.ACTIVE
+        dunning.invoice_id = invoice['id']
+        dunning.hosted_invoice_url = _hosted_invoice_url(invoice)
+        dunning.failed_at = now
+        dunning.grace_until = now + grace if grace else None
+        dunning.step = 0
+        dunning.next_action_at = now + schedule[0] if schedule else dunning.grace_until
+        dunning.save()
+        _set_grace(user.pk, dunning.grace_until)
+    logger.info(f"User {user.pk} dunning started, next action at {dunning.next_action_at}")
+    return dunning
+
+
+def close_dunning(user, status=Dunning.RESOLVED):
+    """
+    Close the active dunning of `user`, ending the grace period.
+    """
+    if not dunning_enabled():
+        return False
+    closed = Dunning.objects.filter(user=user, status=Dunning.ACTIVE).update(
+        status=status, next_action_at=None, modified_at=timezone.now())
+    if closed:
+        _set_grace(user.pk, None)
+    return bool(closed)
+
+
+class DunningReport:
+    def __init__(self):
+        self.reminded = 0
+        self.expired = 0
+        self.failed = 0
+
+    def __str__(self):
+        return f'{self.reminded} reminders sent, {self.expired} expired, {self.failed} failed'
+
+
+def reminder_context(dunning, user, reminder, reminders):
+    return {
+        'user': user,
+        'dunning': dunning,
+        'reminder': reminder,
+        'reminders': reminders,
+        'grace_until': dunning.grace_until,
+        'invoice_id': dunning.invoice_id,
+        'hosted_invoice_url': dunning.hosted_invoice_url,
+    }
+
+
+def _advance(dunning, schedule, now):
+    """
+    Move `dunning` to its next step and return the number of the reminder
+    to send, or None.
+    """
+    due = [i for i in range(dunning.step, len(schedule)) if dunning.failed_at + schedule[i] <= now]
+    reminder = None
+    if due:
+        dunning.step = due[-1] + 1
+        reminder = dunning.step
+    if dunning.step < len(schedule):
+        dunning.next_action_at = dunning.failed_at + schedule[dunning.step]
+    elif dunning.grace_until is not None and dunning.grace_until > now:
+        dunning.next_action_at = dunning.grace_until
+    else:
+        dunning.status = Dunning.EXPIRED
+        dunning.next_action_at = None
+    return reminder
+
+
+def run_dunning(batch_size=500, now=None):
+    """
+    Send the reminders that are due and expire the dunning whose grace period
+    is over. Returns a DunningReport.
+    """
+    now = timezone.now() if now is None else now
+    schedule = dunning_schedule()
+    subject_template_name = getattr(settings, 'SAAS_DUNNING_SUBJECT_TEMPLATE', None)
+    email_template_name = getattr(settings, 'SAAS_DUNNING_EMAIL_TEMPLATE', None)
+    html_email_template_name = getattr(settings, 'SAAS_DUNNING_HTML_EMAIL_TEMPLATE', None)
+    from_email = getattr(settings, 'SAAS_DUNNING_FROM_EMAIL', None)
+    send_emails = subject_template_name is not None and email_template_name is not None
+    report = DunningReport()
+    connection = get_connection()
+    try:
+        while True:
+            with transaction.atomic():
+                due = list(
+                    Dunning.objects.select_for_update(skip_locked=True)
+                    .filter(next_action_at__lte=now, status=Dunning.ACTIVE)
+                    .order_by('next_action_at')[:batch_size]
+                )
+                if not due:
+                    return report
+                users = User.objects.in_bulk([dunning.user_id for dunning in due])
+                previous = {dunning.pk: dunning.step for dunning in due}
+                messages = []
+                expired = 0
+                for dunning in due:
+                    reminder = _advance(dunning, schedule, now)
+                    if dunning.status == Dunning.EXPIRED:
+                        expired += 1
+                    user = users.get(dunning.user_id)
+                    if reminder is None or not send_emails or user is None or not user.email:
+                        continue
+                    messages.append(build_multi_mail(
+                        subject_template_name,
+                        email_template_name,
+                        reminder_context(dunning, user, reminder, len(schedule)),
+                        from_email,
+                        user.email,
+                        html_email_template_name=html_email_template_name,
+                        connection=connection,
+                    ))
+                try:
+                    if messages:
+                        # Opened once for the whole run.
+                        connection.open()
+                        connection.send_messages(messages)
+                    report.reminded += len(messages)
+                    report.expired += expired
+                except Exception:
+                    logger.exception(f"Could not send {len(messages)} dunning reminders")
+                    # Retry the whole batch later, some reminders may be sent twice.
+                    for dunning in due:
+                        dunning.step = previous[dunning.pk]
+                        dunning.status = Dunning.ACTIVE
+                        dunning.next_action_at = now + RETRY_DELAY
+                    report.failed += len(due)
+                Dunning.objects.bulk_update(due, ['status', 'step', 'next_action_at'])
+    finally:
+        connection.close()
@@ -0,0 +1,191 @@
+"""
+Plan entitlements: the features and limits granted by each plan.
+
+Entitlements are configured per plan id in settings:
+
+    SAAS_PLAN_FEATURES = {
+        'plan_pro': {'features': ['export', 'api'], 'limits': {'projects': 50}},
+        'trial': {'features': ['export'], 'limits': {'projects': 5}},
+        'free': {'limits': {'projects': 1}},
+    }
+
+`trial` applies to trialing users and `free` to users without an active
+subscription. With SAAS_PLAN_FEATURES_FROM_STRIPE = True, plans are also
+read from the PlanEntitlement table, filled by `sync_plan_features` from the
+metadata of the Stripe products and plans (`features` as a comma separated
+list and `limit_<name>` as integers) and kept up to date plan by plan by the
+`product.*` and `plan.*` webhooks; settings take precedence. Plans are
+synced and looked up per Stripe account (see saas.tenants).
+
+The registry of each account is built once per process into immutable
+mappings and reloaded every SAAS_PLAN_FEATURES_TTL seconds (300 by default)
+when read from Stripe, so checking an entitlement is a dict lookup.
+"""
+import json
+import logging
+import threading
+import time
+
+from collections import namedtuple
+from types import MappingProxyType
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from saas.client import get_stripe
+from saas.models import PlanEntitlement
+from saas.tenants import current_tenant
+
+logger = logging.getLogger("saas")
+
+TRIAL = 'trial'
+FREE = 'free'
+
+LIMIT_PREFIX = 'limit_'
+
+Entitlements = namedtuple('Entitlements', ['features', 'limits'])
+
+NO_ENTITLEMENTS = Entitlements(frozenset(), MappingProxyType({}))
+
+# {tenant: (registry, loaded at)}
+_registries = {}
+_lock = threading.Lock()
+
+
+def entitlements_from(value):
+    return Entitlements(
+        frozenset(value.get('features') or []),
+        MappingProxyType(dict(value.get('limits') or {})),
+    )
+
+
+def features_from_stripe():
+    return getattr(settings, 'SAAS_PLAN_FEATURES_FROM_STRIPE', False)
+
+
+def load_registry(tenant=None):
+    plans = {}
+    if features_from_stripe():
+        rows = PlanEntitlement.objects.filter(tenant=tenant or '').values_list('plan_id', 'features', 'limits')
+        for plan_id, features, limits in rows:
+            plans[plan_id] = entitlements_from({'features': json.loads(features), 'limits': json.loads(limits)})
+    for plan_id, value in getattr(settings, 'SAAS_PLAN_FEATURES', {}).items():
+        plans[plan_id] = entitlements_from(value)
+    return MappingProxyType(plans)
+
+
+def get_registry(tenant=None):
+    """
+    Return the immutable `{plan id: Entitlements}` mapping of this process
+    for the Stripe account `tenant`.
+    """
+    global _registries
+    registry, loaded_at = _registries.get(tenant, (None, 0))
+    ttl = getattr(settings, 'SAAS_PLAN_FEATURES_TTL', 300)
+    if registry is None or (features_from_stripe() and time.monotonic() - loaded_at > ttl):
+        with _lock:
+            registry = load_registry(tenant)
+            _registries = {**_registries, tenant: (registry, time.monotonic())}
+    return registry
+
+
+def entitlements_of(plan_id, tenant=None):
+    return get_registry(tenant).get(plan_id, NO_ENTITLEMENTS)
+
+
+def invalidate():
+    global _registries
+    _registries = {}
+
+
+@receiver(setting_changed)
+def reset_entitlements(setting, **kwargs):
+    if setting.startswith('SAAS_PLAN_FEATURES'):
+        invalidate()
+
+
+def parse_metadata(metadata):
+    features = set()
+    limits = {}
+    for key, value in (metadata or {}).items():
+        if key == 'features':
+            features.update(feature.strip() for feature in value.split(',') if feature.strip())
+        elif key.startswith(LIMIT_PREFIX):
+            try:
+                limits[key[len(LIMIT_PREFIX):]] = int(value)
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring non integer plan limit {key}={value}")
+    return features, limits
+
+
+def _metadata(stripe_object):
+    if stripe_object is None or isinstance(stripe_object, str):
+        return {}
+    metadata = stripe_object['metadata'] if 'metadata' in stripe_object and stripe_object['metadata'] else {}
+    # stripe objects are not mappings, FakeStripe objects are plain dicts.
+    return metadata.to_dict() if hasattr(metadata, 'to_dict') else metadata
+
+
+def _entitlements(plan, product):
+    product_features, product_limits = parse_metadata(_metadata(product))
+    plan_features, plan_limits = parse_metadata(_metadata(plan))
+    return (
+        json.dumps(sorted(product_features | plan_features)),
+        json.dumps({**product_limits, **plan_limits}, sort_keys=True),
+    )
+
+
+def _list_plans(**params):
+    plans = get_stripe().Plan.list(limit=100, expand=['data.product'], **params)
+    return plans.auto_paging_iter() if hasattr(plans, 'auto_paging_iter') else plans['data']
+
+
+def _store(tenant, rows):
+    with transaction.atomic():
+        for plan_id, (features, limits) in rows.items():
+            PlanEntitlement.objects.update_or_create(
+                tenant=tenant, plan_id=plan_id, defaults={'features': features, 'limits': limits})
+    invalidate()
+
+
+def sync_plan_features():
+    """
+    Store the entitlements of every Stripe plan of the current tenant in
+    PlanEntitlement, from the metadata of its product overridden by its own
+    metadata. Returns the number of plans synced.
+    """
+    tenant = current_tenant() or ''
+    rows = {
+        plan['id']: _entitlements(plan, plan['product'] if 'product' in plan else None)
+        for plan in _list_plans()
+    }
+    with transaction.atomic():
+        PlanEntitlement.objects.filter(tenant=tenant).exclude(plan_id__in=rows.keys()).delete()
+        _store(tenant, rows)
+    return len(rows)
+
+
+def sync_plan(plan, deleted=False):
+    """
+    Store the entitlements of `plan` alone, from a `plan.*` webhook.
+    """
+    tenant = current_tenant() or ''
+    if deleted:
+        PlanEntitlement.objects.filter(tenant=tenant, plan_id=plan['id']).delete()
+        invalidate()
+        return
+    product = plan['product'] if 'product' in plan else None
+    if isinstance(product, str):
+        # Webhook payloads only have the id of the product.
+        plan = get_stripe().Plan.retrieve(plan['id'], expand=['product'])
+        product = plan['product']
+    _store(tenant, {plan['id']: _entitlements(plan, product)})
+
+
+def sync_product(product):
+    """
+    Store the entitlements of the plans of `product`, from a `product.*`
+    webhook.
+    """
+    tenant = current_tenant() or ''
+    _store(tenant, {plan['id']: _entitlements(plan, product) for plan in _list_plans(product=product['id'])})
@@ -0,0 +1,248 @@
+"""
+Streaming exports of the billing history (BillingEvent) and of the Stripe
+event log (StripeEvent) in CSV or JSON Lines, optionally gzipped.
+
+Rows are read with `.iterator(chunk_size=...)` over the needed columns only
+and encoded as they are read, so memory use does not depend on the number
+of exported rows. Each invoice is parsed once; event payloads are copied
+as stored.
+"""
+import csv
+import json
+import zlib
+
+from datetime import datetime, time
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from saas.models import BillingEvent, StripeEvent, StripeInfo
+
+User = get_user_model()
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Rows are buffered into chunks of about this size before being yielded.
+BUFFER_SIZE = 64 * 1024
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def parse_bound(value):
+    """
+    Parse an ISO date or datetime into an aware datetime, dates meaning
+    midnight in the current timezone.
+    """
+    if value is None or isinstance(value, datetime):
+        moment = value
+    else:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(f'Invalid date {value}')
+            moment = datetime.combine(day, time.min)
+    if moment is not None and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _user_id(user):
+    if user is None or hasattr(user, 'pk'):
+        return getattr(user, 'pk', None)
+    user = str(user)
+    if user.isdigit():
+        return int(user)
+    user_id = User.objects.filter(email=user).values_list('pk', flat=True).first()
+    if user_id is None:
+        raise ValueError(f'Unknown user {user}')
+    return user_id
+
+
+class Export:
+    columns = []
+
+    def __init__(self, start=None, end=None, user=None, types=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Rows created in [start, end) for the given user (id, email or
+        instance) and types.
+        """
+        self.start = parse_bound(start)
+        self.end = parse_bound(end)
+        self.user_id = _user_id(user)
+        self.types = types or []
+        self.chunk_size = chunk_size
+
+    def queryset(self):
+        raise NotImplementedError
+
+    def filtered(self, queryset):
+        if self.start is not None:
+            queryset = queryset.filter(created_at__gte=self.start)
+        if self.end is not None:
+            queryset = queryset.filter(created_at__lt=self.end)
+        return queryset.order_by('created_at')
+
+    def rows(self):
+        """
+        Yield a dict per exported row, with `columns` as keys.
+        """
+        raise NotImplementedError
+
+    def csv_lines(self):
+        buffer = _LineBuffer()
+        writer = csv.writer(buffer)
+        writer.writerow(self.columns)
+        yield buffer.pop()
+        for row in self.rows():
+            writer.writerow([_csv_value(row[column]) for column in self.columns])
+            yield buffer.pop()
+
+    def jsonl_lines(self):
+        for row in self.rows():
+            yield json.dumps(row, default=str) + '\n'
+
+    def stream(self, format='csv', compress=False):
+        """
+        Yield the export as bytes chunks.
+        """
+        if format not in FORMATS:
+            raise ValueError(f'Unsupported format {format}')
+        lines = self.csv_lines() if format == 'csv' else self.jsonl_lines()
+        chunks = _buffered(line.encode('utf-8') for line in lines)
+        if compress:
+            chunks = _gzipped(chunks)
+        return chunks
+
+
+class BillingExport(Export):
+    columns = [
+        'id', 'created_at', 'user_id', 'email', 'success', 'invoice', 'number', 'status',
+        'currency', 'amount_due', 'amount_paid', 'description',
+    ]
+
+    def queryset(self):
+        queryset = BillingEvent.objects.all()
+        if self.user_id is not None:
+            queryset = queryset.filter(user_id=self.user_id)
+        if 'succeeded' in self.types and 'failed' not in self.types:
+            queryset = queryset.filter(success=True)
+        elif 'failed' in self.types and 'succeeded' not in self.types:
+            queryset = queryset.filter(success=False)
+        return self.filtered(queryset)
+
+    def rows(self):
+        values = self.queryset().values_list(
+            'id', 'created_at', 'user_id', 'user__email', 'success', 'stripe_object',
+        ).iterator(chunk_size=self.chunk_size)
+        for id, created_at, user_id, email, success, stripe_object in values:
+            try:
+                invoice = json.loads(stripe_object)
+            except ValueError:
+                invoice = {}
+            lines = (invoice.get('lines') or {}).get('data') or [{}]
+            yield {
+                'id': str(id),
+                'created_at': created_at.isoformat(),
+                'user_id': user_id,
+                'email': email,
+                'success': success,
+                'invoice': invoice.get('id'),
+                'number': invoice.get('number'),
+                'status': invoice.get('status'),
+                'currency': invoice.get('currency') or lines[0].get('currency'),
+                'amount_due': invoice.get('amount_due'),
+                'amount_paid': invoice.get('amount_paid'),
+                'description': lines[0].get('description'),
+            }
+
+
+class StripeEventExport(Export):
+    columns = ['id', 'created_at', 'event', 'event_id', 'object_id', 'object']
+
+    def queryset(self):
+        queryset = StripeEvent.objects.all()
+        if self.types:
+            queryset = queryset.filter(event__in=self.types)
+        if self.user_id is not None:
+            # Through the customer_id index, see saas.gdpr.
+            customer_ids = StripeInfo.objects.filter(user_id=self.user_id).values_list('customer_id', flat=True)
+            queryset = queryset.filter(customer_id__in=list(customer_ids))
+        return self.filtered(queryset)
+
+    def rows(self):
+        values = self.queryset().values_list(
+            'id', 'created_at', 'event', 'event_id', 'object_id', 'object',
+        ).iterator(chunk_size=self.chunk_size)
+        for id, created_at, event, event_id, object_id, stripe_object in values:
+            yield {
+                'id': str(id),
+                'created_at': created_at.isoformat(),
+                'event': event,
+                'event_id': event_id,
+                'object_id': object_id,
+                'object': stripe_object,
+            }
+
+    def jsonl_lines(self):
+        # Payloads are already JSON, splice them instead of parsing them. Stripe
+        # objects are stored indented, newlines can only be whitespace there.
+        for row in self.rows():
+            stripe_object = row.pop('object')
+            yield json.dumps(row)[:-1] + ', "object": ' + (stripe_object or 'null').replace('\n', ' ') + '}\n'
+
+
+EXPORTS = {
+    'billing': BillingExport,
+    'events': StripeEventExport,
+}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    return value
+
+
+class _LineBuffer:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, value):
+        self.lines.append(value)
+
+    def pop(self):
+        value = ''.join(self.lines)
+        self.lines = []
+        return value
+
+
+def _buffered(chunks, size=BUFFER_SIZE):
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_filename(dataset, format, compress=False, now=None):
+    now = now or timezone.now()
+    return f'{dataset}-{now:%Y%m%d%H%M%S}.{format}' + ('.gz' if compress else '')
+
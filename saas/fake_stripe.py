@@ -0,0 +1,676 @@
+"""
+In-process stand-in for the Stripe API, for offline development and load
+testing.
+
+Select it with:
+
+    SAAS_STRIPE_BACKEND = 'saas.fake_stripe.FakeStripe'
+
+`saas.client.get_stripe()` then returns a single FakeStripe instance exposing
+the subset of the `stripe` module used by django-saas (Customer,
+Subscription, SubscriptionItem, Plan, billing.MeterEvent,
+billing_portal.Session, checkout.Session, Webhook and error). Customers and subscriptions live in memory, and every change queues
+the webhook event Stripe would send; Checkout sessions are completed as soon
+as they are created. Queued events are signed with STRIPE_ENDPOINT_SECRET
+and delivered to StripeView by `deliver_events()`, optionally throttled:
+
+    SAAS_FAKE_STRIPE_PLANS = [
+        {'id': 'plan_monthly', 'amount': 1000, 'currency': 'usd', 'interval': 'month'},
+    ]
+    SAAS_FAKE_STRIPE_WEBHOOK_URL = '/stripe/webhook'  # path or http(s) URL
+    SAAS_FAKE_STRIPE_WEBHOOK_RATE = 50  # events per second, None for no limit
+"""
+import copy
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+import uuid
+
+from collections import deque
+from django.conf import settings
+
+DEFAULT_PLANS = [
+    {'id': 'plan_fake_monthly', 'amount': 1000, 'currency': 'usd', 'interval': 'month', 'trial_period_days': 0},
+]
+
+INTERVALS = {
+    'day': 24 * 3600,
+    'week': 7 * 24 * 3600,
+    'month': 30 * 24 * 3600,
+    'year': 365 * 24 * 3600,
+}
+
+DEFAULT_TOLERANCE = 300
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """
+    Return a Stripe-Signature header value for `payload`.
+    """
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    signed = '{}.{}'.format(timestamp, payload).encode('utf-8')
+    signature = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return 't={},v1={}'.format(timestamp, signature)
+
+
+class StripeObject(dict):
+    """
+    Dictionary with attribute access that serializes to JSON, like the objects
+    returned by the `stripe` library.
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __str__(self):
+        return json.dumps(self)
+
+    @classmethod
+    def construct_from(cls, value):
+        if isinstance(value, dict):
+            return cls({key: cls.construct_from(item) for key, item in value.items()})
+        if isinstance(value, list):
+            return [cls.construct_from(item) for item in value]
+        return value
+
+
+class StripeError(Exception):
+    pass
+
+
+class InvalidRequestError(StripeError):
+    def __init__(self, message, param=None, code=None):
+        super().__init__(message)
+        self.param = param
+        self.code = code
+
+
+class SignatureVerificationError(StripeError):
+    def __init__(self, message, sig_header=None):
+        super().__init__(message)
+        self.sig_header = sig_header
+
+
+class _Errors:
+    StripeError = StripeError
+    InvalidRequestError = InvalidRequestError
+    SignatureVerificationError = SignatureVerificationError
+
+
+class _Resource:
+    def __init__(self, backend):
+        self._backend = backend
+
+
+class _Customer(_Resource):
+    def create(self, email=None, **params):
+        return self._backend.create_customer(email=email, **params)
+
+    def retrieve(self, id, expand=None, **params):
+        return self._backend.retrieve_customer(id)
+
+    def modify(self, id, **params):
+        return self._backend.modify_customer(id, **params)
+
+    def list(self, email=None, limit=None, **params):
+        return self._backend.list_customers(email=email, limit=limit)
+
+    def delete(self, id, **params):
+        return self._backend.delete_customer(id)
+
+
+class _Subscription(_Resource):
+    def create(self, customer, items, **params):
+        return self._backend.create_subscription(customer, items, **params)
+
+    def retrieve(self, id, **params):
+        return self._backend.view(self._backend.get_subscription(id))
+
+    def modify(self, id, **params):
+        return self._backend.modify_subscription(id, **params)
+
+    def delete(self, id, **params):
+        return self._backend.cancel_subscription(id)
+
+
+class _SubscriptionItem(_Resource):
+    def create_usage_record(self, id, quantity, timestamp=None, action='increment', idempotency_key=None, **params):
+        return self._backend.create_usage_record(id, quantity, timestamp, action, idempotency_key)
+
+
+class _Plan(_Resource):
+    def list(self, product=None, **params):
+        plans = [plan for plan in self._backend.plans.values() if product is None or plan['product'] == product]
+        return self._backend.view({'object': 'list', 'data': plans})
+
+    def retrieve(self, id, **params):
+        try:
+            return self._backend.view(self._backend.plans[id])
+        except KeyError:
+            raise InvalidRequestError(f'No such plan: {id}', 'id')
+
+
+class _MeterEvent(_Resource):
+    def create(self, event_name, payload, identifier=None, timestamp=None, **params):
+        return self._backend.create_meter_event(event_name, payload, identifier, timestamp)
+
+
+class _Billing:
+    def __init__(self, backend):
+        self.MeterEvent = _MeterEvent(backend)
+
+
+class _BillingPortalSession(_Resource):
+    def create(self, customer, return_url, **params):
+        self._backend.get_customer(customer)
+        return self._backend.view({
+            'id': self._backend.new_id('bps'),
+            'object': 'billing_portal.session',
+            'customer': customer,
+            'return_url': return_url,
+            'url': return_url,
+        })
+
+
+class _BillingPortal:
+    def __init__(self, backend):
+        self.Session = _BillingPortalSession(backend)
+
+
+class _CheckoutSession(_Resource):
+    def create(self, line_items, success_url, mode='subscription', **params):
+        return self._backend.create_checkout_session(line_items, success_url, mode, **params)
+
+    def retrieve(self, id, **params):
+        try:
+            return self._backend.view(self._backend.checkout_sessions[id])
+        except KeyError:
+            raise InvalidRequestError(f'No such checkout session: {id}', 'id')
+
+
+class _Checkout:
+    def __init__(self, backend):
+        self.Session = _CheckoutSession(backend)
+
+
+class _Webhook(_Resource):
+    def construct_event(self, payload, sig_header, secret, tolerance=DEFAULT_TOLERANCE, **params):
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        self._backend.verify_header(payload, sig_header, secret, tolerance)
+        try:
+            return StripeObject.construct_from(json.loads(payload))
+        except json.JSONDecodeError as e:
+            raise ValueError(str(e))
+
+
+class FakeStripe:
+    """
+    In-memory Stripe backend. All state is guarded by a lock so the instance
+    can be shared by every thread of a process.
+    """
+    error = _Errors
+
+    def __init__(self, plans=None, endpoint_secret=None):
+        self.api_key = None
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._clock_offset = 0
+        self.customers = {}
+        self.subscriptions = {}
+        self.events = deque()
+        self.idempotency_keys = {}
+        self.usage_records = []
+        self.usage_idempotency_keys = {}
+        self.meter_events = {}
+        self.checkout_sessions = {}
+        if plans is None:
+            plans = getattr(settings, 'SAAS_FAKE_STRIPE_PLANS', DEFAULT_PLANS)
+        self.plans = {plan['id']: self._plan(plan) for plan in plans}
+        self.endpoint_secret = endpoint_secret
+        self.Customer = _Customer(self)
+        self.Subscription = _Subscription(self)
+        self.Plan = _Plan(self)
+        self.SubscriptionItem = _SubscriptionItem(self)
+        self.billing = _Billing(self)
+        self.billing_portal = _BillingPortal(self)
+        self.checkout = _Checkout(self)
+        self.Webhook = _Webhook(self)
+
+    # Helpers
+
+    def now(self):
+        return int(time.time()) + self._clock_offset
+
+    def advance(self, seconds):
+        """
+        Move the fake clock forward, see `renew_subscriptions`.
+        """
+        with self._lock:
+            self._clock_offset += int(seconds)
+
+    def new_id(self, prefix):
+        return '{}_fake{}{}'.format(prefix, next(self._ids), uuid.uuid4().hex[:8])
+
+    def view(self, value):
+        # Callers get a copy so that they can never mutate the backend state.
+        return StripeObject.construct_from(copy.deepcopy(value))
+
+    def _plan(self, plan):
+        return {
+            'id': plan['id'],
+            'object': 'plan',
+            'active': True,
+            'amount': plan.get('amount', 0),
+            'currency': plan.get('currency', 'usd'),
+            'interval': plan.get('interval', 'month'),
+            'interval_count': plan.get('interval_count', 1),
+            'nickname': plan.get('nickname', plan['id']),
+            'product': plan.get('product', 'prod_fake'),
+            'trial_period_days': plan.get('trial_period_days', 0),
+            'metadata': plan.get('metadata', {}),
+        }
+
+    def emit(self, event_type, stripe_object):
+        with self._lock:
+            self.events.append({
+                'id': self.new_id('evt'),
+                'object': 'event',
+                'type': event_type,
+                'created': self.now(),
+                'livemode': False,
+                'data': {'object': copy.deepcopy(stripe_object)},
+            })
+
+    # Customers
+
+    def get_customer(self, customer_id, allow_deleted=False):
+        customer = self.customers.get(customer_id)
+        if customer is None or ('deleted' in customer and not allow_deleted):
+            raise InvalidRequestError(f'No such customer: {customer_id}', 'id', 'resource_missing')
+        return customer
+
+    def _customer_with_subscriptions(self, customer):
+        if 'deleted' in customer:
+            return customer
+        customer = dict(customer)
+        data = [
+            self.subscriptions[subscription_id]
+            for subscription_id in customer.pop('_subscriptions')
+        ]
+        customer['subscriptions'] = {'object': 'list', 'data': data}
+        return customer
+
+    def create_customer(self, email=None, idempotency_key=None, **params):
+        with self._lock:
+            if idempotency_key is not None and idempotency_key in self.idempotency_keys:
+                return self.view(self._customer_with_subscriptions(
+                    self.customers[self.idempotency_keys[idempotency_key]]))
+            customer = {
+                'id': self.new_id('cus'),
+                'object': 'customer',
+                'created': self.now(),
+                'email': email,
+                'metadata': params.get('metadata', {}),
+                'sources': {'object': 'list', 'data': []},
+                'default_source': None,
+                '_subscriptions': [],
+            }
+            self.customers[customer['id']] = customer
+            if idempotency_key is not None:
+                self.idempotency_keys[idempotency_key] = customer['id']
+            if 'source' in params:
+                self._attach_source(customer, params['source'])
+            public = self._customer_with_subscriptions(customer)
+            self.emit('customer.created', public)
+            return self.view(public)
+
+    def _attach_source(self, customer, token):
+        card = {
+            'id': self.new_id('card'),
+            'object': 'card',
+            'brand': 'Visa',
+            'last4': '4242',
+            'exp_month': 12,
+            'exp_year': time.gmtime(self.now()).tm_year + 3,
+            'customer': customer['id'],
+            'token': token,
+        }
+        customer['sources']['data'] = [card]
+        customer['default_source'] = card['id']
+        self.emit('customer.source.created', card)
+
+    def retrieve_customer(self, customer_id):
+        with self._lock:
+            customer = self.get_customer(customer_id, allow_deleted=True)
+            return self.view(self._customer_with_subscriptions(customer))
+
+    def modify_customer(self, customer_id, **params):
+        with self._lock:
+            customer = self.get_customer(customer_id)
+            if 'source' in params:
+                self._attach_source(customer, params.pop('source'))
+            for key in ('email', 'metadata'):
+                if key in params:
+                    customer[key] = params[key]
+            public = self._customer_with_subscriptions(customer)
+            self.emit('customer.updated', public)
+            return self.view(public)
+
+    def list_customers(self, email=None, limit=None):
+        with self._lock:
+            data = [
+                self._customer_with_subscriptions(customer)
+                for customer in self.customers.values()
+                if 'deleted' not in customer and (email is None or customer['email'] == email)
+            ]
+            if limit is not None:
+                data = data[:limit]
+            return self.view({'object': 'list', 'data': data, 'has_more': False})
+
+    def delete_customer(self, customer_id):
+        with self._lock:
+            customer = self.get_customer(customer_id)
+            for subscription_id in list(customer['_subscriptions']):
+                self.cancel_subscription(subscription_id)
+            public = self._customer_with_subscriptions(customer)
+            self.customers[customer_id] = {'id': customer_id, 'object': 'customer', 'deleted': True}
+            self.emit('customer.deleted', public)
+            return self.view(self.customers[customer_id])
+
+    # Subscriptions
+
+    def get_subscription(self, subscription_id):
+        try:
+            return self.subscriptions[subscription_id]
+        except KeyError:
+            raise InvalidRequestError(f'No such subscription: {subscription_id}', 'id')
+
+    def _period(self, plan):
+        return INTERVALS[plan['interval']] * plan['interval_count']
+
+    def _invoice(self, subscription, amount):
+        plan = subscription['plan']
+        return {
+            'id': self.new_id('in'),
+            'object': 'invoice',
+            'customer': subscription['customer'],
+            'subscription': subscription['id'],
+            'created': self.now(),
+            'currency': plan['currency'],
+            'amount_due': amount,
+            'amount_paid': amount,
+            'paid': True,
+            'period_start': subscription['current_period_start'],
+            'period_end': subscription['current_period_end'],
+            'lines': {'object': 'list', 'data': [{
+                'description': '1 × {} (at {} / {})'.format(plan['nickname'], plan['amount'], plan['interval']),
+                'currency': plan['currency'],
+                'amount': amount,
+                'plan': plan,
+                'quantity': subscription['quantity'],
+            }]},
+        }
+
+    def create_subscription(self, customer, items, trial_from_plan=False, trial_period_days=None, **params):
+        with self._lock:
+            owner = self.get_customer(customer)
+            item_plans = []
+            for item in items:
+                plan_id = item.get('plan') or item.get('price')
+                try:
+                    item_plans.append((self.plans[plan_id], item.get('quantity', 1)))
+                except KeyError:
+                    raise InvalidRequestError(f'No such plan: {plan_id}', 'items')
+            plan, quantity = item_plans[0]
+            now = self.now()
+            trial_days = trial_period_days
+            if trial_days is None and trial_from_plan:
+                trial_days = plan['trial_period_days']
+            trial_end = now + trial_days * 24 * 3600 if trial_days else None
+            subscription = {
+                'id': self.new_id('sub'),
+                'object': 'subscription',
+                'customer': customer,
+                'status': 'trialing' if trial_end else 'active',
+                'created': now,
+                'start_date': now,
+                'current_period_start': now,
+                'current_period_end': trial_end or now + self._period(plan),
+                'trial_end': trial_end,
+                'cancel_at_period_end': False,
+                'canceled_at': None,
+                'plan': plan,
+                'quantity': quantity,
+                'items': {'object': 'list', 'data': [{
+                    'id': self.new_id('si'),
+                    'object': 'subscription_item',
+                    'plan': item_plan,
+                    'price': item_plan,
+                    'quantity': item_quantity,
+                } for item_plan, item_quantity in item_plans]},
+                'default_source': owner['default_source'],
+            }
+            self.subscriptions[subscription['id']] = subscription
+            owner['_subscriptions'].append(subscription['id'])
+            self.emit('customer.subscription.created', subscription)
+            self.emit('invoice.payment_succeeded', self._invoice(
+                subscription, 0 if trial_end else plan['amount'] * quantity))
+            return self.view(subscription)
+
+    def modify_subscription(self, subscription_id, **params):
+        with self._lock:
+            subscription = self.get_subscription(subscription_id)
+            if 'items' in params:
+                item = params['items'][0]
+                plan_id = item.get('plan') or item.get('price')
+                if plan_id is not None:
+                    try:
+                        subscription['plan'] = self.plans[plan_id]
+                    except KeyError:
+                        raise InvalidRequestError(f'No such plan: {plan_id}', 'items')
+                subscription['quantity'] = item.get('quantity', subscription['quantity'])
+                subscription['items']['data'][0]['plan'] = subscription['plan']
+                subscription['items']['data'][0]['price'] = subscription['plan']
+                subscription['items']['data'][0]['quantity'] = subscription['quantity']
+            for key in ('cancel_at_period_end', 'default_source', 'metadata'):
+                if key in params:
+                    subscription[key] = params[key]
+            self.emit('customer.subscription.updated', subscription)
+            return self.view(subscription)
+
+    def cancel_subscription(self, subscription_id):
+        with self._lock:
+            subscription = self.get_subscription(subscription_id)
+            subscription['status'] = 'canceled'
+            subscription['canceled_at'] = self.now()
+            del self.subscriptions[subscription_id]
+            customer = self.customers[subscription['customer']]
+            customer['_subscriptions'].remove(subscription_id)
+            self.emit('customer.subscription.deleted', subscription)
+            return self.view(subscription)
+
+    def create_usage_record(self, item_id, quantity, timestamp=None, action='increment', idempotency_key=None):
+        with self._lock:
+            if idempotency_key is not None and idempotency_key in self.usage_idempotency_keys:
+                return self.view(self.usage_records[self.usage_idempotency_keys[idempotency_key]])
+            if not any(
+                item['id'] == item_id
+                for subscription in self.subscriptions.values()
+                for item in subscription['items']['data']
+            ):
+                raise InvalidRequestError(f'No such subscription item: {item_id}', 'id')
+            record = {
+                'id': self.new_id('mbur'),
+                'object': 'usage_record',
+                'subscription_item': item_id,
+                'quantity': int(quantity),
+                'timestamp': int(timestamp) if timestamp is not None else self.now(),
+                'action': action,
+            }
+            self.usage_records.append(record)
+            if idempotency_key is not None:
+                self.usage_idempotency_keys[idempotency_key] = len(self.usage_records) - 1
+            return self.view(record)
+
+    def create_meter_event(self, event_name, payload, identifier=None, timestamp=None):
+        with self._lock:
+            identifier = identifier or self.new_id('mev')
+            # Stripe ignores meter events with an identifier it has already seen.
+            if identifier not in self.meter_events:
+                if payload.get('stripe_customer_id') not in self.customers:
+                    raise InvalidRequestError(f"No such customer: {payload.get('stripe_customer_id')}", 'payload')
+                self.meter_events[identifier] = {
+                    'object': 'billing.meter_event',
+                    'event_name': event_name,
+                    'identifier': identifier,
+                    'payload': dict(payload),
+                    'timestamp': int(timestamp) if timestamp is not None else self.now(),
+                }
+            return self.view(self.meter_events[identifier])
+
+    # Checkout
+
+    def create_checkout_session(self, line_items, success_url, mode='subscription', **params):
+        """
+        Create a Checkout session and complete it right away, as if the
+        customer had paid on the hosted page.
+        """
+        if mode != 'subscription':
+            raise InvalidRequestError(f'Unsupported checkout mode: {mode}', 'mode')
+        with self._lock:
+            customer_id = params.get('customer')
+            if customer_id is None:
+                customer_id = self.create_customer(email=params.get('customer_email'))['id']
+            customer = self.get_customer(customer_id)
+            subscription = self.create_subscription(customer_id, [
+                {'price': item['price'], 'quantity': item.get('quantity', 1)} for item in line_items
+            ])
+            session = {
+                'id': self.new_id('cs'),
+                'object': 'checkout.session',
+                'mode': mode,
+                'status': 'complete',
+                'payment_status': 'paid',
+                'client_reference_id': params.get('client_reference_id'),
+                'customer': customer_id,
+                'customer_email': params.get('customer_email'),
+                'customer_details': {'email': customer['email']},
+                'subscription': subscription['id'],
+                'success_url': success_url,
+                'cancel_url': params.get('cancel_url'),
+                'url': success_url,
+            }
+            self.checkout_sessions[session['id']] = session
+            self.emit('checkout.session.completed', session)
+            return self.view(session)
+
+    def renew_subscriptions(self):
+        """
+        Renew (or end, when cancelled at period end) every subscription whose
+        period ended according to the fake clock. Returns the number of
+        subscriptions processed.
+        """
+        processed = 0
+        with self._lock:
+            now = self.now()
+            for subscription in list(self.subscriptions.values()):
+                if subscription['current_period_end'] > now:
+                    continue
+                processed += 1
+                if subscription['cancel_at_period_end']:
+                    self.cancel_subscription(subscription['id'])
+                    continue
+                plan = subscription['plan']
+                subscription['status'] = 'active'
+                subscription['current_period_start'] = subscription['current_period_end']
+                subscription['current_period_end'] += self._period(plan)
+                self.emit('customer.subscription.updated', subscription)
+                self.emit('invoice.payment_succeeded', self._invoice(
+                    subscription, plan['amount'] * subscription['quantity']))
+        return processed
+
+    # Webhooks
+
+    def verify_header(self, payload, sig_header, secret, tolerance=DEFAULT_TOLERANCE):
+        try:
+            parts = dict(part.split('=', 1) for part in sig_header.split(','))
+            timestamp = int(parts['t'])
+            expected = sign_payload(payload, secret, timestamp)
+        except (AttributeError, KeyError, ValueError):
+            raise SignatureVerificationError('Unable to extract timestamp and signatures from header', sig_header)
+        if not hmac.compare_digest(expected, sig_header):
+            raise SignatureVerificationError('No signatures found matching the expected signature for payload', sig_header)
+        if tolerance and timestamp < time.time() - tolerance:
+            raise SignatureVerificationError('Timestamp outside the tolerance zone', sig_header)
+
+    def pop_events(self, limit=None):
+        events = []
+        with self._lock:
+            while self.events and (limit is None or len(events) < limit):
+                events.append(self.events.popleft())
+        return events
+
+    def deliver_events(self, target=None, rate=None, limit=None, secret=None):
+        """
+        Sign and deliver queued events to `target`, either a URL path resolved
+        in process or an http(s) URL, at most `rate` events per second.
+        Returns the list of HTTP status codes, in delivery order.
+        """
+        if target is None:
+            target = settings.SAAS_FAKE_STRIPE_WEBHOOK_URL
+        if rate is None:
+            rate = getattr(settings, 'SAAS_FAKE_STRIPE_WEBHOOK_RATE', None)
+        secret = secret or self.endpoint_secret or settings.STRIPE_ENDPOINT_SECRET
+        send = _http_sender(target) if target.startswith(('http://', 'https://')) else _local_sender(target)
+
+        statuses = []
+        interval = 1.0 / rate if rate else 0
+        next_at = time.monotonic()
+        for event in self.pop_events(limit):
+            if interval:
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at = max(next_at, time.monotonic()) + interval
+            payload = json.dumps(event)
+            statuses.append(send(payload, sign_payload(payload, secret)))
+        return statuses
+
+
+def _local_sender(path):
+    from django.test import RequestFactory
+    from django.urls import resolve
+
+    match = resolve(path)
+    factory = RequestFactory()
+
+    def send(payload, signature):
+        request = factory.post(
+            path, data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=signature,
+        )
+        return match.func(request, *match.args, **match.kwargs).status_code
+    return send
+
+
+def _http_sender(url):
+    import urllib.error
+    import urllib.request
+
+    def send(payload, signature):
+        request = urllib.request.Request(url, data=payload.encode('utf-8'), method='POST', headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': signature,
+        })
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+    return send
@@ -9,7 +9,6 @@ from django.core.exceptions import ValidationError
 from django.http import HttpRequest
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
-from django_recaptcha.fields import ReCaptchaField
 
 from saas.mailer import AbstractSaasMailer, send_multi_mail
 
@@ -17,17 +16,22 @@ User = get_user_model()
 
 
 class CreateUserForm(UserCreationForm):
-    captcha = ReCaptchaField()
-
     class Meta:
         model = User
-        fields = ("email", "password1", "password2", "captcha")
+        fields = ("email", "password1", "password2")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # django_recaptcha is only needed when the form is actually built.
+        from django_recaptcha.fields import ReCaptchaField
+
+        self.fields["captcha"] = ReCaptchaField()
 
     def clean_email(self):
         email = self.cleaned_data["email"]
         if not email:
             raise ValidationError("This field is required.")
-        if User.objects.filter(email=self.cleaned_data["email"]).count():
+        if User.objects.filter(email=self.cleaned_data["email"]).exists():
             raise ValidationError("Email is taken.")
         return self.cleaned_data["email"]
 
@@ -0,0 +1,224 @@
+"""
+Export and erasure of the data django-saas keeps about a user.
+
+StripeEvent has no foreign key to users: the id of the customer of each
+event is stored in its indexed `customer_id` when it is recorded, so the
+events of a user are found through the index instead of by scanning the
+payloads. Events recorded before that are indexed in batches by
+`index_events()` (see the `index_stripe_events` command).
+
+`export_user()` streams a zip of every saas row of a user, events included,
+and `erase_user()` redacts the personal data of the event payloads in
+batches, deletes the rows keyed by customer id and the stored receipts, and
+finally the user, whose deletion cascades to the other tables. Erasure can
+be run again after an interruption.
+"""
+import json
+import logging
+import zipfile
+
+from django.contrib.auth import get_user_model
+from django.db import router, transaction
+from saas.exports import BUFFER_SIZE, DEFAULT_CHUNK_SIZE, StripeEventExport, _user_id
+from saas.models import (
+    Acquisition,
+    BillingEvent,
+    CustomerSnapshot,
+    Dunning,
+    Membership,
+    PaymentMethod,
+    StripeEvent,
+    StripeInfo,
+    SubscriptionPeriod,
+    UsageRecord,
+    stripe_customer_id,
+)
+from saas.receipts import receipt_storage
+
+User = get_user_model()
+
+logger = logging.getLogger("saas")
+
+USER_FIELDS = ['id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'date_joined', 'last_login']
+
+# Tables with a foreign key to the user, exported as `<name>.jsonl`.
+USER_TABLES = {
+    'stripe_info': StripeInfo,
+    'acquisition': Acquisition,
+    'billing': BillingEvent,
+    'subscription_periods': SubscriptionPeriod,
+    'usage': UsageRecord,
+    'dunning': Dunning,
+    'memberships': Membership,
+}
+
+# Tables keyed by the Stripe customer id.
+CUSTOMER_TABLES = {
+    'customer_snapshots': CustomerSnapshot,
+    'payment_methods': PaymentMethod,
+}
+
+# Keys of Stripe objects holding personal data, at any depth.
+PERSONAL_KEYS = {
+    'address', 'billing_details', 'customer_address', 'customer_details', 'customer_email',
+    'customer_name', 'customer_phone', 'customer_shipping', 'email', 'metadata', 'name',
+    'phone', 'receipt_email', 'shipping',
+}
+
+REDACTED = '[redacted]'
+
+
+def get_user(user):
+    """
+    Return the user with the id or email `user`.
+    """
+    return User.objects.get(pk=_user_id(user))
+
+
+def customer_ids_of(user_id):
+    return list(StripeInfo.objects.filter(user_id=user_id).values_list('customer_id', flat=True))
+
+
+def redact(value):
+    """
+    Return a copy of a Stripe object without its personal data.
+    """
+    if isinstance(value, dict):
+        return {
+            key: (REDACTED if item is not None else None) if key in PERSONAL_KEYS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class _Stream:
+    """
+    Write only file collecting what zipfile writes, to be yielded.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def _jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, default=str) + '\n'
+
+
+def export_user(user, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield a zip of the data of `user` as bytes chunks: `user.json`, a JSON
+    Lines file per table and `events.jsonl` for the Stripe events.
+    """
+    customer_ids = customer_ids_of(user.pk)
+    files = [
+        ('user.json', [json.dumps({field: getattr(user, field, None) for field in USER_FIELDS}, default=str)]),
+    ]
+    for name, model in USER_TABLES.items():
+        rows = model.objects.filter(user_id=user.pk).order_by('created_at').values().iterator(chunk_size=chunk_size)
+        files.append((f'{name}.jsonl', _jsonl(rows)))
+    for name, model in CUSTOMER_TABLES.items():
+        rows = model.objects.filter(customer_id__in=customer_ids).order_by('created_at').values().iterator(
+            chunk_size=chunk_size)
+        files.append((f'{name}.jsonl', _jsonl(rows)))
+    files.append(('events.jsonl', StripeEventExport(user=user, chunk_size=chunk_size).jsonl_lines()))
+
+    stream = _Stream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, lines in files:
+            with archive.open(name, 'w') as f:
+                for line in lines:
+                    f.write(line.encode('utf-8'))
+                    if stream.size >= BUFFER_SIZE:
+                        yield stream.pop()
+    yield stream.pop()
+
+
+def redact_events(customer_id, batch_size=500):
+    """
+    Redact the events of `customer_id` in batches, and take them out of the
+    customer index. Returns the number of events redacted.
+    """
+    redacted = 0
+    while True:
+        with transaction.atomic(using=router.db_for_write(StripeEvent)):
+            events = list(
+                StripeEvent.objects.select_for_update()
+                .filter(customer_id=customer_id)
+                .only('id', 'object')[:batch_size]
+            )
+            if not events:
+                return redacted
+            for event in events:
+                try:
+                    event.object = json.dumps(redact(json.loads(event.object)))
+                except ValueError:
+                    event.object = '{}'
+                event.customer_id = ''
+            StripeEvent.objects.bulk_update(events, ['object', 'customer_id'])
+        redacted += len(events)
+
+
+def delete_receipts(user_id):
+    storage = receipt_storage()
+    try:
+        _, files = storage.listdir(f'receipts/{user_id}')
+    except (FileNotFoundError, NotImplementedError):
+        return
+    for name in files:
+        storage.delete(f'receipts/{user_id}/{name}')
+
+
+def erase_user(user, batch_size=500):
+    """
+    Erase `user` and everything django-saas keeps about them. Returns the
+    number of Stripe events redacted.
+    """
+    user_id = user.pk
+    customer_ids = customer_ids_of(user_id)
+    redacted = 0
+    for customer_id in customer_ids:
+        redacted += redact_events(customer_id, batch_size)
+    for model in CUSTOMER_TABLES.values():
+        model.objects.filter(customer_id__in=customer_ids).delete()
+    delete_receipts(user_id)
+    user.delete()
+    logger.info(f"User {user_id} erased, {redacted} Stripe events redacted")
+    return redacted
+
+
+def index_events(batch_size=2000):
+    """
+    Set the customer_id of the events recorded before it was extracted at
+    ingest, in batches. Returns the number of events indexed.
+    """
+    indexed = 0
+    while True:
+        events = list(StripeEvent.objects.filter(customer_id=None).only('id', 'event', 'object')[:batch_size])
+        if not events:
+            return indexed
+        for event in events:
+            try:
+                stripe_object = json.loads(event.object)
+            except ValueError:
+                stripe_object = None
+            customer_id = stripe_customer_id(event.event, stripe_object) if isinstance(stripe_object, dict) else None
+            event.customer_id = (customer_id or '')[:256]
+        StripeEvent.objects.bulk_update(events, ['customer_id'])
+        indexed += len(events)
@@ -0,0 +1,79 @@
+"""
+Health of the webhook processing, to alert on or autoscale webhook workers.
+
+StripeWebhook records every event before handling it and sets its
+`processed_at` (and `failed`) once done. A delivery that crashed before
+that is marked done when Stripe redelivers the same event successfully, so
+`webhook_health()` reports from indexed queries on StripeEvent:
+
+- the age of the oldest event whose handling has not finished,
+- the events received per minute and the handler failures, by type, over
+  the last SAAS_WEBHOOK_HEALTH_WINDOW seconds (300 by default),
+- the average and maximum lag between the creation of the events by Stripe
+  and the end of their handling over the same window.
+
+The report is cached for SAAS_WEBHOOK_HEALTH_CACHE_SECONDS (5 by default) so
+that scraping it often costs nothing. Failures are only kept when events are
+not rolled back with the request, e.g. with SAAS_EVENTS_DATABASE or without
+ATOMIC_REQUESTS.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Max, Q
+from django.utils import timezone
+from saas.models import StripeEvent
+
+CACHE_KEY = 'saas:webhook_health'
+
+
+def health_window():
+    return timedelta(seconds=getattr(settings, 'SAAS_WEBHOOK_HEALTH_WINDOW', 300))
+
+
+def _seconds(duration):
+    return duration.total_seconds() if duration is not None else None
+
+
+def webhook_health(now=None):
+    """
+    Return the webhook processing health as a JSON serializable dict.
+    """
+    now = timezone.now() if now is None else now
+    window = health_window()
+    oldest = (
+        StripeEvent.objects.filter(processed_at=None)
+        .order_by('created_at')
+        .values_list('created_at', flat=True)
+        .first()
+    )
+    recent = StripeEvent.objects.filter(created_at__gte=now - window)
+    by_type = (
+        recent.values('event')
+        .annotate(count=Count('id'), failures=Count('id', filter=Q(failed=True)))
+        .order_by('event')
+    )
+    lag = recent.exclude(processed_at=None).exclude(stripe_created_at=None).aggregate(
+        average=Avg(ExpressionWrapper(F('processed_at') - F('stripe_created_at'), output_field=DurationField())),
+        maximum=Max(ExpressionWrapper(F('processed_at') - F('stripe_created_at'), output_field=DurationField())),
+    )
+    minutes = window.total_seconds() / 60
+    return {
+        'oldest_unprocessed_seconds': _seconds(now - oldest) if oldest is not None else 0,
+        'window_seconds': window.total_seconds(),
+        'events_per_minute': {row['event']: row['count'] / minutes for row in by_type},
+        'failures': {row['event']: row['failures'] for row in by_type if row['failures']},
+        'lag_seconds': {
+            'average': _seconds(lag['average']),
+            'max': _seconds(lag['maximum']),
+        },
+    }
+
+
+def cached_webhook_health():
+    timeout = getattr(settings, 'SAAS_WEBHOOK_HEALTH_CACHE_SECONDS', 5)
+    health = cache.get(CACHE_KEY)
+    if health is None:
+        health = webhook_health()
+        cache.set(CACHE_KEY, health, timeout)
+    return health
@@ -0,0 +1,264 @@
+"""
+Optional latency and query count instrumentation for the saas hot paths.
+
+Instrumentation is disabled unless SAAS_INSTRUMENTATION is True, in which
+case every measurement is sent through the `measured` signal and recorded by
+the backend configured with SAAS_METRICS_BACKEND (a dotted path, instantiated
+with SAAS_METRICS_BACKEND_OPTIONS as keyword arguments):
+
+    SAAS_INSTRUMENTATION = True
+    SAAS_METRICS_BACKEND = 'saas.instrumentation.StatsdBackend'
+    SAAS_METRICS_BACKEND_OPTIONS = {'host': 'localhost', 'port': 8125}
+"""
+import logging
+import re
+import socket
+import threading
+import time
+import types
+
+from functools import wraps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("saas")
+
+# Sent with name, duration (in seconds), queries and tags for every measurement.
+measured = Signal()
+
+DEFAULT_METRICS_BACKEND = 'saas.instrumentation.InMemoryBackend'
+
+_enabled = None
+_backend = None
+
+
+def is_enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = bool(getattr(settings, 'SAAS_INSTRUMENTATION', False))
+    return _enabled
+
+
+def get_metrics_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SAAS_METRICS_BACKEND', DEFAULT_METRICS_BACKEND)
+        options = getattr(settings, 'SAAS_METRICS_BACKEND_OPTIONS', {})
+        _backend = import_string(path)(**options)
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_instrumentation(setting, **kwargs):
+    global _enabled, _backend
+    if setting.startswith('SAAS_INSTRUMENTATION') or setting.startswith('SAAS_METRICS_BACKEND'):
+        _enabled = None
+        _backend = None
+
+
+class QueryCounter:
+    """
+    Database execute wrapper counting queries without storing them.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Measurement:
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self._counter = QueryCounter()
+        self._wrapper = None
+        self._start = None
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self._counter)
+        self._wrapper.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._start
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        record(self.name, duration, self._counter.count, self.tags)
+        return False
+
+
+class _NullMeasurement:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_measurement = _NullMeasurement()
+
+
+def timed(name, **tags):
+    """
+    Context manager measuring the duration and number of queries of a block.
+    """
+    if not is_enabled():
+        return _null_measurement
+    return Measurement(name, tags)
+
+
+def instrumented(name):
+    """
+    Decorator measuring every call of the decorated function.
+    """
+    def decorator(func):
+        @wraps(func)
+        def _wrapped(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with Measurement(name, {}):
+                return func(*args, **kwargs)
+        return _wrapped
+    return decorator
+
+
+def record(name, duration, queries, tags):
+    try:
+        get_metrics_backend().record(name, duration, queries, tags)
+    except Exception:
+        logger.exception(f"Could not record metric {name}")
+    measured.send(sender=Measurement, name=name, duration=duration, queries=queries, tags=tags)
+
+
+class InstrumentedStripe:
+    """
+    Proxy around the `stripe` module timing every API call as `stripe_api`
+    tagged with the called method, e.g. `Customer.create`.
+    """
+    def __init__(self, target, path=None):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        path = f'{self._path}.{attr}' if self._path else attr
+        if isinstance(value, type) and issubclass(value, BaseException):
+            return value
+        if isinstance(value, type) or isinstance(value, types.ModuleType):
+            return InstrumentedStripe(value, path)
+        if callable(value):
+            @wraps(value)
+            def _call(*args, **kwargs):
+                with timed('stripe_api', call=path):
+                    return value(*args, **kwargs)
+            return _call
+        if hasattr(value, '__dict__'):
+            # Resource namespaces of alternative backends such as FakeStripe.
+            return InstrumentedStripe(value, path)
+        return value
+
+    def __setattr__(self, attr, value):
+        setattr(self._target, attr, value)
+
+
+class MetricsBackend:
+    def record(self, name, duration, queries, tags):
+        raise NotImplementedError
+
+
+class InMemoryBackend(MetricsBackend):
+    """
+    Aggregates measurements in process, to be scraped in the Prometheus text
+    format through `prometheus_text()` (see MetricsView).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def record(self, name, duration, queries, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0.0, 0]
+            series[0] += 1
+            series[1] += duration
+            series[2] += queries
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: {'count': count, 'duration': duration, 'queries': queries}
+                for key, (count, duration, queries) in self._series.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def prometheus_text(self, prefix='saas'):
+        lines = [
+            f'# HELP {prefix}_duration_seconds Time spent in django-saas operations.',
+            f'# TYPE {prefix}_duration_seconds summary',
+        ]
+        snapshot = sorted(self.snapshot().items())
+        for (name, tags), series in snapshot:
+            labels = prometheus_labels(name, tags)
+            lines.append(f'{prefix}_duration_seconds_count{labels} {series["count"]}')
+            lines.append(f'{prefix}_duration_seconds_sum{labels} {series["duration"]:.6f}')
+        lines.extend([
+            f'# HELP {prefix}_queries_total Database queries run by django-saas operations.',
+            f'# TYPE {prefix}_queries_total counter',
+        ])
+        for (name, tags), series in snapshot:
+            lines.append(f'{prefix}_queries_total{prometheus_labels(name, tags)} {series["queries"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdBackend(MetricsBackend):
+    """
+    Sends every measurement to a statsd agent over UDP. Sending never blocks
+    nor fails when no agent is listening.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='saas'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def record(self, name, duration, queries, tags):
+        payload = '\n'.join(statsd_lines(name, duration, queries, tags, self.prefix))
+        try:
+            self._socket.sendto(payload.encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_labels(name, tags):
+    labels = [('operation', name)] + list(tags)
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels) + '}'
+
+
+def _statsd_name(value):
+    return re.sub(r'[^A-Za-z0-9_]', '_', str(value))
+
+
+def statsd_lines(name, duration, queries, tags, prefix='saas'):
+    parts = [prefix, _statsd_name(name)] + [_statsd_name(value) for _, value in sorted(tags.items())]
+    metric = '.'.join(parts)
+    return [
+        f'{metric}.count:1|c',
+        f'{metric}.duration:{duration * 1000:.3f}|ms',
+        f'{metric}.queries:{queries}|c',
+    ]
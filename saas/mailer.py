@@ -5,6 +5,7 @@ from django.template.loader import render_to_string
 from django.contrib.auth import get_user_model
 from django.http import HttpRequest
 
+from saas.instrumentation import instrumented
 from saas.models import BillingEvent
 
 User = get_user_model()
@@ -41,11 +42,12 @@ class AbstractSaasMailer(ABC):
         pass
 
 
-def send_multi_mail(subject_template_name, email_template_name,
-                    context, from_email, to_email, html_email_template_name=None,
-                    attachments=None, fail_silently=False):
+def build_multi_mail(subject_template_name, email_template_name,
+                     context, from_email, to_email, html_email_template_name=None,
+                     attachments=None, connection=None):
     """
-    Send a django.core.mail.EmailMultiAlternatives to `to_email`.
+    Return a django.core.mail.EmailMultiAlternatives to `to_email`, for
+    sending many messages over one `connection`.
     """
     subject = render_to_string(subject_template_name, context)
     # Email subject *must not* contain newlines
@@ -55,11 +57,24 @@ def send_multi_mail(subject_template_name, email_template_name,
     if not isinstance(to_email, list):
         to_email = [to_email]
     email_message = EmailMultiAlternatives(
-        subject, body, from_email, to_email)
+        subject, body, from_email, to_email, connection=connection)
     if html_email_template_name is not None:
         html_email = render_to_string(html_email_template_name, context)
         email_message.attach_alternative(html_email, 'text/html')
     if attachments is not None:
         for attachment in attachments:
             email_message.attach(attachment['name'], attachment['content'], attachment['type'])
-    email_message.send(fail_silently)
+    return email_message
+
+
+@instrumented('send_multi_mail')
+def send_multi_mail(subject_template_name, email_template_name,
+                    context, from_email, to_email, html_email_template_name=None,
+                    attachments=None, fail_silently=False):
+    """
+    Send a django.core.mail.EmailMultiAlternatives to `to_email`.
+    """
+    build_multi_mail(
+        subject_template_name, email_template_name, context, from_email, to_email,
+        html_email_template_name=html_email_template_name, attachments=attachments,
+    ).send(fail_silently)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from saas.gdpr import User, erase_user, get_user
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete a user and everything django-saas keeps about them, redacting their Stripe events. '
+        'Run it again if it was interrupted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='Id or email of the user.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user(options['user'])
+        except (ValueError, User.DoesNotExist):
+            raise CommandError(f'Unknown user {options["user"]}')
+        redacted = erase_user(user, batch_size=options['batch_size'])
+        self.stdout.write(f'User {options["user"]} erased, {redacted} Stripe events redacted')
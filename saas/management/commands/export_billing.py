@@ -0,0 +1,44 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from saas.exports import DEFAULT_CHUNK_SIZE, EXPORTS, FORMATS
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream the billing history (billing) or the Stripe event log (events) as CSV or JSON Lines. '
+        'For billing, --type is succeeded or failed; for events, a Stripe event type.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--start', help='ISO date or datetime, inclusive.')
+        parser.add_argument('--end', help='ISO date or datetime, exclusive.')
+        parser.add_argument('--user', help='User id or email.')
+        parser.add_argument('--type', action='append', dest='types', default=[])
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output', '-o', default='-', help='Output file, - for the standard output.')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            export = EXPORTS[options['dataset']](
+                start=options['start'],
+                end=options['end'],
+                user=options['user'],
+                types=options['types'],
+                chunk_size=options['chunk_size'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        output = options['output']
+        stream = sys.stdout.buffer if output == '-' else open(output, 'wb')
+        try:
+            for chunk in export.stream(options['format'], compress=options['gzip']):
+                stream.write(chunk)
+        finally:
+            if stream is sys.stdout.buffer:
+                stream.flush()
+            else:
+                stream.close()
@@ -0,0 +1,25 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from saas.gdpr import User, export_user, get_user
+
+
+class Command(BaseCommand):
+    help = 'Write a zip of everything django-saas keeps about a user.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='Id or email of the user.')
+        parser.add_argument('--output', default='-', help='Zip file to write, - for the standard output.')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user(options['user'])
+        except (ValueError, User.DoesNotExist):
+            raise CommandError(f'Unknown user {options["user"]}')
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in export_user(user):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
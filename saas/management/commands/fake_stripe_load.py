@@ -0,0 +1,100 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from saas.client import get_stripe
+from saas.fake_stripe import FakeStripe
+from saas.models import StripeInfo
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive registration, subscription, renewals and cancellation through the '
+        'fake Stripe backend (SAAS_STRIPE_BACKEND = "saas.fake_stripe.FakeStripe"), '
+        'delivering the resulting webhooks to StripeView.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--renewals', type=int, default=1)
+        parser.add_argument('--plan', default=None, help='Plan id, defaults to the first fake plan.')
+        parser.add_argument('--webhook-url', default=None,
+                            help='Path or http(s) URL of StripeView, defaults to SAAS_FAKE_STRIPE_WEBHOOK_URL.')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Webhook events per second, defaults to SAAS_FAKE_STRIPE_WEBHOOK_RATE.')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the users created by the run.')
+
+    def handle(self, *args, **options):
+        stripe = get_stripe()
+        # Tenant and instrumentation proxies may be stacked around the backend.
+        backend = stripe
+        while hasattr(backend, '_target'):
+            backend = backend._target
+        if not isinstance(backend, FakeStripe):
+            raise CommandError('SAAS_STRIPE_BACKEND must be set to saas.fake_stripe.FakeStripe')
+        webhook_url = options['webhook_url'] or getattr(settings, 'SAAS_FAKE_STRIPE_WEBHOOK_URL', None)
+        if webhook_url is None:
+            raise CommandError('Provide --webhook-url or set SAAS_FAKE_STRIPE_WEBHOOK_URL')
+        plan = options['plan'] or next(iter(backend.plans))
+        use_checkout = getattr(settings, 'SAAS_USE_CHECKOUT', False)
+        run = uuid.uuid4().hex[:8]
+        timings = {}
+
+        def deliver(step):
+            start = time.perf_counter()
+            statuses = backend.deliver_events(webhook_url, rate=options['rate'])
+            failed = [status for status in statuses if status != 200]
+            timings[step] = timings.get(step, 0) + time.perf_counter() - start
+            self.stdout.write(f'{step}: delivered {len(statuses)} events, {len(failed)} failed')
+
+        # Registration
+        start = time.perf_counter()
+        users = []
+        for i in range(options['users']):
+            email = f'load-{run}-{i}@example.com'
+            # No password, hashing would dwarf the time spent in django-saas.
+            user = User.objects.create_user(username=email, email=email, password=None)
+            if use_checkout:
+                # With checkout, customers are created by Stripe and linked by webhook.
+                stripe.Customer.create(email=email)
+            users.append(user)
+        timings['register'] = time.perf_counter() - start
+        deliver('register')
+
+        # Subscribe
+        start = time.perf_counter()
+        infos = StripeInfo.objects.filter(user__in=users)
+        for info in infos:
+            stripe.Customer.modify(info.customer_id, source='tok_visa')
+            stripe.Subscription.create(customer=info.customer_id, items=[{'plan': plan}])
+        timings['subscribe'] = time.perf_counter() - start
+        deliver('subscribe')
+
+        # Renewals
+        for renewal in range(options['renewals']):
+            backend.advance(max(
+                subscription['current_period_end'] for subscription in backend.subscriptions.values()
+            ) - backend.now() if backend.subscriptions else 0)
+            start = time.perf_counter()
+            backend.renew_subscriptions()
+            timings['renew'] = timings.get('renew', 0) + time.perf_counter() - start
+            deliver('renew')
+
+        # Cancel
+        start = time.perf_counter()
+        for info in StripeInfo.objects.filter(user__in=users).exclude(subscription_id=None):
+            stripe.Subscription.delete(info.subscription_id)
+        timings['cancel'] = time.perf_counter() - start
+        deliver('cancel')
+
+        cancelled = StripeInfo.objects.filter(user__in=users, subscription_id=None, previously_subscribed=True).count()
+        self.stdout.write(f'{cancelled}/{len(users)} users went through the whole subscription lifecycle')
+        for step, elapsed in timings.items():
+            self.stdout.write(f'{step}: {elapsed:.3f}s')
+
+        if options['cleanup']:
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
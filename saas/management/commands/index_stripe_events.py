@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from saas.gdpr import index_events
+
+
+class Command(BaseCommand):
+    help = 'Set the customer id of the Stripe events recorded before it was extracted when receiving them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        count = index_events(batch_size=options['batch_size'])
+        self.stdout.write(f'Indexed {count} Stripe events')
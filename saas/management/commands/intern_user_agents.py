@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from saas.useragents import backfill_user_agents
+
+
+class Command(BaseCommand):
+    help = 'Move the raw User-Agent of older Acquisition rows to the deduplicated UserAgent table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = backfill_user_agents(batch_size=options['batch_size'])
+        self.stdout.write(f'Interned the user agent of {count} acquisitions')
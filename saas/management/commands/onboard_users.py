@@ -0,0 +1,49 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from saas.onboarding import DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, onboard, read_records
+
+
+class Command(BaseCommand):
+    help = (
+        'Create users, their Stripe customers, StripeInfo and Acquisition in batches from a CSV '
+        '(with a header row) or JSON Lines file. Running it again with the same file resumes an '
+        'interrupted import.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, - for the standard input.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                            help='Defaults to the file extension, csv for the standard input.')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                            help='Concurrent Stripe customer creations.')
+        parser.add_argument('--inactive', action='store_true',
+                            help='Create the users inactive, as RegisterView does until activation.')
+        parser.add_argument('--no-customers', action='store_true',
+                            help='Do not create Stripe customers for records without customer_id.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format']
+        if format is None:
+            format = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+        if options['batch_size'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--batch-size and --concurrency must be positive')
+        kwargs = {
+            'batch_size': options['batch_size'],
+            'concurrency': options['concurrency'],
+            'active': not options['inactive'],
+        }
+        if options['no_customers']:
+            kwargs['create_customers'] = False
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            result = onboard(read_records(stream, format), **kwargs)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        for email, error in result.failed:
+            self.stderr.write(f'{email}: {error}')
+        self.stdout.write(str(result))
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from saas.purge import DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, DEFAULT_RATE, purge_unactivated
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete the users who never activated their account, with their StripeInfo, Acquisition and '
+        'Stripe customer. Safe to interrupt and to run on a schedule.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Minimum age of the accounts, SAAS_PURGE_AFTER_DAYS (30) by default.')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                            help='Concurrent Stripe customer deletions.')
+        parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                            help='Maximum Stripe calls per second.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['concurrency'] < 1 or options['rate'] <= 0:
+            raise CommandError('--batch-size, --concurrency and --rate must be positive')
+        report = purge_unactivated(
+            older_than=timedelta(days=options['days']) if options['days'] is not None else None,
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            dry_run=options['dry_run'],
+        )
+        for customer_id, error in report.failed:
+            self.stderr.write(f'{customer_id}: {error}')
+        self.stdout.write(str(report))
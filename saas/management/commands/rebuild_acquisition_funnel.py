@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from saas.analytics import rebuild_funnel
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily acquisition funnel (AcquisitionDaily) from the raw acquisition and billing data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        count = rebuild_funnel(chunk_size=options['chunk_size'])
+        self.stdout.write(f'Rebuilt {count} acquisition funnel rows')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from saas.revenue import rebuild_revenue
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily revenue metrics (RevenueDaily) from the subscription history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help='First open the periods of the subscribed users without history, from their CustomerSnapshot.')
+
+    def handle(self, *args, **options):
+        count = rebuild_revenue(chunk_size=options['chunk_size'], backfill=options['backfill'])
+        self.stdout.write(f'Rebuilt {count} revenue rows')
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime, parse_date
+from django.utils.module_loading import import_string
+from django.utils.timezone import is_naive, make_aware
+from datetime import datetime, time
+from saas.models import StripeEvent
+from saas.replay import replay_events
+
+
+def parse_when(value):
+    when = parse_datetime(value)
+    if when is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f'Invalid date or datetime: {value}')
+        when = datetime.combine(date, time.min)
+    return make_aware(when) if is_naive(when) else when
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-dispatch recorded StripeEvent rows through the webhook handler, without '
+        'signature checks. Events of a customer are handled in order, customers in parallel.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only replay events recorded at or after this date/datetime.')
+        parser.add_argument('--until', help='Only replay events recorded before this date/datetime.')
+        parser.add_argument('--type', action='append', dest='types', help='Event type to replay, may be repeated.')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--view', default='saas.views.StripeWebhook',
+                            help='Dotted path of the StripeWebhook subclass handling the events.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Roll every change back and report the resulting StripeInfo differences.')
+        parser.add_argument('--notify', action='store_true', help='Send the emails triggered by the events.')
+        parser.add_argument('--domain', default='localhost', help='Domain used in emails.')
+
+    def handle(self, *args, **options):
+        events = StripeEvent.objects.all()
+        if options['since']:
+            events = events.filter(created_at__gte=parse_when(options['since']))
+        if options['until']:
+            events = events.filter(created_at__lt=parse_when(options['until']))
+        if options['types']:
+            events = events.filter(event__in=options['types'])
+
+        result = replay_events(
+            events,
+            import_string(options['view']),
+            workers=options['workers'],
+            dry_run=options['dry_run'],
+            notify=options['notify'],
+            domain=options['domain'],
+        )
+
+        for event_type, count in sorted(result.by_type.items()):
+            self.stdout.write(f'{event_type}: {count}')
+        self.stdout.write(f'Replayed {result.processed} events, {len(result.failed)} failed')
+        for event_id, event_type, error in result.failed:
+            self.stderr.write(f'{event_id} ({event_type}): {error}')
+        if options['dry_run']:
+            for customer_id, (before, after) in sorted(result.diffs.items()):
+                self.stdout.write(f'{customer_id}:')
+                for field in sorted(set(before or {}) | set(after or {})):
+                    old = (before or {}).get(field)
+                    new = (after or {}).get(field)
+                    if old != new:
+                        self.stdout.write(f'  {field}: {old} -> {new}')
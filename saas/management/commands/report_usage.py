@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from saas.usage import report_usage
+
+
+class Command(BaseCommand):
+    help = 'Report the metered usage recorded with saas.usage.record_usage to Stripe.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        report = report_usage(batch_size=options['batch_size'])
+        for id, error in report.failed:
+            self.stderr.write(f'{id}: {error}')
+        self.stdout.write(str(report))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from saas.dunning import run_dunning
+
+
+class Command(BaseCommand):
+    help = 'Send the dunning reminders that are due and expire the grace periods that are over.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        report = run_dunning(batch_size=options['batch_size'])
+        self.stdout.write(str(report))
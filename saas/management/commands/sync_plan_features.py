@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from saas.entitlements import sync_plan_features
+from saas.tenants import tenant_config, tenants, use_tenant
+
+
+class Command(BaseCommand):
+    help = 'Store the features and limits of every Stripe plan from its product and plan metadata.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tenant', action='append',
+                            help='Stripe tenant to sync, the default account and every tenant by default')
+
+    def handle(self, *args, **options):
+        names = options['tenant']
+        if not names:
+            names = ([None] if tenant_config()['secret_key'] else []) + list(tenants())
+        for tenant in names:
+            with use_tenant(tenant):
+                count = sync_plan_features()
+            label = f' of tenant {tenant}' if tenant is not None else ''
+            self.stdout.write(f'Synced the entitlements of {count} plans{label}')
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0006_stripeevent_event_id_stripeevent_object_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stripeinfo',
+            name='customer_id',
+            field=models.CharField(db_index=True, max_length=256),
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['event', 'created_at'], name='saas_stripe_event_2f33d6_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:34
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+def create_empty_dimensions(apps, schema_editor):
+    Campaign = apps.get_model('saas', 'Campaign')
+    RefererDomain = apps.get_model('saas', 'RefererDomain')
+    Campaign.objects.get_or_create(id=uuid.UUID('00000000-0000-0000-0000-000000000001'), defaults={'name': ''})
+    RefererDomain.objects.get_or_create(id=uuid.UUID('00000000-0000-0000-0000-000000000002'), defaults={'domain': ''})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0007_stripeinfo_customer_id_stripeevent_event_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='RefererDomain',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('domain', models.CharField(max_length=255, unique=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='acquisition',
+            name='converted_at',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='acquisition',
+            name='normalized_campaign',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='saas.campaign'),
+        ),
+        migrations.AddField(
+            model_name='acquisition',
+            name='referer_domain',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='saas.refererdomain'),
+        ),
+        migrations.CreateModel(
+            name='AcquisitionDaily',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('day', models.DateField()),
+                ('currency', models.CharField(blank=True, default='', max_length=3)),
+                ('signups', models.PositiveIntegerField(default=0)),
+                ('trials', models.PositiveIntegerField(default=0)),
+                ('conversions', models.PositiveIntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+                ('normalized_campaign', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='saas.campaign')),
+                ('referer_domain', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='saas.refererdomain')),
+            ],
+            options={
+                'verbose_name_plural': 'Acquisition funnel',
+                'constraints': [models.UniqueConstraint(fields=('day', 'normalized_campaign', 'referer_domain', 'currency'), name='saas_acquisitiondaily_unique')],
+            },
+        ),
+        migrations.RunPython(create_empty_dimensions, migrations.RunPython.noop),
+    ]
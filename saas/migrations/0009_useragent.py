@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:36
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0008_acquisition_funnel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('agent', models.TextField()),
+                ('browser', models.CharField(db_index=True, max_length=64)),
+                ('os', models.CharField(db_index=True, max_length=64)),
+                ('device', models.CharField(db_index=True, max_length=16)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='acquisition',
+            name='user_agent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='saas.useragent'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:42
+
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0009_useragent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerSnapshot',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('customer_id', models.CharField(max_length=256, unique=True)),
+                ('customer_object', models.TextField(blank=True, default=None, null=True)),
+                ('subscription_object', models.TextField(blank=True, default=None, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Customer snapshots',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='billingevent',
+            index=models.Index(fields=['user', 'created_at'], name='saas_billin_user_id_3b8f80_idx'),
+        ),
+    ]
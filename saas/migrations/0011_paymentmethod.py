@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:44
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0010_customersnapshot_billingevent_user_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentMethod',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('customer_id', models.CharField(db_index=True, max_length=256)),
+                ('payment_method_id', models.CharField(max_length=256, unique=True)),
+                ('brand', models.CharField(blank=True, default='', max_length=32)),
+                ('last4', models.CharField(blank=True, default='', max_length=4)),
+                ('exp_month', models.PositiveSmallIntegerField(blank=True, default=None, null=True)),
+                ('exp_year', models.PositiveSmallIntegerField(blank=True, default=None, null=True)),
+                ('is_default', models.BooleanField(default=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:45
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0011_paymentmethod'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanEntitlement',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('plan_id', models.CharField(max_length=512, unique=True)),
+                ('features', models.TextField(default='[]')),
+                ('limits', models.TextField(default='{}')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:47
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0012_planentitlement'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageRecord',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('metric', models.CharField(max_length=255)),
+                ('period_start', models.DateTimeField()),
+                ('quantity', models.BigIntegerField(default=0)),
+                ('reported_quantity', models.BigIntegerField(default=0)),
+                ('needs_report', models.BooleanField(db_index=True, default=True)),
+                ('reported_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'metric', 'period_start'), name='saas_usagerecord_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:01
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0014_organization'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeinfo',
+            name='grace_until',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.CreateModel(
+            name='Dunning',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(choices=[('active', 'Active'), ('resolved', 'Resolved'), ('canceled', 'Canceled'), ('expired', 'Expired')], default='active', max_length=16)),
+                ('invoice_id', models.CharField(blank=True, default=None, max_length=256, null=True)),
+                ('hosted_invoice_url', models.TextField(blank=True, default=None, null=True)),
+                ('failed_at', models.DateTimeField()),
+                ('grace_until', models.DateTimeField(blank=True, default=None, null=True)),
+                ('step', models.PositiveSmallIntegerField(default=0)),
+                ('next_action_at', models.DateTimeField(blank=True, db_index=True, default=None, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Dunning',
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:08
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0016_stripeinfo_tenant'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevenueDaily',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('day', models.DateField()),
+                ('currency', models.CharField(blank=True, default='', max_length=3)),
+                ('mrr_change', models.BigIntegerField(default=0)),
+                ('new', models.IntegerField(default=0)),
+                ('churned', models.IntegerField(default=0)),
+                ('reactivated', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Revenue',
+                'constraints': [models.UniqueConstraint(fields=('day', 'currency'), name='saas_revenuedaily_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SubscriptionPeriod',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('subscription_id', models.CharField(db_index=True, max_length=512)),
+                ('plan_id', models.CharField(blank=True, default=None, max_length=512, null=True)),
+                ('currency', models.CharField(blank=True, default='', max_length=3)),
+                ('mrr', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'started_at'], name='saas_subscr_user_id_809f5d_idx')],
+            },
+        ),
+    ]
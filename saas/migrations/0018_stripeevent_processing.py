@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:12
+
+from django.db import migrations, models
+
+
+def mark_processed(apps, schema_editor):
+    # Events recorded until now were handled when received.
+    StripeEvent = apps.get_model('saas', 'StripeEvent')
+    StripeEvent.objects.using(schema_editor.connection.alias).update(processed_at=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0017_subscription_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeevent',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='stripe_created_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.RunPython(mark_processed, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['processed_at', 'created_at'], name='saas_stripe_process_d88054_idx'),
+        ),
+    ]
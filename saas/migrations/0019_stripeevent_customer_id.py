@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0018_stripeevent_processing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeevent',
+            name='customer_id',
+            field=models.CharField(blank=True, default=None, max_length=256, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['customer_id', 'created_at'], name='saas_stripe_custome_d523ab_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0019_stripeevent_customer_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='planentitlement',
+            name='tenant',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='planentitlement',
+            name='plan_id',
+            field=models.CharField(max_length=512),
+        ),
+        migrations.AddConstraint(
+            model_name='planentitlement',
+            constraint=models.UniqueConstraint(fields=('tenant', 'plan_id'), name='saas_planentitlement_unique'),
+        ),
+    ]
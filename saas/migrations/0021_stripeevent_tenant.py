@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0020_planentitlement_tenant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripeevent',
+            name='tenant',
+            field=models.CharField(blank=True, default=None, max_length=64, null=True),
+        ),
+    ]
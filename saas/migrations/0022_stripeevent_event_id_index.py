@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0021_stripeevent_tenant'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['event_id', 'processed_at'], name='saas_stripe_event_i_50d2e7_idx'),
+        ),
+    ]
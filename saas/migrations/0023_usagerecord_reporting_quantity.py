@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0022_stripeevent_event_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usagerecord',
+            name='reporting_quantity',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+    ]
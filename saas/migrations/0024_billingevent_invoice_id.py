@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:59
+
+from django.conf import settings
+import json
+
+from django.db import migrations, models
+
+
+def backfill_invoice_id(apps, schema_editor):
+    BillingEvent = apps.get_model('saas', 'BillingEvent')
+    billing_events = BillingEvent.objects.using(schema_editor.connection.alias)
+    batch = []
+    for billing in billing_events.filter(invoice_id=None).only('id', 'stripe_object').iterator(chunk_size=2000):
+        try:
+            billing.invoice_id = json.loads(billing.stripe_object)['id']
+        except (ValueError, KeyError, TypeError):
+            continue
+        batch.append(billing)
+        if len(batch) >= 2000:
+            billing_events.bulk_update(batch, ['invoice_id'])
+            batch = []
+    billing_events.bulk_update(batch, ['invoice_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('saas', '0023_usagerecord_reporting_quantity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingevent',
+            name='invoice_id',
+            field=models.CharField(blank=True, default=None, max_length=256, null=True),
+        ),
+        migrations.RunPython(backfill_invoice_id, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='billingevent',
+            index=models.Index(fields=['user', 'invoice_id', 'success'], name='saas_billin_user_id_ff87c7_idx'),
+        ),
+    ]
@@ -1,11 +1,15 @@
-import dateutil.tz as tz
+import functools
 import json
 import uuid
 
 from datetime import datetime
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth import get_user_model
 from django.utils.timezone import make_aware
+from saas.instrumentation import instrumented
+from saas.tenants import current_tenant
 
 User = get_user_model()
 
@@ -22,16 +26,98 @@ class BaseModel(models.Model):
     class Meta:
         abstract = True
 
+class Organization(BaseModel):
+    """
+    Team account whose subscription (the StripeInfo of its billing user)
+    covers all its members, `seats` being synced from the subscription
+    quantity.
+    """
+    name = models.CharField(max_length=255)
+    seats = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def create_for(cls, owner, name, seats=0):
+        """
+        Create an organization billed through the StripeInfo of `owner`, who
+        becomes its first member.
+        """
+        with transaction.atomic():
+            organization = cls.objects.create(name=name, seats=seats)
+            Membership.objects.create(organization=organization, user=owner, role=Membership.OWNER)
+            StripeInfo.objects.filter(user=owner).update(organization=organization)
+        return organization
+
+    @property
+    def available_seats(self):
+        return max(self.seats - self.memberships.count(), 0)
+
+    def add_member(self, user, role=None):
+        """
+        Add `user` as a member, raising SeatLimitExceeded when every seat is
+        taken. Members are checked against the seats under a row lock so that
+        concurrent invitations cannot exceed them.
+        """
+        with transaction.atomic():
+            organization = Organization.objects.select_for_update().get(pk=self.pk)
+            if organization.memberships.count() >= organization.seats:
+                raise SeatLimitExceeded(f'All the {organization.seats} seats of {organization} are taken')
+            return Membership.objects.create(organization=self, user=user, role=role or Membership.MEMBER)
+
+    @classmethod
+    def seats_of(cls, subscription):
+        if 'quantity' in subscription and subscription['quantity']:
+            return int(subscription['quantity'])
+        items = subscription['items']['data'] if 'items' in subscription and subscription['items'] else []
+        return sum(int(item['quantity']) for item in items if 'quantity' in item and item['quantity'])
+
+
+class SeatLimitExceeded(Exception):
+    pass
+
+
+class Membership(BaseModel):
+    OWNER = 'owner'
+    ADMIN = 'admin'
+    MEMBER = 'member'
+    ROLES = [
+        (OWNER, 'Owner'),
+        (ADMIN, 'Admin'),
+        (MEMBER, 'Member'),
+    ]
+
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
+    role = models.CharField(max_length=16, choices=ROLES, default=MEMBER)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'organization'], name='saas_membership_unique'),
+        ]
+
+
 class StripeInfo(BaseModel):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    customer_id = models.CharField(max_length=256)
+    # Set when this subscription is the one of an organization, user being its billing contact.
+    organization = models.OneToOneField(
+        Organization, on_delete=models.SET_NULL, blank=True, null=True, related_name='stripeinfo')
+    customer_id = models.CharField(max_length=256, db_index=True)
     subscription_id = models.CharField(max_length=512, blank=True, null=True)
     subscription_end = models.DateTimeField(blank=True, null=True)
     plan_id = models.CharField(max_length=512, blank=True, null=True, default=None)
     previously_subscribed = models.BooleanField(default=False)
+    # Access is kept until then after a failed payment, see saas.dunning.
+    grace_until = models.DateTimeField(blank=True, null=True, default=None)
+    # Stripe account of the customer, see saas.tenants.
+    tenant = models.CharField(max_length=64, blank=True, null=True, default=None)
 
     @classmethod
-    def sync_with_customer(cls, customer):
+    @instrumented('sync_with_customer')
+    def sync_with_customer(cls, customer, record_history=True):
+        # saas.revenue imports the models, `record_history` is off when replaying events.
+        from saas.revenue import record_subscription
         subscription = None
         # As of 2022 or so, Stripe doesn't send the subscription info with the stripe event anymore
         # so we should only update the subscription if we detect the object in the event message
@@ -43,7 +129,7 @@ class StripeInfo(BaseModel):
                 subscription = customer['subscriptions']['data'][0]
 
         try:
-            info = StripeInfo.objects.get(customer_id=customer['id'])
+            info = StripeInfo.objects.get(customer_id=customer['id'], tenant=current_tenant())
             if has_subscription:
                 # Update subscription info just in case!
                 info.previously_subscribed = info.previously_subscribed or info.subscription_id is not None
@@ -56,7 +142,12 @@ class StripeInfo(BaseModel):
                     info.subscription_end = None
                     info.plan_id = None
                 info.save()
+                if record_history:
+                    record_subscription(info.user_id, subscription)
         except StripeInfo.DoesNotExist:
+            if getattr(settings, 'SAAS_USE_CHECKOUT', False):
+                # Checkout customers are linked by checkout.session.completed, see sync_with_checkout_session.
+                return
             # No StripeInfo for this customer_id yet, lookup user by corresponding email.
             try:
                 user = User.objects.get(email=customer['email'])
@@ -76,37 +167,155 @@ class StripeInfo(BaseModel):
                             info.subscription_end = None
                             info.plan_id = None
                     info.save()
+                    if has_subscription and record_history:
+                        record_subscription(info.user_id, subscription)
                 except User.stripeinfo.RelatedObjectDoesNotExist:
                     # Brand new customer, create a StripeInfo with what we need
                     info = StripeInfo.objects.create(
                         user=user,
+                        tenant=current_tenant(),
                         customer_id=customer['id'],
                         subscription_id = subscription['id'] if subscription is not None else None,
                         subscription_end = make_aware(datetime.fromtimestamp(
                             int(subscription['current_period_end']))) if subscription is not None else None,
                         plan_id = subscription['plan']['id'] if subscription is not None else None,
                     )
+                    if subscription is not None and record_history:
+                        record_subscription(info.user_id, subscription)
             except User.DoesNotExist:
                 # Could not find a user with this email, this could happen in development mode
                 pass
 
 
+    @classmethod
+    @instrumented('sync_with_checkout_session')
+    def sync_with_checkout_session(cls, session, subscription=None):
+        """
+        Link the customer of a completed Checkout session to the user whose
+        primary key is its client_reference_id, or failing that (sessions not
+        created by CheckoutView) to the user with the same email. Returns the
+        StripeInfo, or None when no user matches.
+        """
+        customer_id = session['customer'] if 'customer' in session else None
+        if not customer_id:
+            return None
+        user = None
+        reference = session['client_reference_id'] if 'client_reference_id' in session else None
+        if reference:
+            try:
+                user = User.objects.filter(pk=reference).first()
+            except (ValueError, ValidationError):
+                user = None
+        if user is None:
+            details = session['customer_details'] if 'customer_details' in session else None
+            email = details['email'] if details and 'email' in details else None
+            email = email or (session['customer_email'] if 'customer_email' in session else None)
+            if not email:
+                return None
+            user = User.objects.filter(email=email).first()
+            if user is None:
+                return None
+
+        info = StripeInfo.objects.filter(user=user).first()
+        if info is None:
+            info = StripeInfo(user=user)
+        info.tenant = current_tenant()
+        info.customer_id = customer_id
+        if subscription is not None:
+            info.previously_subscribed = info.previously_subscribed or (
+                info.subscription_id is not None and info.subscription_id != subscription['id'])
+            info.subscription_id = subscription['id']
+            info.subscription_end = make_aware(datetime.fromtimestamp(int(subscription['current_period_end'])))
+            info.plan_id = subscription['plan']['id']
+        info.save()
+        return info
+
     class Meta:
         verbose_name_plural = "Customers"
 
 
+# Dimensions used when a signup has no campaign or no referer, created by migration 0008.
+NO_CAMPAIGN_ID = uuid.UUID('00000000-0000-0000-0000-000000000001')
+DIRECT_REFERER_ID = uuid.UUID('00000000-0000-0000-0000-000000000002')
+
+
+class Campaign(BaseModel):
+    name = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.name or '(none)'
+
+
+class RefererDomain(BaseModel):
+    domain = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.domain or '(direct)'
+
+
+class UserAgent(BaseModel):
+    """
+    Interned User-Agent header, keyed by its SHA-256 and parsed once.
+    """
+    hash = models.CharField(max_length=64, unique=True)
+    agent = models.TextField()
+    browser = models.CharField(max_length=64, db_index=True)
+    os = models.CharField(max_length=64, db_index=True)
+    device = models.CharField(max_length=16, db_index=True)
+
+    def __str__(self):
+        return f'{self.browser} / {self.os} / {self.device}'
+
+
 class Acquisition(BaseModel):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # Raw User-Agent of signups recorded before user_agent was introduced.
     agent = models.CharField(max_length=1024, default=None, blank=True, null=True)
+    user_agent = models.ForeignKey(UserAgent, on_delete=models.PROTECT, blank=True, null=True)
     referer = models.CharField(max_length=1024, default=None, blank=True, null=True)
     campaign = models.CharField(max_length=1024, default=None, blank=True, null=True)
     content = models.CharField(max_length=1024, default=None, blank=True, null=True)
+    referer_domain = models.ForeignKey(RefererDomain, on_delete=models.PROTECT, blank=True, null=True)
+    normalized_campaign = models.ForeignKey(Campaign, on_delete=models.PROTECT, blank=True, null=True)
+    converted_at = models.DateTimeField(blank=True, null=True, default=None, db_index=True)
+
+
+class AcquisitionDaily(BaseModel):
+    """
+    Daily acquisition funnel per campaign and referer domain, maintained
+    incrementally by saas.analytics. Revenue is in the currency's smallest
+    unit; signups and trials are counted on rows with an empty currency.
+    """
+    day = models.DateField()
+    normalized_campaign = models.ForeignKey(Campaign, on_delete=models.PROTECT)
+    referer_domain = models.ForeignKey(RefererDomain, on_delete=models.PROTECT)
+    currency = models.CharField(max_length=3, blank=True, default='')
+    signups = models.PositiveIntegerField(default=0)
+    trials = models.PositiveIntegerField(default=0)
+    conversions = models.PositiveIntegerField(default=0)
+    revenue = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Acquisition funnel"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'normalized_campaign', 'referer_domain', 'currency'],
+                name='saas_acquisitiondaily_unique',
+            ),
+        ]
+
+
+@functools.lru_cache(maxsize=None)
+def billing_timezone(name):
+    import dateutil.tz as tz
+    return tz.gettz(name)
 
 
 class BillingEvent(BaseModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     success = models.BooleanField(default=True)
     stripe_object = models.TextField()
+    invoice_id = models.CharField(max_length=256, blank=True, null=True, default=None)
 
     @property
     def stripe(self):
@@ -120,8 +329,8 @@ class BillingEvent(BaseModel):
 
     @property
     def date(self):
-        tzinfo = tz.gettz("America/Los_Angeles")
-        return datetime.fromtimestamp(int(self.stripe['created']), tzinfo)
+        return datetime.fromtimestamp(int(self.stripe['created']), billing_timezone(
+            getattr(settings, 'SAAS_BILLING_TIMEZONE', 'America/Los_Angeles')))
 
     @property
     def description(self):
@@ -139,9 +348,278 @@ class BillingEvent(BaseModel):
     def amount_paid(self):
         return self.stripe['amount_paid']
 
+    @classmethod
+    def record(cls, user, invoice, success=True):
+        """
+        Create the BillingEvent of `invoice`, unless this payment attempt was
+        already recorded (redelivered or replayed event).
+        Returns `(billing, created)`.
+        """
+        attempt = invoice['attempt_count'] if 'attempt_count' in invoice else None
+        for billing in cls.objects.filter(user=user, invoice_id=invoice['id'], success=success):
+            if billing.stripe.get('attempt_count') == attempt:
+                return billing, False
+        return cls.objects.create(
+            user=user, success=success, stripe_object=stripe_json(invoice), invoice_id=invoice['id']), True
+
 
     class Meta:
         verbose_name_plural = "Bills"
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['user', 'invoice_id', 'success']),
+        ]
+
+
+def stripe_json(stripe_object):
+    # stripe objects serialize to JSON through str(), plain dicts do not.
+    if isinstance(stripe_object, dict):
+        return json.dumps(stripe_object)
+    return str(stripe_object)
+
+
+def stripe_customer_id(event_type, stripe_object):
+    """
+    Id of the Stripe customer an event is about, or None.
+    """
+    if event_type.startswith('customer.') and 'object' in stripe_object and stripe_object['object'] == 'customer':
+        return stripe_object['id'] if 'id' in stripe_object else None
+    customer = stripe_object['customer'] if 'customer' in stripe_object else None
+    if isinstance(customer, dict):
+        return customer['id'] if 'id' in customer else None
+    return customer
+
+
+class CustomerSnapshot(BaseModel):
+    """
+    Last known state of a Stripe customer and of its subscription, refreshed
+    by the customer.* webhooks so that pages do not call Stripe on every render.
+    """
+    customer_id = models.CharField(max_length=256, unique=True)
+    customer_object = models.TextField(blank=True, null=True, default=None)
+    subscription_object = models.TextField(blank=True, null=True, default=None)
+
+    @property
+    def customer(self):
+        return json.loads(self.customer_object) if self.customer_object else None
+
+    @property
+    def subscription(self):
+        return json.loads(self.subscription_object) if self.subscription_object else None
+
+    @classmethod
+    def store(cls, customer_id, **values):
+        if cls.objects.filter(customer_id=customer_id).update(**values):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(customer_id=customer_id, **values)
+        except IntegrityError:
+            cls.objects.filter(customer_id=customer_id).update(**values)
+
+    @classmethod
+    def sync_with_customer(cls, customer):
+        values = {'customer_object': stripe_json(customer)}
+        # Subscriptions are only part of the customer when expanded.
+        if 'subscriptions' in customer:
+            subscriptions = customer['subscriptions']['data']
+            values['subscription_object'] = stripe_json(subscriptions[0]) if len(subscriptions) > 0 else None
+        cls.store(customer['id'], **values)
+
+    @classmethod
+    def sync_with_subscription(cls, subscription, deleted=False):
+        if 'customer' not in subscription or not subscription['customer']:
+            return
+        cls.store(
+            subscription['customer'],
+            subscription_object=None if deleted else stripe_json(subscription),
+        )
+
+    class Meta:
+        verbose_name_plural = "Customer snapshots"
+
+
+class PaymentMethod(BaseModel):
+    """
+    Compact snapshot of the cards of a Stripe customer, either payment methods
+    or legacy sources, kept up to date by StripeWebhook.
+    """
+    customer_id = models.CharField(max_length=256, db_index=True)
+    payment_method_id = models.CharField(max_length=256, unique=True)
+    brand = models.CharField(max_length=32, blank=True, default='')
+    last4 = models.CharField(max_length=4, blank=True, default='')
+    exp_month = models.PositiveSmallIntegerField(blank=True, null=True, default=None)
+    exp_year = models.PositiveSmallIntegerField(blank=True, null=True, default=None)
+    is_default = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f'{self.brand} •••• {self.last4}'
+
+    @classmethod
+    def default_for(cls, customer_id):
+        return cls.objects.filter(customer_id=customer_id).order_by('-is_default', '-created_at').first()
+
+    @classmethod
+    def sync_with_payment_method(cls, payment_method):
+        """
+        Store a `payment_method`, `card` or `source` object, or forget it when
+        it is no longer attached to a customer.
+        """
+        customer_id = payment_method['customer'] if 'customer' in payment_method else None
+        if not customer_id:
+            cls.objects.filter(payment_method_id=payment_method['id']).delete()
+            return
+        # Payment methods and card sources nest the card details, cards do not.
+        card = payment_method['card'] if 'card' in payment_method and payment_method['card'] else payment_method
+        values = {
+            'customer_id': customer_id,
+            'brand': (card['brand'] if 'brand' in card else '') or '',
+            'last4': (card['last4'] if 'last4' in card else '') or '',
+            'exp_month': card['exp_month'] if 'exp_month' in card else None,
+            'exp_year': card['exp_year'] if 'exp_year' in card else None,
+        }
+        if cls.objects.filter(payment_method_id=payment_method['id']).update(**values):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(payment_method_id=payment_method['id'], **values)
+        except IntegrityError:
+            cls.objects.filter(payment_method_id=payment_method['id']).update(**values)
+
+    @classmethod
+    def sync_with_customer(cls, customer):
+        """
+        Store the sources included in a customer object and flag its default
+        payment method (or default source).
+        """
+        if 'sources' in customer and customer['sources']:
+            for source in customer['sources']['data']:
+                cls.sync_with_payment_method(source)
+        default = None
+        if 'invoice_settings' in customer and customer['invoice_settings']:
+            invoice_settings = customer['invoice_settings']
+            if 'default_payment_method' in invoice_settings:
+                default = invoice_settings['default_payment_method']
+        if not default and 'default_source' in customer:
+            default = customer['default_source']
+        if default and not isinstance(default, str):
+            default = default['id']
+        cls.objects.filter(customer_id=customer['id']).update(is_default=models.Case(
+            models.When(payment_method_id=default or '', then=models.Value(True)),
+            default=models.Value(False),
+        ))
+
+
+class PlanEntitlement(BaseModel):
+    """
+    Features and limits of a plan synced from Stripe product metadata, see
+    saas.entitlements.
+    """
+    plan_id = models.CharField(max_length=512)
+    features = models.TextField(default='[]')
+    limits = models.TextField(default='{}')
+    # Stripe account of the plan, '' for the default one, see saas.tenants.
+    tenant = models.CharField(max_length=64, blank=True, default='')
+
+    def __str__(self):
+        return self.plan_id
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tenant', 'plan_id'], name='saas_planentitlement_unique'),
+        ]
+
+
+class UsageRecord(BaseModel):
+    """
+    Usage of a metered metric by a user over a period, accumulated by
+    saas.usage and reported to Stripe incrementally.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    metric = models.CharField(max_length=255)
+    period_start = models.DateTimeField()
+    quantity = models.BigIntegerField(default=0)
+    reported_quantity = models.BigIntegerField(default=0)
+    # Quantity being reported, kept until Stripe accepted it so that a retry sends the same usage.
+    reporting_quantity = models.BigIntegerField(blank=True, null=True, default=None)
+    needs_report = models.BooleanField(default=True, db_index=True)
+    reported_at = models.DateTimeField(blank=True, null=True, default=None)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'metric', 'period_start'], name='saas_usagerecord_unique'),
+        ]
+
+
+class Dunning(BaseModel):
+    """
+    Follow-up of the failed payments of a user, see saas.dunning. Rows are
+    due when `next_action_at` is passed, which is None once closed.
+    """
+    ACTIVE = 'active'
+    RESOLVED = 'resolved'
+    CANCELED = 'canceled'
+    EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (ACTIVE, 'Active'),
+        (RESOLVED, 'Resolved'),
+        (CANCELED, 'Canceled'),
+        (EXPIRED, 'Expired'),
+    ]
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=ACTIVE)
+    invoice_id = models.CharField(max_length=256, blank=True, null=True, default=None)
+    hosted_invoice_url = models.TextField(blank=True, null=True, default=None)
+    failed_at = models.DateTimeField()
+    grace_until = models.DateTimeField(blank=True, null=True, default=None)
+    # Number of reminders sent.
+    step = models.PositiveSmallIntegerField(default=0)
+    next_action_at = models.DateTimeField(blank=True, null=True, default=None, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "Dunning"
+
+
+class SubscriptionPeriod(BaseModel):
+    """
+    Interval during which a subscription was paid for on a plan, recorded by
+    saas.revenue. A new period starts whenever the plan or the MRR changes;
+    periods are only ever closed, never rewritten.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    subscription_id = models.CharField(max_length=512, db_index=True)
+    plan_id = models.CharField(max_length=512, blank=True, null=True, default=None)
+    currency = models.CharField(max_length=3, blank=True, default='')
+    # Monthly recurring revenue in the currency's smallest unit.
+    mrr = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField(blank=True, null=True, default=None)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'started_at']),
+        ]
+
+
+class RevenueDaily(BaseModel):
+    """
+    Daily revenue metrics per currency, maintained incrementally by
+    saas.revenue: the MRR added that day (negative when lost) and the number
+    of new, churned and reactivated subscribers.
+    """
+    day = models.DateField()
+    currency = models.CharField(max_length=3, blank=True, default='')
+    mrr_change = models.BigIntegerField(default=0)
+    new = models.IntegerField(default=0)
+    churned = models.IntegerField(default=0)
+    reactivated = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Revenue"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'currency'], name='saas_revenuedaily_unique'),
+        ]
 
 
 class StripeEvent(BaseModel):
@@ -149,7 +627,21 @@ class StripeEvent(BaseModel):
     object = models.TextField()
     event_id = models.CharField(max_length=256, null=True, blank=True, default=None)
     object_id = models.CharField(max_length=256, null=True, blank=True, default=None)
+    # When Stripe created the event, and when its handling finished (null meanwhile), see saas.health.
+    stripe_created_at = models.DateTimeField(null=True, blank=True, default=None)
+    processed_at = models.DateTimeField(null=True, blank=True, default=None)
+    failed = models.BooleanField(default=False)
+    # Extracted when recorded, '' for events without a customer and null until indexed, see saas.gdpr.
+    customer_id = models.CharField(max_length=256, null=True, blank=True, default=None)
+    # Stripe account the event was received from, see saas.tenants.
+    tenant = models.CharField(max_length=64, blank=True, null=True, default=None)
 
     class Meta:
         verbose_name_plural = "Events"
+        indexes = [
+            models.Index(fields=['event', 'created_at']),
+            models.Index(fields=['processed_at', 'created_at']),
+            models.Index(fields=['customer_id', 'created_at']),
+            models.Index(fields=['event_id', 'processed_at']),
+        ]
 
@@ -0,0 +1,288 @@
+"""
+Bulk onboarding of users from a CSV or JSON Lines stream.
+
+Records are processed in batches: users, StripeInfo and Acquisition rows are
+inserted with `bulk_create` (so `on_new_user` is not fired for every row) and
+Stripe customers are created concurrently by a bounded thread pool. Every
+customer is created with an idempotency key derived from the user and their
+email, and tagged with the user id in its metadata. Rows that already exist
+are skipped, and the customers of users created by an earlier run are looked
+up on Stripe before creating one, so an interrupted import resumes where it
+stopped when it is run again with the same input, even after the idempotency
+keys expired.
+
+Recognized fields are `email` (required), `username`, `first_name`,
+`last_name`, `customer_id` (an existing Stripe customer), `referer`,
+`campaign`, `content` and `user_agent`. Users are created without a usable
+password. Rows whose username is already taken are reported as failed
+without failing the rest of their batch.
+"""
+import csv
+import hashlib
+import json
+import logging
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from saas.analytics import campaign_id_for, increment, referer_domain_id_for, trials_at_signup
+from saas.client import get_stripe
+from saas.models import Acquisition, StripeInfo
+from saas.tenants import current_tenant, use_tenant
+from saas.useragents import intern_user_agent
+
+User = get_user_model()
+
+logger = logging.getLogger("saas")
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_CONCURRENCY = 8
+# Metadata key of the user id of the customers created by onboarding.
+USER_ID_METADATA = 'saas_user_id'
+
+
+def read_records(stream, format='csv'):
+    """
+    Yield a dict per record of a text stream in the `csv` (with a header
+    row) or `jsonl` format.
+    """
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+    elif format == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        raise ValueError(f'Unsupported format {format}')
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def idempotency_key(user_id, email):
+    return 'saas-onboarding-' + hashlib.sha256(f'{user_id}:{email}'.encode('utf-8')).hexdigest()[:32]
+
+
+class OnboardingResult:
+    def __init__(self):
+        self.users_created = 0
+        self.users_existing = 0
+        self.customers_created = 0
+        self.acquisitions_created = 0
+        self.failed = []
+
+    def __str__(self):
+        return (
+            f'{self.users_created} users created, {self.users_existing} already existed, '
+            f'{self.customers_created} Stripe customers created, '
+            f'{self.acquisitions_created} acquisitions recorded, {len(self.failed)} failed'
+        )
+
+
+class Onboarding:
+    """
+    Bulk onboarding service, see `onboard`.
+    """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY, active=True,
+                 create_customers=None):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.active = active
+        if create_customers is None:
+            # Same rule as on_new_user: with checkout, Stripe creates the customers.
+            create_customers = not getattr(settings, 'SAAS_USE_CHECKOUT', False)
+        self.create_customers = create_customers
+        # Worker threads do not inherit the tenant of the caller.
+        self.tenant = current_tenant()
+        self.result = OnboardingResult()
+        self._dimensions = {}
+
+    def run(self, records):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for batch in _batches(records, self.batch_size):
+                self.onboard_batch(batch, pool)
+                logger.info(f'Onboarding: {self.result}')
+        return self.result
+
+    def clean(self, batch):
+        records = {}
+        for record in batch:
+            email = (record.get('email') or '').strip()
+            try:
+                validate_email(email)
+            except ValidationError:
+                self.result.failed.append((email, 'Invalid email'))
+                continue
+            records.setdefault(email, record)
+        return records
+
+    def onboard_batch(self, batch, pool):
+        records = self.clean(batch)
+        if not records:
+            return
+        users = {user.email: user for user in User.objects.filter(email__in=records.keys())}
+        existing = set(users)
+        self.result.users_existing += len(users)
+        new_users = [
+            User(
+                username=record.get('username') or email,
+                email=email,
+                first_name=record.get('first_name') or '',
+                last_name=record.get('last_name') or '',
+                is_active=self.active,
+                password=make_password(None),
+            )
+            for email, record in records.items()
+            if email not in users
+        ]
+        new_users = self.without_taken_usernames(new_users)
+        if new_users:
+            self.result.users_created += self.create_users(new_users)
+            # Primary keys are not returned by bulk_create on every backend.
+            users = {user.email: user for user in User.objects.filter(email__in=records.keys())}
+
+        user_ids = [user.pk for user in users.values()]
+        with_info = set(StripeInfo.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+        with_acquisition = set(Acquisition.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+
+        customers = {}
+        pending = []
+        for email, user in users.items():
+            if user.pk in with_info:
+                continue
+            if records[email].get('customer_id'):
+                customers[email] = records[email]['customer_id']
+            elif self.create_customers:
+                pending.append(email)
+        created = pool.map(
+            self.create_customer, [users[email] for email in pending], [email in existing for email in pending])
+        for email, customer_id in zip(pending, created):
+            if customer_id is not None:
+                customers[email] = customer_id
+                self.result.customers_created += 1
+
+        acquisitions = [
+            self.acquisition(user, records[email])
+            for email, user in users.items()
+            if user.pk not in with_acquisition
+        ]
+        with transaction.atomic():
+            StripeInfo.objects.bulk_create([
+                StripeInfo(user=users[email], customer_id=customer_id, tenant=self.tenant)
+                for email, customer_id in customers.items()
+            ], batch_size=self.batch_size)
+            Acquisition.objects.bulk_create(acquisitions, batch_size=self.batch_size)
+            self.record_signups(acquisitions)
+        self.result.acquisitions_created += len(acquisitions)
+
+    def without_taken_usernames(self, new_users):
+        taken = set(
+            User.objects.filter(username__in=[user.username for user in new_users]).values_list('username', flat=True))
+        available = []
+        for user in new_users:
+            if user.username in taken:
+                self.result.failed.append((user.email, f'Username {user.username} already taken'))
+                continue
+            taken.add(user.username)
+            available.append(user)
+        return available
+
+    def create_users(self, new_users):
+        """
+        Insert `new_users` and return the number created. When the batch
+        fails (e.g. a username taken meanwhile), users are inserted one by
+        one and the failing rows are reported.
+        """
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(new_users, batch_size=self.batch_size)
+            return len(new_users)
+        except IntegrityError:
+            logger.info('Onboarding: batch insert failed, inserting users one by one')
+        created = 0
+        for user in new_users:
+            user.pk = None
+            try:
+                # bulk_create rather than save(), so that on_new_user is not fired.
+                with transaction.atomic():
+                    User.objects.bulk_create([user])
+                created += 1
+            except IntegrityError as e:
+                self.result.failed.append((user.email, repr(e)))
+        return created
+
+    def create_customer(self, user, existing=False):
+        try:
+            with use_tenant(self.tenant):
+                stripe = get_stripe()
+                # The customer of a user created by an earlier run may already exist.
+                customer = self.find_customer(stripe, user) if existing else None
+                if customer is None:
+                    customer = stripe.Customer.create(
+                        email=user.email,
+                        metadata={USER_ID_METADATA: str(user.pk)},
+                        idempotency_key=idempotency_key(user.pk, user.email),
+                    )
+            return customer['id']
+        except Exception as e:
+            logger.exception(f'Could not create the Stripe customer of {user.email}')
+            self.result.failed.append((user.email, repr(e)))
+            return None
+
+    def find_customer(self, stripe, user):
+        for customer in stripe.Customer.list(email=user.email, limit=100)['data']:
+            metadata = customer['metadata'] if 'metadata' in customer and customer['metadata'] else {}
+            if USER_ID_METADATA in metadata and metadata[USER_ID_METADATA] == str(user.pk):
+                return customer
+        return None
+
+    def dimension(self, lookup, value):
+        # Imports share a handful of campaigns, referers and user agents.
+        key = (lookup, value)
+        if key not in self._dimensions:
+            self._dimensions[key] = lookup(value)
+        return self._dimensions[key]
+
+    def acquisition(self, user, record):
+        user_agent = self.dimension(intern_user_agent, record.get('user_agent') or None)
+        return Acquisition(
+            user=user,
+            user_agent_id=user_agent.id if user_agent is not None else None,
+            referer=record.get('referer') or None,
+            campaign=record.get('campaign') or None,
+            content=record.get('content') or None,
+            normalized_campaign_id=self.dimension(campaign_id_for, record.get('campaign') or None),
+            referer_domain_id=self.dimension(referer_domain_id_for, record.get('referer') or None),
+        )
+
+    def record_signups(self, acquisitions):
+        enable_trial = trials_at_signup()
+        counts = defaultdict(int)
+        for acquisition in acquisitions:
+            counts[(acquisition.normalized_campaign_id, acquisition.referer_domain_id)] += 1
+        day = timezone.localdate()
+        for (campaign_id, referer_domain_id), count in counts.items():
+            increment(day, campaign_id, referer_domain_id, signups=count, trials=count if enable_trial else 0)
+
+
+def onboard(records, **options):
+    """
+    Onboard the users described by the `records` dicts, see Onboarding for
+    the options, and return an OnboardingResult.
+    """
+    return Onboarding(**options).run(records)
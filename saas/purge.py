@@ -0,0 +1,164 @@
+"""
+Purge of the accounts that were never activated.
+
+RegisterView creates inactive users and, outside of checkout mode, a Stripe
+customer for each of them. `purge_unactivated()` (see the `purge_users`
+command) deletes the users that never logged in and are still inactive
+SAAS_PURGE_AFTER_DAYS (30 by default) after signing up, along with their
+StripeInfo, Acquisition and Stripe customer. Staff and users who ever
+subscribed are always kept.
+
+Users are walked in primary key order, one bounded batch at a time. Stripe
+customers of a batch are deleted concurrently by a thread pool, at most
+`rate` calls per second, before the users themselves; a user whose customer
+could not be deleted is kept and retried on the next run. Deleting is
+idempotent (customers already deleted on Stripe count as deleted), so an
+interrupted or overlapping run is safe and the command can run on a schedule.
+"""
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils import timezone
+from saas.client import get_stripe
+from saas.models import StripeInfo
+from saas.tenants import use_tenant
+
+User = get_user_model()
+
+logger = logging.getLogger("saas")
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_CONCURRENCY = 4
+# Stripe allows 100 requests per second in live mode and 25 in test mode.
+DEFAULT_RATE = 20
+
+
+class Throttle:
+    """
+    Space the calls of `wait()` by 1 / `rate` seconds across threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class PurgeReport:
+    def __init__(self):
+        self.users_deleted = 0
+        self.customers_deleted = 0
+        self.failed = []
+
+    def __str__(self):
+        return (
+            f'{self.users_deleted} users deleted, {self.customers_deleted} Stripe customers deleted, '
+            f'{len(self.failed)} failed'
+        )
+
+
+def purge_after():
+    return timedelta(days=getattr(settings, 'SAAS_PURGE_AFTER_DAYS', 30))
+
+
+def unactivated_users(older_than=None, now=None):
+    """
+    Return the users eligible for the purge.
+    """
+    now = timezone.now() if now is None else now
+    older_than = purge_after() if older_than is None else older_than
+    subscribed = StripeInfo.objects.filter(
+        Q(previously_subscribed=True) | Q(subscription_id__isnull=False)).values('user_id')
+    return User.objects.filter(
+        is_active=False,
+        is_staff=False,
+        is_superuser=False,
+        last_login=None,
+        date_joined__lt=now - older_than,
+    ).exclude(pk__in=subscribed)
+
+
+def _is_missing(e):
+    return getattr(e, 'code', None) == 'resource_missing'
+
+
+class Purge:
+    """
+    Purge service, see `purge_unactivated`.
+    """
+    def __init__(self, older_than=None, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 rate=DEFAULT_RATE, dry_run=False, now=None):
+        self.users = unactivated_users(older_than, now)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.throttle = Throttle(rate)
+        self.dry_run = dry_run
+        self.report = PurgeReport()
+
+    def run(self):
+        last_pk = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                batch = self.users.order_by('pk')
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                user_ids = list(batch.values_list('pk', flat=True)[:self.batch_size])
+                if not user_ids:
+                    return self.report
+                # Users kept (failed customer deletion) are not selected again by this run.
+                last_pk = user_ids[-1]
+                self.purge_batch(user_ids, pool)
+                logger.info(f'Purge: {self.report}')
+
+    def purge_batch(self, user_ids, pool):
+        customers = list(StripeInfo.objects.filter(user_id__in=user_ids).values_list('user_id', 'customer_id', 'tenant'))
+        if self.dry_run:
+            self.report.users_deleted += len(user_ids)
+            self.report.customers_deleted += len(customers)
+            return
+        kept = set()
+        for (user_id, _, _), deleted in zip(customers, pool.map(self.delete_customer, customers)):
+            if deleted:
+                self.report.customers_deleted += 1
+            else:
+                kept.add(user_id)
+        # Checked again in case a user activated the account meanwhile.
+        deleted, by_model = self.users.filter(pk__in=[pk for pk in user_ids if pk not in kept]).delete()
+        self.report.users_deleted += by_model.get(User._meta.label, 0)
+
+    def delete_customer(self, row):
+        user_id, customer_id, tenant = row
+        if not customer_id:
+            return True
+        self.throttle.wait()
+        try:
+            with use_tenant(tenant):
+                get_stripe().Customer.delete(customer_id)
+            return True
+        except Exception as e:
+            if _is_missing(e):
+                return True
+            logger.exception(f'Could not delete the Stripe customer {customer_id} of user {user_id}')
+            self.report.failed.append((customer_id, repr(e)))
+            return False
+
+
+def purge_unactivated(**options):
+    """
+    Delete the unactivated users and their Stripe customers, see Purge for
+    the options, and return a PurgeReport.
+    """
+    return Purge(**options).run()
@@ -0,0 +1,100 @@
+"""
+Sliding window rate limiting backed by the Django cache.
+
+Each limit counts hits in fixed windows with atomic cache increments and
+weighs the previous window by how much of it still overlaps the sliding
+window, which needs two cache keys per client and no list of timestamps.
+
+Limits are `(hits, seconds)` per key, configured per action:
+
+    SAAS_RATE_LIMITS = {
+        'register': {'ip': (10, 3600), 'email_domain': (50, 3600)},
+        'activate': {'ip': (30, 3600)},
+    }
+
+A limit set to None is disabled. The client IP is REMOTE_ADDR unless
+SAAS_RATE_LIMIT_IP_HEADER names a header set by a trusted proxy, e.g.
+'HTTP_X_FORWARDED_FOR'. Clients can send that header themselves, so the
+address used is the one appended by the outermost of the
+SAAS_RATE_LIMIT_TRUSTED_PROXIES proxies (1 by default), counting from the
+right.
+"""
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger("saas")
+
+DEFAULT_RATE_LIMITS = {
+    'register': {'ip': (10, 3600), 'email_domain': None},
+    'activate': {'ip': (30, 3600)},
+}
+
+
+def rate_limits(action):
+    limits = dict(DEFAULT_RATE_LIMITS.get(action, {}))
+    limits.update(getattr(settings, 'SAAS_RATE_LIMITS', {}).get(action, {}))
+    return limits
+
+
+def _incr(key, timeout):
+    if cache.add(key, 1, timeout):
+        return 1
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Expired between add and incr
+        cache.add(key, 1, timeout)
+        return 1
+
+
+def hit(name, value, limit, window, now=None):
+    """
+    Count a hit for `value` and return whether it is within `limit` hits
+    over the last `window` seconds.
+    """
+    now = time.time() if now is None else now
+    digest = hashlib.sha1(str(value).encode('utf-8')).hexdigest()
+    current_window = int(now // window)
+    current = _incr(f'saas:ratelimit:{name}:{digest}:{current_window}', window * 2)
+    previous = cache.get(f'saas:ratelimit:{name}:{digest}:{current_window - 1}', 0)
+    overlap = (window - now % window) / window
+    return previous * overlap + current <= limit
+
+
+def client_ip(request):
+    header = getattr(settings, 'SAAS_RATE_LIMIT_IP_HEADER', None)
+    if header and request.META.get(header):
+        addresses = [address.strip() for address in request.META[header].split(',')]
+        proxies = max(getattr(settings, 'SAAS_RATE_LIMIT_TRUSTED_PROXIES', 1), 1)
+        return addresses[-min(proxies, len(addresses))]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def email_domain(email):
+    if not email or '@' not in email:
+        return None
+    return email.rsplit('@', 1)[1].strip().lower()
+
+
+def check_rate_limits(action, request, email=None):
+    """
+    Count the request against the limits of `action` and return False when
+    one of them is exceeded.
+    """
+    values = {
+        'ip': client_ip(request),
+        'email_domain': email_domain(email),
+    }
+    allowed = True
+    for key, limit in rate_limits(action).items():
+        if limit is None or values.get(key) is None:
+            continue
+        hits, window = limit
+        if not hit(f'{action}:{key}', values[key], hits, window):
+            logger.warning(f"Rate limit {action} exceeded for {key} {values[key]}")
+            allowed = False
+    return allowed
@@ -0,0 +1,119 @@
+"""
+Receipts of BillingEvent, as HTML and PDF.
+
+A receipt is rendered on first use (the payment succeeded email or the first
+download) and kept in the storage named by SAAS_RECEIPT_STORAGE (an alias of
+STORAGES, 'default' by default; before Django 4.2, where there is no
+STORAGES, the default storage or the dotted path of a storage class), so it
+is rendered once per BillingEvent.
+The HTML receipt renders SAAS_RECEIPT_TEMPLATE ('saas/receipt.html' by
+default) and the PDF receipt is written directly, without any dependency.
+"""
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template.loader import render_to_string
+from saas.instrumentation import timed
+from saas.templatetags.saas import stripe_amount
+
+try:
+    from django.core.files.storage import storages
+except ImportError:
+    # Django < 4.2
+    from django.core.files.storage import get_storage_class
+    storages = None
+
+CONTENT_TYPES = {
+    'html': 'text/html; charset=utf-8',
+    'pdf': 'application/pdf',
+}
+
+
+def receipt_storage():
+    name = getattr(settings, 'SAAS_RECEIPT_STORAGE', 'default')
+    if storages is not None:
+        return storages[name]
+    return default_storage if name == 'default' else get_storage_class(name)()
+
+
+def receipt_name(billing, format):
+    return f'receipts/{billing.user_id}/{billing.id}.{format}'
+
+
+def receipt_filename(billing, format):
+    return f'receipt-{billing.invoice}.{format}'
+
+
+def receipt_lines(billing):
+    invoice = billing.stripe
+    amount = billing.amount_paid if billing.success else billing.amount_due
+    return [
+        f"Invoice {invoice.get('number') or billing.invoice}",
+        f"Date: {billing.date:%B %d, %Y}",
+        f"Billed to: {billing.user.email}",
+        billing.description or '',
+        f"{'Amount paid' if billing.success else 'Amount due'}: {stripe_amount(amount, billing.currency)}",
+    ]
+
+
+def _pdf_text(text):
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return text.encode('latin-1', 'replace')
+
+
+def render_pdf(title, lines):
+    """
+    Return a one page A4 PDF of `title` followed by `lines`, in Helvetica.
+    """
+    stream = b'BT /F1 18 Tf 56 770 Td (' + _pdf_text(title) + b') Tj /F1 11 Tf 0 -32 Td'
+    for line in lines:
+        stream += b' (' + _pdf_text(line) + b') Tj 0 -16 Td'
+    stream += b' ET'
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+        b'/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream',
+    ]
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+
+def render_receipt(billing, format):
+    with timed('render_receipt', format=format):
+        if format == 'html':
+            template_name = getattr(settings, 'SAAS_RECEIPT_TEMPLATE', 'saas/receipt.html')
+            return render_to_string(template_name, {'billing': billing}).encode('utf-8')
+        return render_pdf('Receipt', receipt_lines(billing))
+
+
+def receipt(billing, format='pdf'):
+    """
+    Return the receipt of `billing` as bytes, rendering and storing it when
+    it does not exist yet.
+    """
+    if format not in CONTENT_TYPES:
+        raise ValueError(f'Unknown receipt format {format}')
+    storage = receipt_storage()
+    name = receipt_name(billing, format)
+    try:
+        with storage.open(name) as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    content = render_receipt(billing, format)
+    saved = storage.save(name, ContentFile(content))
+    if saved != name:
+        # Rendered concurrently, keep the first one.
+        storage.delete(saved)
+    return content
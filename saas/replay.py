@@ -0,0 +1,234 @@
+"""
+Replay of the StripeEvent log through StripeWebhook.handle_stripe_event.
+
+Events are streamed from the database in `created_at` order and partitioned
+by Stripe customer across a pool of workers: all the events of a customer go
+through the same worker queue, so they are handled in order, while different
+customers are handled in parallel. Each event is handled within the Stripe
+tenant it was received from, and reads go to the primary database as when
+the webhook handles it. Replayed events are not recorded again,
+do not update analytics, revenue history or dunning, and no email is sent
+unless `notify` is set. Invoices already recorded as BillingEvent are not recorded again.
+"""
+import itertools
+import json
+import logging
+import queue
+import threading
+import zlib
+
+from django.db import connections, transaction
+from django.http import HttpRequest
+from saas.models import StripeInfo, stripe_customer_id
+from saas.routers import pin_primary
+from saas.tenants import use_tenant
+
+logger = logging.getLogger("saas")
+
+STRIPE_INFO_FIELDS = ['user_id', 'subscription_id', 'subscription_end', 'plan_id', 'previously_subscribed']
+
+_DONE = object()
+
+# Events handled in one transaction before it is rolled back by a dry run.
+DRY_RUN_BATCH_SIZE = 200
+
+
+class _Rollback(Exception):
+    pass
+
+
+def replay_view_class(view_class, notify=False):
+    """
+    Return a subclass of `view_class` that does not record events again nor
+    update analytics, revenue history and dunning and, unless `notify` is set, does not send
+    any email.
+    """
+    attrs = {'record_stripe_event': lambda self, event, stripe_object: None, 'side_effects': False}
+    if not notify:
+        for name in ('on_payment_succeeded', 'on_payment_failed', 'on_payment_action_required',
+                     'on_invoice_incoming', 'on_trial_will_end'):
+            attrs[name] = lambda self, *args, **kwargs: None
+    return type('Replay' + view_class.__name__, (view_class,), attrs)
+
+
+def replay_request(domain):
+    """
+    Request handed to the webhook handlers, which only read its host and
+    scheme (for the links of emails).
+    """
+    request = HttpRequest()
+    request.method = 'POST'
+    request.META['HTTP_HOST'] = domain
+    return request
+
+
+def stripe_info_state(customer_id, tenant=None):
+    return StripeInfo.objects.filter(customer_id=customer_id, tenant=tenant).values(*STRIPE_INFO_FIELDS).first()
+
+
+class ReplayResult:
+    def __init__(self):
+        self.processed = 0
+        self.failed = []
+        self.by_type = {}
+        self.diffs = {}
+        self._lock = threading.Lock()
+
+    def add(self, event_type, error=None, event_id=None):
+        with self._lock:
+            self.processed += 1
+            self.by_type[event_type] = self.by_type.get(event_type, 0) + 1
+            if error is not None:
+                self.failed.append((event_id, event_type, error))
+
+    def add_diffs(self, diffs):
+        with self._lock:
+            self.diffs.update(diffs)
+
+
+class _Worker:
+    def __init__(self, view, request, result, dry_run):
+        self.view = view
+        self.request = request
+        self.result = result
+        self.dry_run = dry_run
+        self.before = {}
+        self.diffs = {}
+
+    def handle(self, row):
+        event_id, event_type, stripe_object, customer_id, created, tenant = row
+        if stripe_object is None:
+            logger.warning(f"Cannot replay event {event_id}: invalid JSON payload")
+            self.result.add(event_type, error='Invalid JSON payload', event_id=event_id)
+            return
+        if self.dry_run:
+            if customer_id is not None and (tenant, customer_id) not in self.before:
+                self.before[tenant, customer_id] = stripe_info_state(customer_id, tenant)
+        event = {'id': event_id, 'type': event_type, 'created': created, 'data': {'object': stripe_object}}
+        try:
+            with use_tenant(tenant), transaction.atomic():
+                self.view.handle_stripe_event(self.request, event, stripe_object)
+        except Exception as e:
+            logger.exception(f"Replaying event {event_id} ({event_type}) failed")
+            self.result.add(event_type, error=repr(e), event_id=event_id)
+        else:
+            self.result.add(event_type)
+
+    def run(self, rows):
+        # The pin of the calling context does not reach worker threads.
+        with pin_primary():
+            self._run(rows)
+
+    def _run(self, rows):
+        if not self.dry_run:
+            for row in rows:
+                self.handle(row)
+            return
+        # Each batch is rolled back on its own rather than holding one
+        # transaction for the whole replay. Events of a customer spread over
+        # several batches do not see the changes of the earlier batches, the
+        # StripeInfo left by the last one is reported.
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, DRY_RUN_BATCH_SIZE))
+            if not batch:
+                break
+            try:
+                with transaction.atomic():
+                    for row in batch:
+                        self.handle(row)
+                    for tenant, customer_id in {(row[5], row[3]) for row in batch if row[3] is not None}:
+                        before = self.before[tenant, customer_id]
+                        after = stripe_info_state(customer_id, tenant)
+                        if before != after:
+                            self.diffs[customer_id] = (before, after)
+                        else:
+                            self.diffs.pop(customer_id, None)
+                    raise _Rollback
+            except _Rollback:
+                pass
+        self.result.add_diffs(self.diffs)
+
+
+def parse_row(row):
+    """
+    Turn an `(event_id, event, object, stripe_created_at, created_at, tenant)`
+    row into `(event_id, event, stripe_object, customer_id, created, tenant)`,
+    `stripe_object` being None when the payload cannot be parsed and
+    `created` the timestamp of the event as Stripe sends it. Handlers read
+    Stripe objects as dicts, so the payload is handed over as decoded.
+    """
+    event_id, event_type, payload, stripe_created_at, created_at, tenant = row
+    created = int((stripe_created_at or created_at).timestamp())
+    try:
+        stripe_object = json.loads(payload)
+    except ValueError:
+        return event_id, event_type, None, None, created, tenant
+    if not isinstance(stripe_object, dict):
+        return event_id, event_type, None, None, created, tenant
+    return event_id, event_type, stripe_object, stripe_customer_id(event_type, stripe_object), created, tenant
+
+
+class _QueueReader:
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = False
+
+    def __iter__(self):
+        while not self.done:
+            row = self.rows.get()
+            if row is _DONE:
+                self.done = True
+            else:
+                yield row
+
+
+def replay_events(events, view_class, workers=4, dry_run=False, notify=False, domain='localhost',
+                  chunk_size=2000):
+    """
+    Replay the StripeEvent queryset `events` through `view_class` and return a
+    ReplayResult. With `dry_run` every change is rolled back, every
+    DRY_RUN_BATCH_SIZE events, and
+    `ReplayResult.diffs` maps customer ids to their StripeInfo state
+    `(before, after)`.
+    """
+    view = replay_view_class(view_class, notify=notify)()
+    request = replay_request(domain)
+    result = ReplayResult()
+    rows = map(parse_row, (
+        events.order_by('created_at', 'event_id')
+        .values_list('event_id', 'event', 'object', 'stripe_created_at', 'created_at', 'tenant')
+        .iterator(chunk_size=chunk_size)
+    ))
+
+    if workers <= 1:
+        _Worker(view, request, result, dry_run).run(rows)
+        return result
+
+    queues = [queue.Queue(maxsize=chunk_size) for _ in range(workers)]
+
+    def work(rows):
+        reader = _QueueReader(rows)
+        try:
+            _Worker(view, request, result, dry_run).run(reader)
+        except Exception:
+            logger.exception("Replay worker failed")
+            # Drain the queue so the reader never blocks on a failed worker.
+            for _ in reader:
+                pass
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=work, args=(rows,), daemon=True) for rows in queues]
+    for thread in threads:
+        thread.start()
+    try:
+        for row in rows:
+            key = f"{row[5] or ''}:{row[3] or ''}"
+            queues[zlib.crc32(key.encode('utf-8')) % workers].put(row)
+    finally:
+        for rows in queues:
+            rows.put(_DONE)
+        for thread in threads:
+            thread.join()
+    return result
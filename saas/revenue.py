@@ -0,0 +1,270 @@
+"""
+Subscription history and revenue metrics.
+
+StripeInfo only keeps the current subscription of a user. Every change seen
+by the subscription webhooks and StripeInfo.sync_with_customer is also
+recorded here as SubscriptionPeriod rows: a period starts when a user starts
+paying for a plan, and is closed when the plan or the amount changes (a new
+period starts at the same time) or when the subscription stops being paid
+for (canceled, unpaid, trialing...).
+
+RevenueDaily rows are incremented as periods are opened and closed, so the
+daily MRR change and the number of new, churned and reactivated subscribers
+are read without replaying StripeEvent. `rebuild_revenue()` (see the
+`rebuild_revenue` command) recomputes them from the history in bulk.
+Amounts are in the currency's smallest unit, normalized to 30 days.
+"""
+import json
+
+from collections import defaultdict
+from datetime import datetime
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.timezone import make_aware
+from saas.models import CustomerSnapshot, RevenueDaily, StripeInfo, SubscriptionPeriod
+
+# Subscriptions in these statuses are paid for, a subscription without a status is assumed active.
+PAYING_STATUSES = ('active', 'past_due')
+
+MONTHS_PER_INTERVAL = {
+    'day': 1 / 30,
+    'week': 7 / 30,
+    'month': 1,
+    'year': 12,
+}
+
+
+def _value(stripe_object, key, default=None):
+    if stripe_object is not None and key in stripe_object and stripe_object[key] is not None:
+        return stripe_object[key]
+    return default
+
+
+def is_paying(subscription):
+    return _value(subscription, 'status', 'active') in PAYING_STATUSES
+
+
+def _monthly(price, quantity):
+    """
+    Monthly amount of `quantity` units of a price or legacy plan.
+    """
+    amount = _value(price, 'unit_amount', _value(price, 'amount', 0))
+    recurring = _value(price, 'recurring', price)
+    interval = _value(recurring, 'interval', 'month')
+    interval_count = _value(recurring, 'interval_count', 1) or 1
+    return amount * quantity / (MONTHS_PER_INTERVAL.get(interval, 1) * interval_count)
+
+
+def subscription_mrr(subscription):
+    """
+    Return the monthly recurring revenue of `subscription` and its currency.
+    """
+    items = _value(_value(subscription, 'items'), 'data', [])
+    lines = []
+    for item in items:
+        price = _value(item, 'price') or _value(item, 'plan')
+        if price is not None:
+            lines.append((price, _value(item, 'quantity', 1)))
+    if not lines and _value(subscription, 'plan') is not None:
+        lines.append((subscription['plan'], _value(subscription, 'quantity', 1)))
+    mrr = sum(_monthly(price, quantity) for price, quantity in lines)
+    currency = _value(subscription, 'currency') or next(
+        (_value(price, 'currency') for price, _ in lines if _value(price, 'currency')), '')
+    return int(round(mrr)), currency[:3]
+
+
+def increment(day, currency='', **counts):
+    """
+    Atomically add `counts` to the RevenueDaily row of `day` and `currency`,
+    creating it when needed.
+    """
+    updates = {name: F(name) + value for name, value in counts.items()}
+    if RevenueDaily.objects.filter(day=day, currency=currency).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            RevenueDaily.objects.create(day=day, currency=currency, **counts)
+    except IntegrityError:
+        RevenueDaily.objects.filter(day=day, currency=currency).update(**updates)
+
+
+def _closing(periods, subscription):
+    if subscription is None:
+        return periods
+    return [period for period in periods if period.subscription_id == subscription['id']]
+
+
+def _unchanged(periods, subscription, paying):
+    closing = _closing(periods, subscription)
+    if not paying:
+        return not closing
+    mrr, currency = subscription_mrr(subscription)
+    plan_id = _value(_value(subscription, 'plan'), 'id')
+    return [(p.plan_id, p.mrr, p.currency) for p in closing] == [(plan_id, mrr, currency)]
+
+
+def record_subscription(user_id, subscription, deleted=False, at=None):
+    """
+    Record the state of `subscription` for the user, None meaning that the
+    user has no subscription anymore, and count the change in RevenueDaily.
+    Returns the period opened, if any.
+    """
+    at = timezone.now() if at is None else at
+    paying = subscription is not None and not deleted and is_paying(subscription)
+    # Most events do not change anything (e.g. the renewal of a period), check
+    # that before taking any lock.
+    if _unchanged(list(SubscriptionPeriod.objects.filter(user_id=user_id, ended_at=None)), subscription, paying):
+        return None
+    with transaction.atomic():
+        periods = list(SubscriptionPeriod.objects.select_for_update().filter(user_id=user_id, ended_at=None))
+        if _unchanged(periods, subscription, paying):
+            return None
+        closing = _closing(periods, subscription)
+
+        day = timezone.localdate(at)
+        changes = defaultdict(lambda: defaultdict(int))
+        for period in closing:
+            # Events may arrive out of order, periods never end before they start.
+            period.ended_at = max(at, period.started_at)
+            changes[period.currency]['mrr_change'] -= period.mrr
+        if closing:
+            SubscriptionPeriod.objects.bulk_update(closing, ['ended_at'])
+        still_open = len(periods) - len(closing)
+
+        opened = None
+        if paying:
+            mrr, currency = subscription_mrr(subscription)
+            opened = SubscriptionPeriod.objects.create(
+                user_id=user_id,
+                subscription_id=subscription['id'],
+                plan_id=_value(_value(subscription, 'plan'), 'id'),
+                currency=currency,
+                mrr=mrr,
+                started_at=at,
+            )
+            changes[currency]['mrr_change'] += mrr
+            if not closing and not still_open:
+                returning = SubscriptionPeriod.objects.filter(user_id=user_id).exclude(pk=opened.pk).exists()
+                changes[currency]['reactivated' if returning else 'new'] += 1
+        elif not still_open:
+            changes[closing[0].currency]['churned'] += 1
+
+        for currency, counts in changes.items():
+            increment(day, currency, **counts)
+    return opened
+
+
+def revenue(start, end):
+    """
+    Return the revenue metrics of the days between `start` and `end`
+    (inclusive) per currency, with the MRR at the end of each day.
+    """
+    mrr = dict(
+        RevenueDaily.objects.filter(day__lt=start)
+        .values('currency')
+        .annotate(total=Sum('mrr_change'))
+        .values_list('currency', 'total')
+        .order_by()
+    )
+    rows = []
+    days = RevenueDaily.objects.filter(day__gte=start, day__lte=end).order_by('day', 'currency')
+    for daily in days.values('day', 'currency', 'mrr_change', 'new', 'churned', 'reactivated'):
+        mrr[daily['currency']] = mrr.get(daily['currency'], 0) + daily['mrr_change']
+        rows.append(dict(daily, mrr=mrr[daily['currency']]))
+    return rows
+
+
+def backfill_periods(chunk_size=2000):
+    """
+    Open a period for the subscribed users without any history yet, from
+    their CustomerSnapshot, e.g. after upgrading. Returns the number opened.
+    """
+    known = set(SubscriptionPeriod.objects.values_list('user_id', flat=True).distinct())
+    users = dict(
+        StripeInfo.objects.exclude(subscription_id=None)
+        .values_list('customer_id', 'user_id')
+        .iterator(chunk_size=chunk_size)
+    )
+    snapshots = (
+        CustomerSnapshot.objects.filter(customer_id__in=list(users))
+        .exclude(subscription_object=None)
+        .values_list('customer_id', 'subscription_object')
+        .iterator(chunk_size=chunk_size)
+    )
+    periods = []
+    for customer_id, subscription_object in snapshots:
+        user_id = users[customer_id]
+        try:
+            subscription = json.loads(subscription_object)
+        except ValueError:
+            continue
+        if user_id in known or not is_paying(subscription):
+            continue
+        known.add(user_id)
+        mrr, currency = subscription_mrr(subscription)
+        started = _value(subscription, 'start_date', _value(subscription, 'created'))
+        periods.append(SubscriptionPeriod(
+            user_id=user_id,
+            subscription_id=subscription['id'],
+            plan_id=_value(_value(subscription, 'plan'), 'id'),
+            currency=currency,
+            mrr=mrr,
+            started_at=make_aware(datetime.fromtimestamp(int(started))) if started else timezone.now(),
+        ))
+    SubscriptionPeriod.objects.bulk_create(periods, batch_size=chunk_size)
+    return len(periods)
+
+
+def rebuild_revenue(chunk_size=2000, backfill=False):
+    """
+    Recompute every RevenueDaily row from SubscriptionPeriod in bulk, after
+    opening the missing periods from CustomerSnapshot when `backfill` is set.
+    Returns the number of rows.
+    """
+    if backfill:
+        backfill_periods(chunk_size)
+    rows = defaultdict(lambda: defaultdict(int))
+    periods = (
+        SubscriptionPeriod.objects.order_by('user_id', 'started_at')
+        .values_list('user_id', 'currency', 'mrr', 'started_at', 'ended_at')
+        .iterator(chunk_size=chunk_size)
+    )
+
+    def replay(changes):
+        # Periods replacing one another at the same time are opened before the
+        # previous ones are closed, so that a plan change is not a churn.
+        open_count = 0
+        subscribed = False
+        for at, closing, currency, mrr in sorted(changes, key=lambda change: change[:2]):
+            key = (timezone.localdate(at), currency)
+            if closing:
+                rows[key]['mrr_change'] -= mrr
+                open_count -= 1
+                if not open_count:
+                    rows[key]['churned'] += 1
+            else:
+                rows[key]['mrr_change'] += mrr
+                if not open_count:
+                    rows[key]['reactivated' if subscribed else 'new'] += 1
+                open_count += 1
+                subscribed = True
+
+    user = None
+    changes = []
+    for user_id, currency, mrr, started_at, ended_at in periods:
+        if user_id != user:
+            replay(changes)
+            user, changes = user_id, []
+        changes.append((started_at, False, currency, mrr))
+        if ended_at is not None:
+            changes.append((ended_at, True, currency, mrr))
+    replay(changes)
+
+    with transaction.atomic():
+        RevenueDaily.objects.all().delete()
+        RevenueDaily.objects.bulk_create([
+            RevenueDaily(day=day, currency=currency, **counts)
+            for (day, currency), counts in rows.items()
+        ], batch_size=chunk_size)
+    return len(rows)
@@ -0,0 +1,137 @@
+"""
+Optional database router for the saas app.
+
+    DATABASE_ROUTERS = ['saas.routers.SaasRouter']
+
+    # Alias receiving the webhook event log, reads, writes and migrations.
+    SAAS_EVENTS_DATABASE = 'events'
+    SAAS_EVENTS_MODELS = ['stripeevent']
+    # Alias serving StripeInfo reads (subscription_required, current_customer).
+    SAAS_SUBSCRIPTION_READ_DATABASE = 'replica'
+    # Alias of the primary database, where StripeInfo is written.
+    SAAS_PRIMARY_DATABASE = 'default'
+    # Seconds during which a user reads their StripeInfo from the primary
+    # after it was written.
+    SAAS_READ_YOUR_WRITES_SECONDS = 10
+
+Every setting is optional, an unset alias leaves the model to the other
+routers and the default database. BillingEvent references the user, so only
+add it to SAAS_EVENTS_MODELS when the events alias reaches the user table;
+relations between the events alias and the primary are then allowed. The
+event models are only migrated on the events alias, and no other saas model
+is migrated there.
+
+Read-your-writes: saving a StripeInfo marks its user in the cache, and reads
+of `user.stripeinfo` for that user go to the primary for
+SAAS_READ_YOUR_WRITES_SECONDS, so a webhook or login is visible on the next
+request whatever the replica lag. Code reading before writing, like the
+webhook and login handlers, runs within `pin_primary()`.
+"""
+import contextvars
+
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+DEFAULT_EVENTS_MODELS = ('stripeevent',)
+
+_pinned = contextvars.ContextVar('saas_pinned', default=False)
+
+
+def primary_database():
+    return getattr(settings, 'SAAS_PRIMARY_DATABASE', 'default')
+
+
+def events_database():
+    return getattr(settings, 'SAAS_EVENTS_DATABASE', None)
+
+
+def subscription_read_database():
+    return getattr(settings, 'SAAS_SUBSCRIPTION_READ_DATABASE', None)
+
+
+def sticky_key(user_id):
+    return f'saas:sticky:{user_id}'
+
+
+def stick(user_id):
+    """
+    Read the StripeInfo of `user_id` from the primary for the next
+    SAAS_READ_YOUR_WRITES_SECONDS.
+    """
+    if subscription_read_database() is None or user_id is None:
+        return
+    cache.set(sticky_key(user_id), 1, getattr(settings, 'SAAS_READ_YOUR_WRITES_SECONDS', 10))
+
+
+def is_sticky(user_id):
+    return user_id is not None and cache.get(sticky_key(user_id)) is not None
+
+
+@contextmanager
+def pin_primary():
+    """
+    Read StripeInfo from the primary within the block (or decorated function).
+    """
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def _user_id(instance):
+    if instance is None:
+        return None
+    if isinstance(instance, get_user_model()):
+        return instance.pk
+    return getattr(instance, 'user_id', None)
+
+
+class SaasRouter:
+    def _is_event(self, model):
+        return self._is_event_name(model._meta.app_label, model._meta.model_name)
+
+    def _is_event_name(self, app_label, model_name):
+        models = getattr(settings, 'SAAS_EVENTS_MODELS', DEFAULT_EVENTS_MODELS)
+        return app_label == 'saas' and model_name in models
+
+    def _is_stripe_info(self, model):
+        return model._meta.app_label == 'saas' and model._meta.model_name == 'stripeinfo'
+
+    def db_for_read(self, model, **hints):
+        if self._is_event(model):
+            return events_database()
+        if self._is_stripe_info(model):
+            replica = subscription_read_database()
+            if replica is None or _pinned.get() or is_sticky(_user_id(hints.get('instance'))):
+                return primary_database()
+            return replica
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_event(model):
+            return events_database()
+        if self._is_stripe_info(model) and subscription_read_database() is not None:
+            # Instances read from the replica would otherwise be saved there.
+            return primary_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica mirrors the primary, and event models only reference the
+        # primary when the events alias reaches its tables.
+        aliases = {primary_database(), subscription_read_database(), events_database()} - {None}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        events = events_database()
+        if events is None or app_label != 'saas' or model_name is None:
+            return None
+        if self._is_event_name(app_label, model_name):
+            return db == events
+        if db == events:
+            return False
+        return None
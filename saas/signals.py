@@ -1,14 +1,17 @@
 import logging
-import stripe
 
 from datetime import datetime
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.signals import user_logged_in
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.timezone import make_aware
-from saas.models import StripeInfo
+from saas.billing import invalidate as invalidate_billing_history
+from saas.client import get_stripe
+from saas.models import BillingEvent, StripeInfo
+from saas.routers import pin_primary, stick
+from saas.tenants import current_tenant, use_tenant
 
 User = get_user_model()
 
@@ -20,6 +23,7 @@ def on_new_user(sender, instance, created, **kwargs):
         # Do not create a customer when using CHECKOUT
         if hasattr(settings, 'SAAS_USE_CHECKOUT') and settings.SAAS_USE_CHECKOUT:
             return
+        stripe = get_stripe()
         # Create a Stripe Customer and store customer id
         customer = None
         subscription = None
@@ -47,6 +51,7 @@ def on_new_user(sender, instance, created, **kwargs):
         logger.info('Created Stripe Customer {}'.format(customer['id']))
         StripeInfo.objects.create(
             user=instance,
+            tenant=current_tenant(),
             customer_id=customer['id'],
             subscription_id = subscription['id'] if subscription is not None else None,
             subscription_end = datetime.fromtimestamp(
@@ -54,11 +59,15 @@ def on_new_user(sender, instance, created, **kwargs):
         )
 
 @receiver(user_logged_in)
+@pin_primary()
 def on_user_login(sender, request, user, **kwargs):
     customer = None
     info = None
     try:
         info = user.stripeinfo
+        # The client keeps the keys of the Stripe account of the user.
+        with use_tenant(info.tenant):
+            stripe = get_stripe()
         try:
             customer = stripe.Customer.retrieve(info.customer_id, expand=['subscriptions'])
             print(customer)
@@ -80,3 +89,13 @@ def on_user_login(sender, request, user, **kwargs):
         info.subscription_end = make_aware(datetime.fromtimestamp(int(subscription['current_period_end'])))
         info.plan_id = subscription['plan']['id']
         info.save()
+
+@receiver(post_save, sender=BillingEvent)
+@receiver(post_delete, sender=BillingEvent)
+def on_billing_event_changed(sender, instance, **kwargs):
+    invalidate_billing_history(instance.user_id)
+
+@receiver(post_save, sender=StripeInfo)
+def on_stripe_info_saved(sender, instance, **kwargs):
+    # Read your writes when StripeInfo is read from a replica.
+    stick(instance.user_id)
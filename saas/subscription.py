@@ -1,6 +1,10 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import F
 from django.utils import timezone
+from saas.entitlements import FREE, TRIAL, entitlements_of
+from saas.models import StripeInfo
+from saas.tenants import current_tenant
 
 User = get_user_model()
 
@@ -26,6 +30,44 @@ class Customer:
         except User.stripeinfo.RelatedObjectDoesNotExist:
             return None
 
+    @property
+    def organization_info(self):
+        """
+        StripeInfo of the organizations of the user, the one ending last
+        first. Looked up once per user instance, in one indexed query.
+        """
+        if not hasattr(self._user, '_saas_organization_info'):
+            self._user._saas_organization_info = (
+                StripeInfo.objects.filter(organization__memberships__user=self._user)
+                .order_by(F('subscription_end').desc(nulls_last=True))
+                .first()
+            )
+        return self._user._saas_organization_info
+
+    @staticmethod
+    def is_active(info, now):
+        if info is None:
+            return False
+        if info.subscription_end is not None and now <= info.subscription_end:
+            return True
+        # Grace period of a failed payment, see saas.dunning.
+        return info.grace_until is not None and now <= info.grace_until
+
+    @property
+    def active_info(self):
+        """
+        StripeInfo of the personal or, failing that, organization subscription
+        currently active (or within its grace period), or None.
+        """
+        now = timezone.now()
+        info = self.info
+        if self.is_active(info, now):
+            return info
+        info = self.organization_info
+        if self.is_active(info, now):
+            return info
+        return None
+
     @property
     def subscribed(self):
         return self.trialing or self.actively_subscribed
@@ -35,10 +77,7 @@ class Customer:
         if (hasattr(settings, 'SAAS_IS_STAFF_SUBSCRIBED') and settings.SAAS_IS_STAFF_SUBSCRIBED) or not hasattr(settings, 'SAAS_IS_STAFF_SUBSCRIBED'):
             if self._user.is_staff:
                 return True
-        info = self.info
-        if info is None:
-            return False
-        return info.subscription_end is not None and timezone.now() <= info.subscription_end
+        return self.active_info is not None
 
     @property
     def previously_subscribed(self):
@@ -68,6 +107,40 @@ class Customer:
         delta = timezone.now() - self.date_joined
         return delta.total_seconds() < self.trial_duration_in_seconds
 
+    @property
+    def plan_key(self):
+        """
+        Key of the entitlements of this customer: the subscribed plan id, the
+        SAAS_STAFF_PLAN of staff members when set, `trial` or `free`.
+        """
+        if self._user.is_staff and getattr(settings, 'SAAS_STAFF_PLAN', None):
+            return settings.SAAS_STAFF_PLAN
+        if self.actively_subscribed:
+            info = self.active_info
+            if info is not None and info.plan_id:
+                return info.plan_id
+        if self.trialing:
+            return TRIAL
+        return FREE
+
+    @property
+    def tenant(self):
+        """
+        Stripe account of the customer, see saas.tenants.
+        """
+        info = self.active_info or self.info
+        return info.tenant if info is not None else current_tenant()
+
+    @property
+    def entitlements(self):
+        return entitlements_of(self.plan_key, self.tenant)
+
+    def has_feature(self, name):
+        return name in self.entitlements.features
+
+    def limit(self, name, default=None):
+        return self.entitlements.limits.get(name, default)
+
     @property
     def trial_left_in_seconds(self):
         return self.trial_duration_in_seconds - (timezone.now() - self.date_joined).total_seconds()
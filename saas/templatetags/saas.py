@@ -1,5 +1,4 @@
 
-import currency
 from datetime import datetime
 from django import template
 
@@ -7,6 +6,7 @@ register = template.Library()
 
 @register.filter
 def stripe_amount(amount, symbol):
+    import currency
     return currency.pretty(amount / pow(10, currency.decimals(symbol)), symbol)
 
 @register.filter(name='fromunix')
@@ -0,0 +1,89 @@
+"""
+Several Stripe accounts in one deployment.
+
+    SAAS_STRIPE_TENANTS = {
+        'brand-a': {
+            'secret_key': 'sk_live_...',
+            'publishable_key': 'pk_live_...',
+            'endpoint_secret': 'whsec_...',
+            'account': 'acct_...',  # optional, see SAAS_STRIPE_ACCOUNT_HEADER
+        },
+    }
+    # Tenant of the requests by host, set by saas.tenants.TenantMiddleware.
+    SAAS_STRIPE_TENANT_HOSTS = {'brand-a.example.com': 'brand-a'}
+
+Within `use_tenant(name)`, `get_stripe()` calls Stripe with the keys of the
+tenant and StripeInfo is created and looked up for that tenant only. Outside
+of any tenant, STRIPE_SECRET_KEY, STRIPE_PUBLISHABLE_KEY and
+STRIPE_ENDPOINT_SECRET are used as before.
+
+Webhooks are verified with the secret of the tenant of their endpoint
+(`StripeView.tenant` or a `tenant` URL argument) or, failing that, of the
+account named by the SAAS_STRIPE_ACCOUNT_HEADER request header.
+"""
+import contextvars
+
+from contextlib import contextmanager
+from django.conf import settings
+
+_tenant = contextvars.ContextVar('saas_tenant', default=None)
+
+
+def tenants():
+    return getattr(settings, 'SAAS_STRIPE_TENANTS', {})
+
+
+def current_tenant():
+    return _tenant.get()
+
+
+@contextmanager
+def use_tenant(name):
+    """
+    Use the Stripe account of tenant `name` (None for the default one) within
+    the block.
+    """
+    if name is not None and name not in tenants():
+        raise ValueError(f'Unknown Stripe tenant {name}')
+    token = _tenant.set(name)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+def tenant_config(name=None):
+    if name is not None:
+        return tenants()[name]
+    return {
+        'secret_key': getattr(settings, 'STRIPE_SECRET_KEY', None),
+        'publishable_key': getattr(settings, 'STRIPE_PUBLISHABLE_KEY', None),
+        'endpoint_secret': getattr(settings, 'STRIPE_ENDPOINT_SECRET', None),
+    }
+
+
+def tenant_setting(key):
+    """
+    Setting `key` of the current tenant, e.g. 'publishable_key'.
+    """
+    return tenant_config(current_tenant()).get(key)
+
+
+def tenant_for_account(account):
+    for name, config in tenants().items():
+        if account and config.get('account') == account:
+            return name
+    return None
+
+
+def tenant_for_host(host):
+    return getattr(settings, 'SAAS_STRIPE_TENANT_HOSTS', {}).get(host)
+
+
+class TenantMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with use_tenant(tenant_for_host(request.get_host())):
+            return self.get_response(request)
@@ -1,3 +1,1577 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+import zipfile
+import stripe
 
-# Create your tests here.
+from datetime import timedelta
+from unittest import mock, skipUnless
+from importlib import import_module
+from io import BytesIO, StringIO
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Permission
+from django.core.exceptions import PermissionDenied
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+
+from saas.benchmarks import (
+    BENCHMARK_ENDPOINT_SECRET,
+    BENCHMARK_TEMPLATES,
+    create_user,
+    customer_fixture,
+    event_payload,
+    invoice_fixture,
+    run_benchmarks,
+    sign_payload,
+    subscription_fixture,
+)
+from saas.billing import billing_history
+from saas.client import TenantStripe, get_stripe
+from saas.dunning import run_dunning
+from saas.decorators import feature_required, subscription_required
+from saas.entitlements import _list_plans, sync_plan_features
+from saas.exports import BillingExport
+from saas.gdpr import erase_user, export_user, index_events
+from saas.health import cached_webhook_health, webhook_health
+from saas.instrumentation import InstrumentedStripe, get_metrics_backend, measured, statsd_lines
+from saas.analytics import funnel, normalize_referer, rebuild_funnel, record_signup
+from saas.onboarding import Onboarding, onboard
+from saas.purge import purge_unactivated
+from saas.models import Acquisition, AcquisitionDaily, BillingEvent, StripeEvent, StripeInfo, UserAgent, CustomerSnapshot, Dunning, PaymentMethod, UsageRecord, Organization, PlanEntitlement, RevenueDaily, SeatLimitExceeded, SubscriptionPeriod
+from saas.ratelimit import check_rate_limits, client_ip, hit
+from saas.receipts import receipt, receipt_storage, render_receipt
+from saas.replay import _Worker, replay_events
+from saas.revenue import rebuild_revenue, record_subscription, revenue, subscription_mrr
+from saas.routers import SaasRouter, pin_primary, sticky_key
+from saas.usage import flush_usage_buffer, record_usage, report_usage
+from saas.subscription import Customer
+from saas.tenants import use_tenant
+from saas.useragents import backfill_user_agents, conversions_by, intern_user_agent, parse_user_agent
+from saas.views import ActivateView, BillingView, CheckoutView, RegisterView, UpdatePaymentView, BillingHistoryView, ExportView, MetricsView, ReceiptView, StripeWebhook, SubscriptionView, UserDataExportView, WebhookHealthView
+
+urlpatterns = [
+    path('stripe', StripeWebhook.as_view(), name='stripe'),
+]
+
+SAAS_MODULES = [
+    'saas.analytics',
+    'saas.billing',
+    'saas.client',
+    'saas.context_processors',
+    'saas.decorators',
+    'saas.dunning',
+    'saas.entitlements',
+    'saas.exports',
+    'saas.fake_stripe',
+    'saas.forms',
+    'saas.gdpr',
+    'saas.health',
+    'saas.instrumentation',
+    'saas.mailer',
+    'saas.ratelimit',
+    'saas.receipts',
+    'saas.replay',
+    'saas.revenue',
+    'saas.routers',
+    'saas.models',
+    'saas.onboarding',
+    'saas.purge',
+    'saas.signals',
+    'saas.subscription',
+    'saas.templatetags.saas',
+    'saas.tenants',
+    'saas.urls',
+    'saas.usage',
+    'saas.useragents',
+    'saas.views',
+]
+
+
+def run_python(code, *flags):
+    return subprocess.run(
+        [sys.executable, *flags, '-c', code],
+        capture_output=True, text=True, check=True,
+    )
+
+
+class ImportTimeTestCase(SimpleTestCase):
+    # Heavy third party packages that must only be imported on first use.
+    lazy_modules = ['stripe', 'django_recaptcha', 'currency', 'dateutil']
+    # Regression budget for importing every saas module, in milliseconds.
+    import_time_budget_ms = 250
+
+    def test_heavy_dependencies_are_lazy(self):
+        code = (
+            'import sys, django\n'
+            'before = set(sys.modules)\n'
+            'django.setup()\n'
+            'import {}\n'
+            'import json\n'
+            'print(json.dumps(sorted(set(sys.modules) - before)))\n'
+        ).format(', '.join(SAAS_MODULES))
+        loaded = json.loads(run_python(code).stdout)
+        for name in self.lazy_modules:
+            self.assertFalse(name in loaded, f'{name} is imported eagerly')
+
+    def test_missing_secret_key_is_warned_once(self):
+        with override_settings(STRIPE_SECRET_KEY=None):
+            del settings.STRIPE_SECRET_KEY
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                get_stripe()
+                get_stripe()
+        self.assertEqual(len(caught), 1)
+        self.assertIn('STRIPE_SECRET_KEY', str(caught[0].message))
+
+    def test_import_time_budget(self):
+        code = 'import django; django.setup(); import {}'.format(', '.join(SAAS_MODULES))
+        stderr = run_python(code, '-X', 'importtime').stderr
+        entries = []
+        for line in stderr.splitlines():
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip())) // 2
+            entries.append((depth, name.strip(), int(cumulative)))
+
+        def is_saas(name):
+            return name == 'saas' or name.startswith('saas.')
+
+        total = 0
+        for i, (depth, name, cumulative) in enumerate(entries):
+            if not is_saas(name):
+                continue
+            # -X importtime prints children before their parent, only count
+            # saas modules that were not imported by another saas module.
+            nested = False
+            for parent_depth, parent_name, _ in entries[i + 1:]:
+                if parent_depth < depth:
+                    depth = parent_depth
+                    if is_saas(parent_name):
+                        nested = True
+                        break
+            if not nested:
+                total += cumulative
+        self.assertLess(total / 1000, self.import_time_budget_ms)
+
+
+class BenchmarkTestCase(TestCase):
+    # Database queries allowed per operation, a regression budget for the hot paths.
+    query_budgets = {
+        # Every event is marked processed once handled (see saas.health), and subscription
+        # events also read the open SubscriptionPeriod of the user.
+        'webhook customer.created': 7,
+        'webhook customer.updated': 7,
+        'webhook customer.subscription.created': 7,
+        'webhook customer.subscription.updated': 7,
+        'webhook customer.subscription.deleted': 7,
+        'webhook customer.subscription.trial_will_end': 4,
+        'webhook invoice.payment_succeeded': 7,
+        'webhook invoice.payment_failed': 5,
+        'webhook invoice.payment_action_required': 4,
+        'webhook invoice.upcoming': 4,
+        # Loading StripeInfo, then the organization subscriptions of users without an active one.
+        'subscription_required overhead': 2,
+        'Customer properties (fresh user)': 3,
+        'Customer properties (cached user)': 0,
+        'send_multi_mail text': 0,
+        'send_multi_mail text+html': 0,
+    }
+
+    def test_query_budgets(self):
+        results = {result.name: result for result in run_benchmarks(iterations=3)}
+        for name, budget in self.query_budgets.items():
+            self.assertIn(name, results)
+            self.assertLessEqual(results[name].queries_per_op, budget, name)
+
+
+@override_settings(SAAS_INSTRUMENTATION=True, SAAS_UPGRADE_URL='/upgrade')
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.factory = RequestFactory()
+
+    def post_event(self, event_type, stripe_object):
+        payload = event_payload(event_type, stripe_object)
+        request = self.factory.post(
+            '/stripe', data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, BENCHMARK_ENDPOINT_SECRET),
+        )
+        return StripeWebhook.as_view(endpoint_secret=BENCHMARK_ENDPOINT_SECRET)(request)
+
+    def test_webhook_is_measured_per_event_type(self):
+        received = []
+
+        def on_measured(sender, name, duration, queries, tags, **kwargs):
+            received.append((name, tags))
+
+        measured.connect(on_measured)
+        try:
+            self.post_event('customer.subscription.updated', subscription_fixture())
+        finally:
+            measured.disconnect(on_measured)
+
+        self.assertIn(('handle_stripe_event', {'event': 'customer.subscription.updated'}), received)
+        self.assertIn(('customer_user_info', {}), received)
+        self.assertIn(('stripe_api', {'call': 'Webhook.construct_event'}), received)
+        series = get_metrics_backend().snapshot()
+        handled = series[('handle_stripe_event', (('event', 'customer.subscription.updated'),))]
+        self.assertEqual(handled['count'], 1)
+        # Includes creating the CustomerSnapshot (update, savepoint, insert, release) and opening
+        # the first SubscriptionPeriod of the user with its RevenueDaily row (10 queries).
+        self.assertEqual(handled['queries'], 18)
+
+    def test_subscription_required_and_prometheus_text(self):
+        view = subscription_required()(lambda request: HttpResponse())
+        request = self.factory.get('/')
+        request.user = self.user
+        view(request)
+
+        request = self.factory.get('/metrics')
+        request.user = AnonymousUser()
+        with self.assertRaises(PermissionDenied):
+            MetricsView.as_view()(request)
+        with override_settings(SAAS_METRICS_TOKEN='metrics-token'):
+            with self.assertRaises(PermissionDenied):
+                MetricsView.as_view()(self.factory.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong'))
+            response = MetricsView.as_view()(self.factory.get('/metrics', HTTP_AUTHORIZATION='Bearer metrics-token'))
+        self.assertEqual(response.status_code, 200)
+        request.user = get_user_model()(username='staff', is_staff=True)
+        self.assertEqual(MetricsView.as_view()(request).status_code, 200)
+        self.assertIn(b'saas_duration_seconds_count{operation="subscription_required"} 1', response.content)
+        self.assertIn(b'saas_queries_total{operation="subscription_required"}', response.content)
+
+    def test_disabled(self):
+        with override_settings(SAAS_INSTRUMENTATION=False):
+            self.post_event('customer.subscription.updated', subscription_fixture())
+            self.assertEqual(get_metrics_backend().snapshot(), {})
+
+    def test_statsd_lines(self):
+        self.assertEqual(
+            statsd_lines('handle_stripe_event', 0.0125, 3, {'event': 'invoice.paid'}),
+            [
+                'saas.handle_stripe_event.invoice_paid.count:1|c',
+                'saas.handle_stripe_event.invoice_paid.duration:12.500|ms',
+                'saas.handle_stripe_event.invoice_paid.queries:3|c',
+            ],
+        )
+
+
+@override_settings(
+    ROOT_URLCONF='saas.tests',
+    SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+    SAAS_USE_CHECKOUT=False,
+    SAAS_FAKE_STRIPE_WEBHOOK_URL='/stripe',
+    STRIPE_ENDPOINT_SECRET=BENCHMARK_ENDPOINT_SECRET,
+)
+class FakeStripeTestCase(TestCase):
+    def test_subscription_lifecycle(self):
+        out = StringIO()
+        call_command('fake_stripe_load', users=3, renewals=2, stdout=out)
+        self.assertIn('3/3 users went through the whole subscription lifecycle', out.getvalue())
+        for line in out.getvalue().splitlines():
+            if 'delivered' in line:
+                self.assertTrue(line.endswith(', 0 failed'), line)
+        self.assertEqual(StripeInfo.objects.filter(previously_subscribed=True).count(), 3)
+
+    def test_proxies_are_unwrapped(self):
+        stripe = TenantStripe(InstrumentedStripe(get_stripe()), 'sk_fake')
+        out = StringIO()
+        with mock.patch('saas.management.commands.fake_stripe_load.get_stripe', return_value=stripe):
+            call_command('fake_stripe_load', users=1, renewals=1, stdout=out)
+        self.assertIn('1/1 users went through the whole subscription lifecycle', out.getvalue())
+
+    def test_webhook_signature_is_checked(self):
+        stripe = get_stripe()
+        stripe.Customer.create(email='nobody@example.com')
+        self.assertEqual(stripe.deliver_events(secret='whsec_wrong'), [400])
+
+    def test_subscription_updates_stripe_info(self):
+        user = create_user(customer_id=get_stripe().Customer.create(email='fake@example.com')['id'])
+        stripe = get_stripe()
+        subscription = stripe.Subscription.create(
+            customer=user.stripeinfo.customer_id,
+            items=[{'plan': 'plan_fake_monthly'}],
+        )
+        self.assertEqual(set(stripe.deliver_events()), {200})
+        info = StripeInfo.objects.get(user=user)
+        self.assertEqual(info.subscription_id, subscription.id)
+        self.assertEqual(info.plan_id, 'plan_fake_monthly')
+        self.assertEqual(int(info.subscription_end.timestamp()), subscription['current_period_end'])
+
+    @override_settings(SAAS_USE_CHECKOUT=True, SAAS_CHECKOUT_PRICE_ID='plan_fake_monthly')
+    def test_checkout_session_links_user_by_id(self):
+        user = get_user_model().objects.create_user('checkout', email='checkout@example.com')
+        request = RequestFactory().post('/checkout')
+        request.user = user
+        response = CheckoutView.as_view(success_url='/done', cancel_url='/')(request)
+        self.assertEqual(response['Location'], 'http://testserver/done')
+        # Only the client_reference_id can match the user now.
+        user.email = 'renamed@example.com'
+        user.save()
+
+        stripe = get_stripe()
+        self.assertEqual(set(stripe.deliver_events()), {200})
+        info = StripeInfo.objects.get(user=user)
+        session = list(stripe.checkout_sessions.values())[-1]
+        self.assertEqual(session['client_reference_id'], str(user.pk))
+        self.assertEqual(info.customer_id, session['customer'])
+        self.assertEqual(info.subscription_id, session['subscription'])
+        self.assertEqual(info.plan_id, 'plan_fake_monthly')
+        self.assertTrue(Customer.of(get_user_model().objects.get(pk=user.pk)).actively_subscribed)
+
+
+class WebhookTestMixin:
+    def post_event(self, event_type, stripe_object, sequence=0):
+        payload = event_payload(event_type, stripe_object, sequence=sequence)
+        request = RequestFactory().post(
+            '/stripe', data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, BENCHMARK_ENDPOINT_SECRET),
+        )
+        self.assertEqual(StripeWebhook.as_view(endpoint_secret=BENCHMARK_ENDPOINT_SECRET)(request).status_code, 200)
+
+
+class ReplayTestMixin(WebhookTestMixin):
+    def post_events(self):
+        self.users = [
+            create_user(email=f'replay{i}@example.com', customer_id=f'cus_replay{i}') for i in range(3)
+        ]
+        for i, user in enumerate(self.users):
+            customer_id = user.stripeinfo.customer_id
+            for event_type, stripe_object in [
+                ('customer.subscription.created', subscription_fixture(customer_id)),
+                ('invoice.payment_succeeded', invoice_fixture(customer_id)),
+                ('customer.updated', customer_fixture(user.email, customer_id)),
+            ]:
+                self.post_event(event_type, stripe_object, sequence=f'{i}{event_type}')
+        # Simulate a handler bug wiping the subscriptions.
+        StripeInfo.objects.update(subscription_id=None, subscription_end=None, plan_id=None)
+
+    def assert_restored(self):
+        for info in StripeInfo.objects.all():
+            self.assertEqual(info.subscription_id, 'sub_benchmark')
+            self.assertEqual(info.plan_id, 'plan_benchmark')
+        self.assertEqual(StripeEvent.objects.count(), 9)
+
+
+class ReplayTestCase(ReplayTestMixin, TestCase):
+    def test_replay(self):
+        self.post_events()
+        result = replay_events(
+            StripeEvent.objects.exclude(event='invoice.payment_succeeded'), StripeWebhook, workers=1)
+        self.assertEqual(result.processed, 6)
+        self.assertEqual(result.failed, [])
+        self.assert_restored()
+        self.assertEqual(BillingEvent.objects.count(), 3)
+
+    def test_replay_is_idempotent(self):
+        self.post_events()
+        result = replay_events(StripeEvent.objects.all(), StripeWebhook, workers=1)
+        self.assertEqual(result.processed, 9)
+        self.assertEqual(result.failed, [])
+        self.assert_restored()
+        self.assertEqual(BillingEvent.objects.count(), 3)
+
+    def test_replay_keeps_revenue_history(self):
+        self.post_events()
+        customer_id = self.users[0].stripeinfo.customer_id
+        self.post_event('customer.subscription.deleted', subscription_fixture(customer_id), sequence='deleted')
+        history = sorted(RevenueDaily.objects.values_list('day', 'currency', 'mrr_change', 'new', 'churned', 'reactivated'))
+        periods = sorted(SubscriptionPeriod.objects.values_list('user_id', 'started_at', 'ended_at'))
+        replay_events(StripeEvent.objects.all(), StripeWebhook, workers=1)
+        self.assertEqual(
+            sorted(RevenueDaily.objects.values_list('day', 'currency', 'mrr_change', 'new', 'churned', 'reactivated')),
+            history,
+        )
+        self.assertEqual(sorted(SubscriptionPeriod.objects.values_list('user_id', 'started_at', 'ended_at')), periods)
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', dict(
+            BENCHMARK_TEMPLATES, **{'saas/benchmark/link.txt': '{{ protocol }}://{{ domain }}/billing\n'}))]},
+    }])
+    def test_notify(self):
+        self.post_events()
+        BillingEvent.objects.all().delete()
+        mail.outbox = []
+
+        class NotifyingWebhook(StripeWebhook):
+            payment_succeeded_subject_template_name = 'saas/benchmark/subject.txt'
+            payment_succeeded_email_template_name = 'saas/benchmark/link.txt'
+
+        result = replay_events(StripeEvent.objects.filter(event='invoice.payment_succeeded'), NotifyingWebhook,
+                               workers=1, notify=True, domain='example.com')
+        self.assertEqual(result.failed, [])
+        self.assertEqual([message.body for message in mail.outbox], ['http://example.com/billing\n'] * 3)
+
+    def test_dry_run(self):
+        self.post_events()
+        out = StringIO()
+        call_command('replay_stripe_events', '--dry-run', '--workers=1', '--type=customer.subscription.created', stdout=out)
+        self.assertIn('Replayed 3 events, 0 failed', out.getvalue())
+        self.assertIn('cus_replay0:\n  plan_id: None -> plan_benchmark', out.getvalue())
+        self.assertFalse(StripeInfo.objects.exclude(subscription_id=None).exists())
+
+    def test_dry_run_rolls_back_each_batch(self):
+        self.post_events()
+        events = StripeEvent.objects.exclude(event='customer.updated')
+        savepoints = []
+        handle = _Worker.handle
+
+        def recording_handle(worker, row):
+            savepoints.append(connection.savepoint_ids[-1])
+            handle(worker, row)
+
+        with mock.patch('saas.replay.DRY_RUN_BATCH_SIZE', 2), mock.patch.object(_Worker, 'handle', recording_handle):
+            result = replay_events(events, StripeWebhook, workers=1, dry_run=True)
+        # The 6 events are rolled back 2 at a time.
+        self.assertEqual(len(savepoints), 6)
+        self.assertEqual(len(set(savepoints)), 3)
+        self.assertEqual(sorted(result.diffs), ['cus_replay0', 'cus_replay1', 'cus_replay2'])
+        self.assertEqual({after['plan_id'] for _, after in result.diffs.values()}, {'plan_benchmark'})
+        self.assertFalse(StripeInfo.objects.exclude(subscription_id=None).exists())
+
+
+class ParallelReplayTestCase(ReplayTestMixin, TestCase):
+    def test_customer_order_is_kept(self):
+        self.post_events()
+        handled = []
+
+        reads = set()
+
+        class RecordingWebhook(StripeWebhook):
+            def handle_stripe_event(self, request, event, stripe_object):
+                handled.append((threading.current_thread().name, stripe_object['customer'], event['id']))
+                reads.add(SaasRouter().db_for_read(StripeInfo))
+
+        with override_settings(SAAS_SUBSCRIPTION_READ_DATABASE='replica'):
+            result = replay_events(
+                StripeEvent.objects.exclude(event='customer.updated'), RecordingWebhook, workers=3)
+        self.assertEqual(result.processed, 6)
+        # StripeInfo is read from the primary, as in the webhook.
+        self.assertEqual(reads, {'default'})
+        by_customer = {}
+        for thread, customer, event_id in handled:
+            by_customer.setdefault(customer, []).append((thread, event_id))
+        for customer, events in by_customer.items():
+            # Every customer is handled by a single worker, in created order.
+            self.assertEqual(len({thread for thread, _ in events}), 1)
+            self.assertEqual(
+                [event_id for _, event_id in events],
+                list(StripeEvent.objects.filter(event_id__in=[event_id for _, event_id in events])
+                     .order_by('created_at').values_list('event_id', flat=True)),
+            )
+
+
+class AnalyticsTestCase(WebhookTestMixin, TestCase):
+    def signup(self, i, referer, campaign):
+        user = create_user(email=f'funnel{i}@example.com', customer_id=f'cus_funnel{i}')
+        record_signup(Acquisition.objects.create(user=user, referer=referer, campaign=campaign))
+        return user
+
+    def test_normalize_referer(self):
+        self.assertEqual(normalize_referer('https://www.Google.com/search?q=saas'), 'google.com')
+        self.assertEqual(normalize_referer('ProductHunt'), 'producthunt')
+        self.assertEqual(normalize_referer(None), '')
+
+    def test_funnel(self):
+        self.signup(0, 'https://www.google.com/?q=1', 'launch')
+        self.signup(1, 'https://google.com/?q=2', 'launch')
+        self.signup(2, None, None)
+        for i in range(2):
+            self.post_event('invoice.payment_succeeded', invoice_fixture('cus_funnel0', amount=1500, invoice_id=f'in_{i}'))
+
+        today = AcquisitionDaily.objects.first().day
+        by_campaign = {row['normalized_campaign__name']: row for row in funnel(today, today)}
+        self.assertEqual(by_campaign['launch']['total_signups'], 2)
+        self.assertEqual(by_campaign['launch']['total_conversions'], 1)
+        self.assertEqual(by_campaign['launch']['total_revenue'], 3000)
+        self.assertEqual(by_campaign['']['total_signups'], 1)
+        by_domain = {row['referer_domain__domain']: row for row in funnel(today, today, ('referer_domain__domain',))}
+        self.assertEqual(by_domain['google.com']['total_signups'], 2)
+
+        incremental = sorted(AcquisitionDaily.objects.values_list(
+            'day', 'normalized_campaign', 'referer_domain', 'currency', 'signups', 'trials', 'conversions', 'revenue'))
+        Acquisition.objects.update(converted_at=None)
+        rebuild_funnel()
+        rebuilt = sorted(AcquisitionDaily.objects.values_list(
+            'day', 'normalized_campaign', 'referer_domain', 'currency', 'signups', 'trials', 'conversions', 'revenue'))
+        self.assertEqual(rebuilt, incremental)
+
+    def trials_counted(self):
+        trialing = subscription_fixture('cus_funnel0')
+        trialing['status'] = 'trialing'
+        self.signup(0, None, 'launch')
+        self.post_event('customer.subscription.created', trialing)
+        # Redelivered by Stripe.
+        self.post_event('customer.subscription.created', trialing)
+        incremental = list(AcquisitionDaily.objects.values_list('trials', flat=True))
+        rebuild_funnel()
+        self.assertEqual(list(AcquisitionDaily.objects.values_list('trials', flat=True)), incremental)
+        return sum(incremental)
+
+    def test_trials_counted_at_signup(self):
+        self.assertEqual(self.trials_counted(), 1)
+
+    @override_settings(SAAS_ENABLE_TRIAL=False)
+    def test_trials_counted_from_stripe(self):
+        self.assertEqual(self.trials_counted(), 1)
+
+
+CHROME_MAC = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
+SAFARI_IPHONE = ('Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 '
+                 '(KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1')
+
+
+class UserAgentTestCase(TestCase):
+    def test_parse_user_agent(self):
+        self.assertEqual(parse_user_agent(CHROME_MAC), ('Chrome', 'macOS', 'desktop'))
+        self.assertEqual(parse_user_agent(SAFARI_IPHONE), ('Safari', 'iOS', 'mobile'))
+        self.assertEqual(parse_user_agent('Googlebot/2.1 (+http://www.google.com/bot.html)')[2], 'bot')
+        self.assertEqual(parse_user_agent(''), ('Other', 'Other', 'desktop'))
+
+    def test_intern_user_agent(self):
+        self.assertIsNone(intern_user_agent(None))
+        user_agent = intern_user_agent(SAFARI_IPHONE)
+        with self.assertNumQueries(1):
+            self.assertEqual(intern_user_agent(SAFARI_IPHONE), user_agent)
+        self.assertEqual(UserAgent.objects.count(), 1)
+
+    def test_backfill_and_conversions(self):
+        for i, agent in enumerate([CHROME_MAC, SAFARI_IPHONE, SAFARI_IPHONE, None]):
+            user = create_user(email=f'agent{i}@example.com', customer_id=f'cus_agent{i}')
+            Acquisition.objects.create(user=user, agent=agent)
+        Acquisition.objects.filter(user__email='agent1@example.com').update(converted_at='2024-01-01T00:00Z')
+
+        self.assertEqual(backfill_user_agents(batch_size=2), 3)
+        self.assertEqual(UserAgent.objects.count(), 2)
+        self.assertFalse(Acquisition.objects.exclude(agent=None).exists())
+        by_device = {row['user_agent__device']: row for row in conversions_by('device')}
+        self.assertEqual(by_device['mobile']['signups'], 2)
+        self.assertEqual(by_device['mobile']['conversions'], 1)
+        self.assertEqual(by_device['desktop']['conversions'], 0)
+        self.assertEqual(by_device[None]['signups'], 1)
+
+
+@override_settings(SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe', SAAS_USE_CHECKOUT=False)
+class OnboardingTestCase(TestCase):
+    def test_onboard_command(self):
+        records = [
+            {'email': f'onboard{i}@example.com', 'campaign': 'migration', 'user_agent': CHROME_MAC}
+            for i in range(5)
+        ] + [{'email': 'invalid'}, {'email': 'existing@example.com', 'customer_id': 'cus_existing'}]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            f.write('\n'.join(json.dumps(record) for record in records))
+        self.addCleanup(os.remove, f.name)
+
+        out = StringIO()
+        call_command('onboard_users', f.name, batch_size=2, concurrency=3, stdout=out, stderr=StringIO())
+        self.assertIn('6 users created', out.getvalue())
+        self.assertIn('5 Stripe customers created', out.getvalue())
+        self.assertIn('1 failed', out.getvalue())
+        self.assertEqual(StripeInfo.objects.get(user__email='existing@example.com').customer_id, 'cus_existing')
+        self.assertEqual(len(set(StripeInfo.objects.values_list('customer_id', flat=True))), 6)
+        self.assertEqual(Acquisition.objects.filter(normalized_campaign__name='migration').count(), 5)
+        self.assertEqual(UserAgent.objects.count(), 1)
+        self.assertEqual(AcquisitionDaily.objects.get(normalized_campaign__name='migration').signups, 5)
+
+    def test_resume(self):
+        records = [{'email': f'resume{i}@example.com'} for i in range(4)]
+        onboard(records[:2])
+        StripeInfo.objects.filter(user__email='resume1@example.com').delete()
+        customers = len(get_stripe().customers)
+        # Stripe forgets idempotency keys after 24 hours.
+        get_stripe().idempotency_keys.clear()
+
+        result = onboard(records, batch_size=3)
+        self.assertEqual((result.users_created, result.users_existing), (2, 2))
+        self.assertEqual(result.acquisitions_created, 2)
+        # The customer of resume1 is found again through its metadata.
+        self.assertEqual(len(get_stripe().customers), customers + 2)
+        self.assertEqual(
+            StripeInfo.objects.get(user__email='resume1@example.com').customer_id,
+            get_stripe().Customer.list(email='resume1@example.com')['data'][0]['id'],
+        )
+        self.assertEqual(StripeInfo.objects.count(), 4)
+        self.assertEqual(Acquisition.objects.count(), 4)
+
+    def test_username_collisions(self):
+        get_user_model().objects.create_user(username='taken', email='taken@example.com')
+        records = [
+            {'email': 'first@example.com', 'username': 'taken'},
+            {'email': 'second@example.com', 'username': 'twice'},
+            {'email': 'third@example.com', 'username': 'twice'},
+            {'email': 'fourth@example.com'},
+        ]
+        result = onboard(records, create_customers=False)
+        self.assertEqual(result.users_created, 2)
+        self.assertEqual([email for email, _ in result.failed], ['first@example.com', 'third@example.com'])
+        self.assertEqual(Acquisition.objects.count(), 2)
+
+        # Usernames taken between the check and the insert.
+        records = [{'email': 'fifth@example.com', 'username': 'taken'}, {'email': 'sixth@example.com'}]
+        with mock.patch.object(Onboarding, 'without_taken_usernames', lambda self, new_users: new_users):
+            result = onboard(records, create_customers=False)
+        self.assertEqual(result.users_created, 1)
+        self.assertEqual([email for email, _ in result.failed], ['fifth@example.com'])
+        self.assertTrue(get_user_model().objects.filter(email='sixth@example.com').exists())
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user(email='export@example.com', customer_id='cus_export')
+        for i in range(3):
+            BillingEvent.objects.create(
+                user=self.user, success=i != 1, stripe_object=json.dumps(invoice_fixture('cus_export', amount=100 * i)))
+            StripeEvent.objects.create(
+                event='invoice.paid', event_id=f'evt_{i}', object=json.dumps(invoice_fixture('cus_export')))
+        StripeEvent.objects.create(event='customer.created', object=json.dumps(customer_fixture('other@example.com', 'cus_other')))
+        # Recorded without their customer id, as before it was extracted when received.
+        self.assertEqual(index_events(batch_size=2), 4)
+        self.staff = create_user(email='finance@example.com', customer_id='cus_finance')
+        self.staff.user_permissions.add(*Permission.objects.filter(codename__in=['view_billingevent', 'view_stripeevent']))
+
+    def get(self, requester, dataset, **params):
+        request = RequestFactory().get('/export', params)
+        request.user = requester
+        response = ExportView.as_view()(request, dataset=dataset)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_billing_csv(self):
+        response, content = self.get(self.staff, 'billing', user='export@example.com', type='succeeded')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(content.decode('utf-8'))))
+        self.assertEqual([row['amount_paid'] for row in rows], ['0', '200'])
+        self.assertEqual(rows[0]['description'], '1 × Benchmark plan')
+
+    def test_events_jsonl_gzip(self):
+        response, content = self.get(self.staff, 'events', format='jsonl', gzip='1', user=str(self.user.pk))
+        rows = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual([row['event_id'] for row in rows], ['evt_0', 'evt_1', 'evt_2'])
+        self.assertEqual(rows[0]['object']['customer'], 'cus_export')
+
+    def test_events_jsonl_with_indented_payloads(self):
+        # str() of a stripe object, as the webhook stores it, is indented JSON.
+        invoice = stripe.StripeObject.construct_from(invoice_fixture('cus_export'), 'sk_test')
+        StripeEvent.objects.create(event='invoice.paid', event_id='evt_3', object=invoice, customer_id='cus_export')
+        response, content = self.get(self.staff, 'events', format='jsonl', user=str(self.user.pk))
+        rows = [json.loads(line) for line in content.decode('utf-8').splitlines()]
+        self.assertEqual([row['event_id'] for row in rows], ['evt_0', 'evt_1', 'evt_2', 'evt_3'])
+        self.assertEqual(rows[3]['object']['lines']['data'][0]['currency'], 'usd')
+
+    def test_errors(self):
+        self.assertEqual(self.get(self.staff, 'billing', start='yesterday')[0].status_code, 400)
+        with self.assertRaises(PermissionDenied):
+            self.get(self.user, 'billing')
+        self.assertEqual(self.get(AnonymousUser(), 'events')[0].status_code, 302)
+
+    def test_command_streams_in_chunks(self):
+        with self.assertNumQueries(1):
+            rows = list(BillingExport(chunk_size=1).rows())
+        self.assertEqual(len(rows), 3)
+        out = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        out.close()
+        self.addCleanup(os.remove, out.name)
+        call_command('export_billing', 'events', type=['customer.created'], output=out.name)
+        with open(out.name, encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(json.loads(rows[0]['object'])['id'], 'cus_other')
+
+
+class BillingHistoryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user(email='history@example.com', customer_id='cus_history')
+        for i in range(5):
+            BillingEvent.objects.create(user=self.user, stripe_object=json.dumps(invoice_fixture('cus_history', amount=i)))
+
+    def post_event(self, event_type, stripe_object):
+        payload = event_payload(event_type, stripe_object)
+        request = RequestFactory().post(
+            '/stripe', data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, BENCHMARK_ENDPOINT_SECRET),
+        )
+        self.assertEqual(StripeWebhook.as_view(endpoint_secret=BENCHMARK_ENDPOINT_SECRET)(request).status_code, 200)
+
+    def get_page(self, **params):
+        request = RequestFactory().get('/billing', params)
+        request.user = self.user
+        response = BillingHistoryView.as_view()(request)
+        return response.status_code, json.loads(response.content) if response.status_code == 200 else None
+
+    def test_keyset_pagination(self):
+        amounts = []
+        cursor = None
+        while True:
+            params = {'limit': 2} if cursor is None else {'limit': 2, 'cursor': cursor}
+            status, page = self.get_page(**params)
+            self.assertEqual(status, 200)
+            amounts.extend(row['amount_paid'] for row in page['results'])
+            cursor = page['next']
+            if cursor is None:
+                break
+        self.assertEqual(amounts, [4, 3, 2, 1, 0])
+        self.assertEqual(self.get_page(cursor='garbage')[0], 400)
+
+    def test_first_page_is_cached_until_billing_changes(self):
+        billing_history(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(billing_history(self.user)['results']), 5)
+        BillingEvent.objects.create(user=self.user, stripe_object=json.dumps(invoice_fixture('cus_history', amount=5)))
+        self.assertEqual(billing_history(self.user)['results'][0]['amount_paid'], 5)
+
+    def test_record_looks_up_the_invoice_id(self):
+        migration = import_module('saas.migrations.0024_billingevent_invoice_id')
+        migration.backfill_invoice_id(django_apps, mock.Mock(connection=connection))
+        self.assertEqual(BillingEvent.objects.filter(invoice_id='in_benchmark').count(), 5)
+        invoice = invoice_fixture('cus_history', amount=0)
+        with self.assertNumQueries(1):
+            self.assertFalse(BillingEvent.record(self.user, invoice)[1])
+        invoice['attempt_count'] = 2
+        billing, created = BillingEvent.record(self.user, invoice)
+        self.assertTrue(created)
+        self.assertEqual(billing.invoice_id, 'in_benchmark')
+        self.assertEqual(BillingEvent.record(self.user, invoice), (billing, False))
+
+    def test_subscription_view_reads_snapshot(self):
+        customer = customer_fixture('history@example.com', 'cus_history')
+        customer['sources'] = {'object': 'list', 'data': [
+            {'id': 'card_1', 'object': 'card', 'customer': 'cus_history', 'brand': 'Visa', 'last4': '4242'}]}
+        customer['default_source'] = 'card_1'
+        self.post_event('customer.updated', customer)
+        subscription = subscription_fixture('cus_history')
+        subscription['status'] = 'past_due'
+        self.post_event('customer.subscription.updated', subscription)
+
+        request = RequestFactory().get('/subscription')
+        request.user = self.user
+        view = SubscriptionView(paginate_by=3)
+        view.setup(request)
+        # cus_history does not exist in Stripe: any API call would fail.
+        with override_settings(SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe'):
+            context = view.get_context_data()
+        self.assertEqual(context['card'].last4, '4242')
+        self.assertEqual(context['subscription']['status'], 'past_due')
+        self.assertEqual(len(context['billing']), 3)
+        self.assertIsNotNone(context['billing_next'])
+
+        self.post_event('customer.subscription.deleted', subscription)
+        self.assertIsNone(CustomerSnapshot.objects.get(customer_id='cus_history').subscription)
+
+
+@override_settings(
+    ROOT_URLCONF='saas.tests',
+    SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+    SAAS_FAKE_STRIPE_WEBHOOK_URL='/stripe',
+    STRIPE_ENDPOINT_SECRET=BENCHMARK_ENDPOINT_SECRET,
+)
+class PaymentMethodTestCase(TestCase):
+    def test_update_payment_and_webhooks(self):
+        stripe = get_stripe()
+        user = create_user(email='card@example.com', customer_id=stripe.Customer.create(email='card@example.com')['id'])
+        request = RequestFactory().post('/update-payment', {'stripeToken': 'tok_visa'})
+        request.user = user
+        self.assertEqual(UpdatePaymentView.as_view(success_url='/')(request).status_code, 302)
+        card = PaymentMethod.default_for(user.stripeinfo.customer_id)
+        self.assertEqual((card.brand, card.last4, card.is_default), ('Visa', '4242', True))
+
+        self.assertEqual(set(stripe.deliver_events()), {200})
+        self.assertEqual(PaymentMethod.objects.count(), 1)
+        self.post_payment_method('payment_method.attached', {
+            'id': 'pm_1', 'object': 'payment_method', 'customer': user.stripeinfo.customer_id,
+            'card': {'brand': 'mastercard', 'last4': '4444', 'exp_month': 1, 'exp_year': 2030},
+        })
+        self.assertEqual(PaymentMethod.objects.get(payment_method_id='pm_1').exp_year, 2030)
+        self.post_payment_method('payment_method.detached', {'id': 'pm_1', 'object': 'payment_method', 'customer': None})
+        self.assertFalse(PaymentMethod.objects.filter(payment_method_id='pm_1').exists())
+
+    def post_payment_method(self, event_type, payment_method):
+        payload = event_payload(event_type, payment_method)
+        request = RequestFactory().post(
+            '/stripe', data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, BENCHMARK_ENDPOINT_SECRET),
+        )
+        self.assertEqual(StripeWebhook.as_view()(request).status_code, 200)
+
+
+PLAN_FEATURES = {
+    'plan_pro': {'features': ['export', 'api'], 'limits': {'projects': 50}},
+    'trial': {'features': ['export'], 'limits': {'projects': 5}},
+    'free': {'limits': {'projects': 1}},
+}
+
+
+@override_settings(SAAS_PLAN_FEATURES=PLAN_FEATURES, SAAS_UPGRADE_URL='/upgrade', SAAS_IS_STAFF_SUBSCRIBED=False)
+class EntitlementsTestCase(WebhookTestMixin, TestCase):
+    def setUp(self):
+        self.user = create_user(email='features@example.com', customer_id='cus_features')
+
+    def subscribe(self, plan_id):
+        StripeInfo.objects.filter(user=self.user).update(
+            plan_id=plan_id, subscription_end=timezone.now() + timedelta(days=30))
+        self.user = type(self.user).objects.select_related('stripeinfo').get(pk=self.user.pk)
+
+    def test_customer_entitlements(self):
+        customer = Customer.of(self.user)
+        self.assertEqual(customer.plan_key, 'trial')
+        self.assertTrue(customer.has_feature('export'))
+        self.assertFalse(customer.has_feature('api'))
+        self.assertEqual(customer.limit('projects'), 5)
+
+        self.subscribe('plan_pro')
+        customer = Customer.of(self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(customer.has_feature('api'))
+            self.assertEqual(customer.limit('projects'), 50)
+            self.assertIsNone(customer.limit('seats'))
+
+        self.user.date_joined = timezone.now() - timedelta(days=365)
+        self.user.stripeinfo.subscription_end = None
+        self.assertEqual(Customer.of(self.user).limit('projects'), 1)
+
+    def test_feature_required(self):
+        view = feature_required('api')(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.assertEqual(view(request)['Location'], '/upgrade')
+        self.subscribe('plan_pro')
+        request.user = self.user
+        self.assertEqual(view(request).status_code, 200)
+
+    @override_settings(
+        SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+        SAAS_PLAN_FEATURES={},
+        SAAS_PLAN_FEATURES_FROM_STRIPE=True,
+        SAAS_FAKE_STRIPE_PLANS=[
+            {'id': 'plan_team', 'metadata': {'features': 'api, sso', 'limit_seats': '25'}},
+            {'id': 'plan_solo'},
+        ],
+    )
+    def test_sync_from_stripe_metadata(self):
+        out = StringIO()
+        call_command('sync_plan_features', stdout=out)
+        self.assertIn('2 plans', out.getvalue())
+        self.subscribe('plan_team')
+        customer = Customer.of(self.user)
+        self.assertTrue(customer.has_feature('sso'))
+        self.assertEqual(customer.limit('seats'), 25)
+
+    @override_settings(
+        SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+        SAAS_PLAN_FEATURES={},
+        SAAS_PLAN_FEATURES_FROM_STRIPE=True,
+        SAAS_FAKE_STRIPE_PLANS=[{'id': 'plan_team', 'metadata': {'features': 'sso'}}],
+        SAAS_STRIPE_TENANTS={'brand': {'secret_key': 'sk_brand'}},
+    )
+    def test_sync_is_scoped_to_the_tenant(self):
+        PlanEntitlement.objects.create(tenant='brand', plan_id='plan_solo')
+        self.assertEqual(sync_plan_features(), 1)
+        self.assertEqual(
+            sorted(PlanEntitlement.objects.values_list('tenant', 'plan_id')),
+            [('', 'plan_team'), ('brand', 'plan_solo')],
+        )
+        out = StringIO()
+        call_command('sync_plan_features', stdout=out)
+        self.assertIn('1 plans of tenant brand', out.getvalue())
+        PlanEntitlement.objects.filter(tenant='brand').update(features='[]')
+        self.subscribe('plan_team')
+        self.assertTrue(Customer.of(self.user).has_feature('sso'))
+        StripeInfo.objects.filter(user=self.user).update(tenant='brand')
+        self.subscribe('plan_team')
+        self.assertFalse(Customer.of(self.user).has_feature('sso'))
+
+    @override_settings(
+        SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+        SAAS_PLAN_FEATURES={},
+        SAAS_PLAN_FEATURES_FROM_STRIPE=True,
+        SAAS_FAKE_STRIPE_PLANS=[
+            {'id': 'plan_team', 'metadata': {'features': 'sso'}},
+            {'id': 'plan_other', 'product': 'prod_other'},
+        ],
+    )
+    def test_webhooks_sync_one_plan(self):
+        PlanEntitlement.objects.create(plan_id='plan_kept')
+        with mock.patch('saas.entitlements._list_plans', wraps=_list_plans) as list_plans:
+            self.post_event('plan.created', {'id': 'plan_team', 'object': 'plan', 'product': 'prod_fake'})
+            list_plans.assert_not_called()
+            self.assertEqual(sorted(PlanEntitlement.objects.values_list('plan_id', flat=True)), ['plan_kept', 'plan_team'])
+            self.post_event('product.updated', {'id': 'prod_fake', 'object': 'product', 'metadata': {'limit_seats': '5'}})
+            list_plans.assert_called_once_with(product='prod_fake')
+        self.subscribe('plan_team')
+        self.assertEqual(Customer.of(self.user).limit('seats'), 5)
+        self.assertTrue(Customer.of(self.user).has_feature('sso'))
+        self.post_event('plan.deleted', {'id': 'plan_team', 'object': 'plan', 'product': 'prod_fake'})
+        self.assertEqual(list(PlanEntitlement.objects.values_list('plan_id', flat=True)), ['plan_kept'])
+
+
+@override_settings(
+    SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+    SAAS_FAKE_STRIPE_PLANS=[{'id': 'plan_base'}, {'id': 'price_api_calls'}],
+    SAAS_USAGE_METRICS={'api_calls': 'price_api_calls'},
+    SAAS_USAGE_BUFFER_SECONDS=0,
+)
+class UsageTestCase(TestCase):
+    def setUp(self):
+        stripe = get_stripe()
+        # FakeStripe lives as long as the process.
+        stripe.usage_records.clear()
+        stripe.meter_events.clear()
+        self.user = create_user(email='usage@example.com', customer_id=stripe.Customer.create(email='usage@example.com')['id'])
+        subscription = stripe.Subscription.create(
+            customer=self.user.stripeinfo.customer_id, items=[{'plan': 'plan_base'}, {'plan': 'price_api_calls'}])
+        StripeInfo.objects.filter(user=self.user).update(subscription_id=subscription['id'])
+        self.subscription_id = subscription['id']
+        self.item_id = subscription['items']['data'][1]['id']
+        self.free_user = create_user(email='free@example.com', customer_id='cus_free')
+
+    def test_record_usage_is_buffered(self):
+        with self.assertNumQueries(0):
+            for _ in range(100):
+                record_usage(self.user, 'api_calls')
+        with override_settings(SAAS_USAGE_BUFFER_SIZE=2):
+            record_usage(self.user, 'api_calls', 5, timestamp=time.time() - 7200)
+        self.assertEqual(sorted(UsageRecord.objects.values_list('quantity', flat=True)), [5, 100])
+
+    def test_report_usage(self):
+        stripe = get_stripe()
+        for _ in range(3):
+            record_usage(self.user, 'api_calls', 2)
+        record_usage(self.free_user, 'api_calls')
+        report = report_usage()
+        self.assertEqual((report.reported, report.skipped, report.failed), (1, 1, []))
+        self.assertEqual([(r['subscription_item'], r['quantity']) for r in stripe.usage_records], [(self.item_id, 6)])
+
+        record_usage(self.user, 'api_calls', 4)
+        flush_usage_buffer()
+        # A report interrupted before saving its progress is sent again with the same key.
+        UsageRecord.objects.filter(user=self.user).update(reported_quantity=6)
+        report_usage()
+        UsageRecord.objects.filter(user=self.user).update(reported_quantity=6, needs_report=True)
+        report_usage()
+        self.assertEqual([r['quantity'] for r in stripe.usage_records], [6, 4])
+        self.assertFalse(UsageRecord.objects.filter(needs_report=True).exists())
+
+        # Progress lost after Stripe accepted the usage, and more usage recorded meanwhile.
+        UsageRecord.objects.filter(user=self.user).update(reported_quantity=6, reporting_quantity=10, needs_report=True)
+        record_usage(self.user, 'api_calls', 3)
+        flush_usage_buffer()
+        report_usage()
+        report_usage()
+        self.assertEqual([r['quantity'] for r in stripe.usage_records], [6, 4, 3])
+        self.assertEqual(UsageRecord.objects.get(user=self.user).reported_quantity, 13)
+
+    def test_members_usage_is_billed_to_the_organization(self):
+        stripe = get_stripe()
+        organization = Organization.create_for(self.user, 'Team', seats=2)
+        organization.add_member(self.free_user)
+        record_usage(self.free_user, 'api_calls', 5)
+        report = report_usage()
+        self.assertEqual((report.reported, report.skipped), (1, 0))
+        self.assertEqual([(r['subscription_item'], r['quantity']) for r in stripe.usage_records], [(self.item_id, 5)])
+
+    @override_settings(SAAS_USAGE_METERS={'api_calls': 'api_calls'})
+    def test_report_meter_events(self):
+        stripe = get_stripe()
+        record_usage(self.user, 'api_calls', 2)
+        self.assertEqual(report_usage().reported, 1)
+        # Progress lost after Stripe accepted the meter event.
+        UsageRecord.objects.filter(user=self.user).update(reported_quantity=0, reporting_quantity=2, needs_report=True)
+        report_usage()
+        self.assertEqual(
+            [(e['event_name'], e['payload']['stripe_customer_id'], e['payload']['value']) for e in stripe.meter_events.values()],
+            [('api_calls', self.user.stripeinfo.customer_id, '2')],
+        )
+        self.assertEqual(stripe.usage_records, [])
+
+    def test_report_with_the_stripe_package(self):
+        subscription = get_stripe().Subscription.retrieve(self.subscription_id)
+        record_usage(self.user, 'api_calls', 2)
+        flush_usage_buffer()
+        # patch.object fails when the stripe package does not have the method report_usage calls.
+        with mock.patch('saas.usage.get_stripe', return_value=stripe), \
+                mock.patch.object(stripe.Subscription, 'retrieve', return_value=subscription), \
+                mock.patch.object(stripe.billing.MeterEvent, 'create') as create:
+            if not hasattr(stripe.SubscriptionItem, 'create_usage_record'):
+                with self.assertLogs('saas', 'ERROR'):
+                    report = report_usage()
+                self.assertEqual(len(report.failed), 1)
+                self.assertIn('SAAS_USAGE_METERS', report.failed[0][1])
+            with override_settings(SAAS_USAGE_METERS={'api_calls': 'api_calls'}):
+                report = report_usage()
+        self.assertEqual((report.reported, report.failed), (1, []))
+        record_id = UsageRecord.objects.get(user=self.user).id
+        create.assert_called_once_with(
+            event_name='api_calls',
+            payload={'stripe_customer_id': self.user.stripeinfo.customer_id, 'value': '2'},
+            identifier=f'saas-usage-{record_id}-2',
+            timestamp=mock.ANY,
+        )
+
+
+class OrganizationTestCase(WebhookTestMixin, TestCase):
+    def setUp(self):
+        self.owner = create_user(email='owner@example.com', customer_id='cus_team')
+        self.organization = Organization.create_for(self.owner, 'Team')
+
+    def test_seats_and_membership(self):
+        subscription = subscription_fixture('cus_team')
+        subscription['quantity'] = 3
+        self.post_event('customer.subscription.created', subscription)
+        self.organization.refresh_from_db()
+        self.assertEqual(self.organization.seats, 3)
+
+        members = [create_user(email=f'member{i}@example.com', customer_id=f'cus_member{i}') for i in range(3)]
+        self.organization.add_member(members[0])
+        self.organization.add_member(members[1])
+        with self.assertRaises(SeatLimitExceeded):
+            self.organization.add_member(members[2])
+
+        member = type(members[0]).objects.select_related('stripeinfo').get(pk=members[0].pk)
+        member.date_joined = timezone.now() - timedelta(days=365)
+        with self.assertNumQueries(1):
+            self.assertTrue(Customer.of(member).actively_subscribed)
+            self.assertTrue(Customer.of(member).subscribed)
+        outsider = type(members[2]).objects.select_related('stripeinfo').get(pk=members[2].pk)
+        outsider.date_joined = member.date_joined
+        self.assertFalse(Customer.of(outsider).subscribed)
+
+
+class RateLimitTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sliding_window(self):
+        self.assertTrue(all(hit('test', 'client', 3, 60, now=1000 + i) for i in range(3)))
+        self.assertFalse(hit('test', 'client', 3, 60, now=1010))
+        self.assertTrue(hit('test', 'other', 3, 60, now=1010))
+        # Half of the previous window still counts.
+        self.assertTrue(hit('test', 'client', 3, 60, now=1050))
+        self.assertFalse(hit('test', 'client', 3, 60, now=1051))
+        self.assertTrue(hit('test', 'client', 3, 60, now=1200))
+
+    @override_settings(SAAS_RATE_LIMITS={'register': {'ip': None, 'email_domain': (2, 3600)}})
+    def test_email_domain(self):
+        def register(email):
+            return check_rate_limits('register', RequestFactory().post('/'), email=email)
+        self.assertEqual([register(f'{i}@spam.example') for i in range(3)], [True, True, False])
+        self.assertTrue(register('someone@example.com'))
+
+    @override_settings(SAAS_RATE_LIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_client_ip_ignores_spoofed_addresses(self):
+        request = RequestFactory().get('/', HTTP_X_FORWARDED_FOR='1.2.3.4, 10.0.0.7', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(client_ip(request), '10.0.0.7')
+        with override_settings(SAAS_RATE_LIMIT_TRUSTED_PROXIES=2):
+            request = RequestFactory().get('/', HTTP_X_FORWARDED_FOR='1.2.3.4, 10.0.0.7, 10.1.0.1')
+            self.assertEqual(client_ip(request), '10.0.0.7')
+            request = RequestFactory().get('/', HTTP_X_FORWARDED_FOR='10.0.0.7')
+            self.assertEqual(client_ip(request), '10.0.0.7')
+        self.assertEqual(client_ip(RequestFactory().get('/', REMOTE_ADDR='10.0.0.1')), '10.0.0.1')
+
+    @override_settings(SAAS_RATE_LIMITS={'register': {'ip': (0, 60)}, 'activate': {'ip': (0, 60)}})
+    def test_views_are_limited_before_any_work(self):
+        request = RequestFactory().post('/register', {'email': 'bot@example.com'}, REMOTE_ADDR='10.0.0.1')
+        # SimpleTestCase fails on any database query.
+        self.assertEqual(RegisterView.as_view()(request).status_code, 429)
+        request = RequestFactory().get('/activate', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(ActivateView.as_view()(request, uidb64='MQ', token='bad').status_code, 429)
+
+
+@override_settings(SAAS_EVENTS_DATABASE='events', SAAS_SUBSCRIPTION_READ_DATABASE='replica')
+class RouterTestCase(TestCase):
+    def setUp(self):
+        self.router = SaasRouter()
+        self.user = create_user(email='router@example.com', customer_id='cus_router')
+        cache.clear()
+
+    def test_events_database(self):
+        self.assertEqual(self.router.db_for_write(StripeEvent), 'events')
+        self.assertIsNone(self.router.db_for_read(BillingEvent))
+        self.assertIsNone(self.router.db_for_read(Organization))
+        with override_settings(SAAS_EVENTS_MODELS=['stripeevent', 'billingevent']):
+            self.assertEqual(self.router.db_for_write(BillingEvent), 'events')
+        self.assertTrue(self.router.allow_migrate('events', 'saas', 'stripeevent'))
+        self.assertFalse(self.router.allow_migrate('default', 'saas', 'stripeevent'))
+        self.assertFalse(self.router.allow_migrate('events', 'saas', 'billingevent'))
+        self.assertIsNone(self.router.allow_migrate('default', 'saas', 'billingevent'))
+        self.assertIsNone(self.router.allow_migrate('events', 'auth', 'user'))
+
+    def test_read_your_writes(self):
+        self.assertEqual(self.router.db_for_read(StripeInfo, instance=self.user), 'replica')
+        self.assertEqual(self.router.db_for_write(StripeInfo, instance=self.user.stripeinfo), 'default')
+        with pin_primary():
+            self.assertEqual(self.router.db_for_read(StripeInfo), 'default')
+        self.assertEqual(self.router.db_for_read(StripeInfo), 'replica')
+
+        self.user.stripeinfo.save()
+        self.assertEqual(self.router.db_for_read(StripeInfo, instance=self.user), 'default')
+        self.assertEqual(self.router.db_for_read(StripeInfo, instance=self.user.stripeinfo), 'default')
+        other = create_user(email='other@example.com', customer_id='cus_other')
+        cache.delete(sticky_key(other.pk))
+        self.assertEqual(self.router.db_for_read(StripeInfo, instance=other), 'replica')
+
+
+@skipUnless('events' in settings.DATABASES, 'Needs an events database alias')
+@override_settings(SAAS_EVENTS_DATABASE='events', DATABASE_ROUTERS=['saas.routers.SaasRouter'])
+class EventsDatabaseTestCase(WebhookTestMixin, TestCase):
+    databases = {'default', 'events'}
+
+    def test_payment_webhooks(self):
+        user = create_user(email='events@example.com', customer_id='cus_events')
+        self.post_event('invoice.payment_succeeded', invoice_fixture('cus_events'))
+        self.post_event('invoice.payment_failed', invoice_fixture('cus_events', invoice_id='in_failed'), sequence=1)
+        self.assertEqual(StripeEvent.objects.using('events').count(), 2)
+        self.assertFalse(StripeEvent.objects.using('default').exists())
+        self.assertEqual(BillingEvent.objects.using('default').filter(user=user).count(), 2)
+        self.assertEqual(StripeEvent.objects.filter(processed_at=None).count(), 0)
+
+
+@override_settings(
+    STORAGES={'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'}},
+    SAAS_BILLING_TIMEZONE='UTC',
+)
+class ReceiptTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user(email='receipt@example.com', customer_id='cus_receipt')
+        invoice = invoice_fixture('cus_receipt')
+        invoice['created'] = 1700000000
+        self.billing = BillingEvent.objects.create(user=self.user, stripe_object=json.dumps(invoice))
+
+    def test_rendered_once(self):
+        with mock.patch('saas.receipts.render_receipt', wraps=render_receipt) as render:
+            pdf = receipt(self.billing, 'pdf')
+            self.assertEqual(receipt(self.billing, 'pdf'), pdf)
+            html = receipt(self.billing, 'html').decode('utf-8')
+        self.assertEqual(render.call_count, 2)
+        self.assertTrue(pdf.startswith(b'%PDF-1.4') and pdf.rstrip().endswith(b'%%EOF'))
+        self.assertIn(b'(Date: November 14, 2023) Tj', pdf)
+        self.assertIn('receipt@example.com', html)
+        self.assertEqual(self.billing.date.utcoffset(), timedelta(0))
+
+    def test_storage_without_storages(self):
+        # Django < 4.2 has no STORAGES.
+        with mock.patch('saas.receipts.storages', None):
+            self.assertIs(receipt_storage(), default_storage)
+
+    def test_view_checks_owner_and_caches(self):
+        request = RequestFactory().get('/receipt')
+        request.user = self.user
+        response = ReceiptView.as_view()(request, billing_id=self.billing.id)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+        request.user = create_user(email='someone@example.com', customer_id='cus_someone')
+        with self.assertRaises(Http404):
+            ReceiptView.as_view()(request, billing_id=self.billing.id)
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', BENCHMARK_TEMPLATES)]},
+    }])
+    def test_attached_to_payment_succeeded_email(self):
+        webhook = StripeWebhook(
+            payment_succeeded_subject_template_name='saas/benchmark/subject.txt',
+            payment_succeeded_email_template_name='saas/benchmark/email.txt',
+        )
+        request = RequestFactory().post('/stripe', HTTP_HOST='example.com')
+        webhook.on_payment_succeeded(request, self.user, self.billing, self.billing.stripe)
+        name, content, content_type = mail.outbox[-1].attachments[0]
+        self.assertEqual((name, content_type), ('receipt-in_benchmark.pdf', 'application/pdf'))
+        self.assertEqual(content, receipt(self.billing, 'pdf'))
+
+
+@override_settings(TEMPLATES=[{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'subscription/billing.html': '{{ billing.invoice }} {{ billing.user.email }}',
+    })]},
+}])
+class BillingViewTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user(email='bill@example.com', customer_id='cus_bill')
+        self.billing = BillingEvent.objects.create(user=self.user, stripe_object=json.dumps(invoice_fixture('cus_bill')))
+
+    def get(self, user, **headers):
+        request = RequestFactory().get('/billing', headers=headers)
+        request.user = user
+        return BillingView.as_view()(request, billing_id=self.billing.id)
+
+    def test_conditional_get(self):
+        with self.assertNumQueries(1):
+            response = self.get(self.user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'in_benchmark bill@example.com')
+        self.assertIn('private', response['Cache-Control'])
+        etag = response['ETag']
+
+        # A signed ETag of the same user only needs modified_at to be checked.
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(self.user, if_none_match=etag).status_code, 304)
+        with self.assertNumQueries(1):
+            response = self.get(self.user, if_modified_since=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.get(self.user, if_none_match=etag.replace(':', ';', 1)).status_code, 200)
+
+        other = create_user(email='other@example.com', customer_id='cus_other')
+        with self.assertRaises(Http404):
+            self.get(other, if_none_match=etag)
+        with self.assertRaises(Http404):
+            self.get(AnonymousUser())
+
+    def test_modified_bill_is_sent_again(self):
+        etag = self.get(self.user)['ETag']
+        BillingEvent.objects.filter(pk=self.billing.pk).update(modified_at=timezone.now() + timedelta(seconds=5))
+        response = self.get(self.user, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(
+    SAAS_DUNNING_SCHEDULE=[1, 3],
+    SAAS_DUNNING_GRACE_DAYS=7,
+    SAAS_DUNNING_SUBJECT_TEMPLATE='saas/benchmark/subject.txt',
+    SAAS_DUNNING_EMAIL_TEMPLATE='saas/benchmark/email.txt',
+    TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', BENCHMARK_TEMPLATES)]},
+    }],
+)
+class DunningTestCase(WebhookTestMixin, TestCase):
+    def setUp(self):
+        self.user = create_user(email='dunning@example.com', customer_id='cus_dunning')
+
+    def test_grace_period_and_reminders(self):
+        self.assertFalse(Customer.of(self.user).actively_subscribed)
+        self.post_event('invoice.payment_failed', invoice_fixture('cus_dunning'))
+        dunning = Dunning.objects.get(user=self.user)
+        user = type(self.user).objects.get(pk=self.user.pk)
+        self.assertTrue(Customer.of(user).actively_subscribed)
+        self.assertEqual(user.stripeinfo.grace_until, dunning.grace_until)
+        # Failing again does not restart the schedule.
+        self.post_event('invoice.payment_failed', invoice_fixture('cus_dunning'))
+        self.assertEqual(Dunning.objects.get(user=self.user).failed_at, dunning.failed_at)
+
+        mail.outbox = []
+        self.assertEqual(run_dunning(now=dunning.failed_at + timedelta(hours=12)).reminded, 0)
+        # Late: only the second reminder is sent.
+        report = run_dunning(now=dunning.failed_at + timedelta(days=4))
+        self.assertEqual((report.reminded, report.expired), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        dunning.refresh_from_db()
+        self.assertEqual((dunning.step, dunning.next_action_at), (2, dunning.grace_until))
+        report = run_dunning(now=dunning.failed_at + timedelta(days=8))
+        self.assertEqual((report.reminded, report.expired), (0, 1))
+        self.assertEqual(Dunning.objects.get(user=self.user).status, Dunning.EXPIRED)
+
+        self.post_event('invoice.payment_failed', invoice_fixture('cus_dunning', invoice_id='in_next'))
+        self.post_event('invoice.payment_succeeded', invoice_fixture('cus_dunning', invoice_id='in_next'))
+        self.assertEqual(Dunning.objects.get(user=self.user).status, Dunning.RESOLVED)
+        self.assertIsNone(StripeInfo.objects.get(user=self.user).grace_until)
+
+    def test_batches_share_one_connection(self):
+        failed_at = timezone.now() - timedelta(days=2)
+        for i in range(25):
+            user = create_user(email=f'due{i}@example.com', customer_id=f'cus_due{i}')
+            Dunning.objects.create(user=user, failed_at=failed_at, next_action_at=failed_at + timedelta(days=1))
+        mail.outbox = []
+        with mock.patch('saas.dunning.get_connection', wraps=mail.get_connection) as get_connection:
+            report = run_dunning(batch_size=10)
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual((report.reminded, len(mail.outbox)), (25, 25))
+        self.assertFalse(Dunning.objects.filter(next_action_at__lte=timezone.now()).exists())
+
+
+@override_settings(
+    SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe',
+    SAAS_STRIPE_TENANTS={'brand': {'secret_key': 'sk_brand', 'endpoint_secret': 'whsec_brand', 'account': 'acct_brand'}},
+    SAAS_STRIPE_ACCOUNT_HEADER='X-Stripe-Account',
+)
+class TenantTestCase(TestCase):
+    def post_event(self, event_type, stripe_object, secret, headers=None, **kwargs):
+        payload = event_payload(event_type, stripe_object)
+        request = RequestFactory().post(
+            '/stripe', data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, secret), headers=headers or {},
+        )
+        return StripeWebhook.as_view()(request, **kwargs).status_code
+
+    def test_api_key_of_tenant(self):
+        stripe = get_stripe()
+        with mock.patch.object(stripe.Customer, 'create') as create:
+            with use_tenant('brand'):
+                get_stripe().Customer.create(email='brand@example.com')
+            create.assert_called_once_with(email='brand@example.com', api_key='sk_brand')
+            get_stripe().Customer.create(email='default@example.com')
+            create.assert_called_with(email='default@example.com')
+        with self.assertRaises(ValueError):
+            with use_tenant('unknown'):
+                pass
+
+    def test_webhook_secret_and_scoping(self):
+        default = create_user(email='default@example.com', customer_id='cus_shared')
+        brand = create_user(email='brand@example.com', customer_id='cus_shared')
+        StripeInfo.objects.filter(user=brand).update(tenant='brand')
+        subscription = subscription_fixture('cus_shared')
+
+        self.assertEqual(self.post_event('customer.subscription.updated', subscription, 'whsec_brand', tenant='brand'), 200)
+        self.assertEqual(StripeInfo.objects.get(user=brand).subscription_id, subscription['id'])
+        self.assertIsNone(StripeInfo.objects.get(user=default).subscription_id)
+
+        self.assertEqual(self.post_event('customer.subscription.updated', subscription, 'whsec_test', tenant='brand'), 400)
+        self.assertEqual(self.post_event('customer.subscription.updated', subscription, 'whsec_brand'), 400)
+        self.assertEqual(self.post_event('customer.subscription.updated', subscription, 'whsec_brand',
+                                         headers={'X-Stripe-Account': 'acct_brand'}), 200)
+        self.assertEqual(self.post_event('customer.subscription.updated', subscription, 'whsec_brand', tenant='other'), 404)
+
+    def test_events_are_replayed_within_their_tenant(self):
+        default = create_user(email='default@example.com', customer_id='cus_shared')
+        brand = create_user(email='brand@example.com', customer_id='cus_shared')
+        StripeInfo.objects.filter(user=brand).update(tenant='brand')
+        self.assertEqual(self.post_event(
+            'customer.subscription.updated', subscription_fixture('cus_shared'), 'whsec_brand', tenant='brand'), 200)
+        self.assertEqual(StripeEvent.objects.get().tenant, 'brand')
+        StripeInfo.objects.update(subscription_id=None)
+        replay_events(StripeEvent.objects.all(), StripeWebhook, workers=1)
+        self.assertEqual(StripeInfo.objects.get(user=brand).subscription_id, 'sub_benchmark')
+        self.assertIsNone(StripeInfo.objects.get(user=default).subscription_id)
+
+
+def paid_subscription(customer_id, plan_id, amount, interval='month', status='active'):
+    subscription = subscription_fixture(customer_id)
+    subscription['status'] = status
+    subscription['plan'] = {'id': plan_id, 'object': 'plan', 'amount': amount, 'currency': 'usd', 'interval': interval}
+    return subscription
+
+
+class RevenueTestCase(WebhookTestMixin, TestCase):
+    def setUp(self):
+        self.user = create_user(email='revenue@example.com', customer_id='cus_revenue')
+
+    def test_subscription_mrr(self):
+        self.assertEqual(subscription_mrr(paid_subscription('cus_revenue', 'plan_yearly', 12000, 'year')), (1000, 'usd'))
+        subscription = paid_subscription('cus_revenue', 'plan_seats', 500)
+        subscription['items'] = {'data': [{'price': {'unit_amount': 500, 'currency': 'eur', 'recurring': {
+            'interval': 'week', 'interval_count': 1}}, 'quantity': 3}]}
+        subscription['currency'] = 'eur'
+        self.assertEqual(subscription_mrr(subscription), (6429, 'eur'))
+
+    def test_webhooks_record_history(self):
+        self.post_event('customer.subscription.created', paid_subscription('cus_revenue', 'plan_basic', 1000, status='trialing'))
+        self.assertFalse(SubscriptionPeriod.objects.exists())
+        for _ in range(2):
+            self.post_event('customer.subscription.updated', paid_subscription('cus_revenue', 'plan_basic', 1000))
+        period = SubscriptionPeriod.objects.get(user=self.user)
+        self.assertEqual((period.plan_id, period.mrr, period.ended_at), ('plan_basic', 1000, None))
+        self.post_event('customer.subscription.deleted', paid_subscription('cus_revenue', 'plan_basic', 1000))
+        self.assertIsNotNone(SubscriptionPeriod.objects.get(user=self.user).ended_at)
+        daily = RevenueDaily.objects.get(currency='usd')
+        self.assertEqual((daily.mrr_change, daily.new, daily.churned), (0, 1, 1))
+
+    def test_daily_metrics_and_rebuild(self):
+        other = create_user(email='other@example.com', customer_id='cus_other')
+        start = timezone.now() - timedelta(days=10)
+        record_subscription(self.user.pk, paid_subscription('cus_revenue', 'plan_basic', 1000), at=start)
+        record_subscription(other.pk, paid_subscription('cus_other', 'plan_basic', 1000), at=start)
+        # Upgrade, then a renewal that changes nothing.
+        record_subscription(self.user.pk, paid_subscription('cus_revenue', 'plan_pro', 3000), at=start + timedelta(days=2))
+        record_subscription(self.user.pk, paid_subscription('cus_revenue', 'plan_pro', 3000), at=start + timedelta(days=3))
+        record_subscription(other.pk, None, at=start + timedelta(days=4))
+        record_subscription(other.pk, paid_subscription('cus_other', 'plan_pro', 3000), at=start + timedelta(days=6))
+        self.assertEqual(SubscriptionPeriod.objects.filter(ended_at=None).count(), 2)
+
+        rows = revenue(timezone.localdate(start), timezone.localdate())
+        self.assertEqual(
+            [(row['mrr'], row['new'], row['churned'], row['reactivated']) for row in rows],
+            [(2000, 2, 0, 0), (4000, 0, 0, 0), (3000, 0, 1, 0), (6000, 0, 0, 1)],
+        )
+        self.assertEqual(revenue(timezone.localdate(start + timedelta(days=5)), timezone.localdate())[0]['mrr'], 6000)
+
+        incremental = sorted(RevenueDaily.objects.values_list('day', 'currency', 'mrr_change', 'new', 'churned', 'reactivated'))
+        out = StringIO()
+        call_command('rebuild_revenue', stdout=out)
+        self.assertIn('Rebuilt 4 revenue rows', out.getvalue())
+        rebuilt = sorted(RevenueDaily.objects.values_list('day', 'currency', 'mrr_change', 'new', 'churned', 'reactivated'))
+        self.assertEqual(rebuilt, incremental)
+
+    def test_backfill_from_snapshots(self):
+        subscription = paid_subscription('cus_revenue', 'plan_basic', 1000)
+        StripeInfo.objects.filter(user=self.user).update(subscription_id=subscription['id'])
+        CustomerSnapshot.sync_with_subscription(subscription)
+        self.assertEqual(rebuild_revenue(backfill=True), 1)
+        self.assertEqual(RevenueDaily.objects.get().new, 1)
+        self.assertEqual(rebuild_revenue(backfill=True), 1)
+        self.assertEqual(SubscriptionPeriod.objects.count(), 1)
+
+
+class WebhookHealthTestCase(WebhookTestMixin, TestCase):
+    def setUp(self):
+        self.user = create_user(email='health@example.com', customer_id='cus_health')
+        cache.clear()
+
+    def test_processing_is_recorded(self):
+        self.post_event('invoice.upcoming', invoice_fixture('cus_health'))
+        event = StripeEvent.objects.get()
+        self.assertFalse(event.failed)
+        self.assertIsNotNone(event.stripe_created_at)
+        self.assertGreaterEqual(event.processed_at, event.created_at)
+
+        with mock.patch.object(StripeWebhook, 'on_invoice_incoming', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.post_event('invoice.upcoming', invoice_fixture('cus_health'))
+        self.assertEqual(StripeEvent.objects.filter(failed=True).count(), 1)
+
+    def test_redelivery_marks_crashed_deliveries(self):
+        StripeEvent.objects.create(event_id='evt_benchmark_0', event='invoice.upcoming', object='{}')
+        StripeEvent.objects.create(event_id='evt_other', event='invoice.upcoming', object='{}')
+        self.post_event('invoice.upcoming', invoice_fixture('cus_health'))
+        self.assertEqual(
+            list(StripeEvent.objects.filter(processed_at=None).values_list('event_id', flat=True)), ['evt_other'])
+
+    def test_health(self):
+        now = timezone.now()
+        for i in range(3):
+            StripeEvent.objects.create(event='invoice.upcoming', object='{}', stripe_created_at=now - timedelta(seconds=10),
+                                       processed_at=now, failed=i == 0)
+        stuck = StripeEvent.objects.create(event='customer.updated', object='{}')
+        StripeEvent.objects.filter(pk=stuck.pk).update(created_at=now - timedelta(seconds=30))
+        StripeEvent.objects.create(event='customer.updated', object='{}', processed_at=now - timedelta(hours=1))
+        StripeEvent.objects.filter(processed_at__lt=now - timedelta(minutes=30)).update(created_at=now - timedelta(hours=1))
+
+        with override_settings(SAAS_WEBHOOK_HEALTH_WINDOW=60):
+            with self.assertNumQueries(3):
+                health = webhook_health(now=now)
+        self.assertAlmostEqual(health['oldest_unprocessed_seconds'], 30, delta=1)
+        self.assertEqual(health['events_per_minute'], {'customer.updated': 1, 'invoice.upcoming': 3})
+        self.assertEqual(health['failures'], {'invoice.upcoming': 1})
+        self.assertAlmostEqual(health['lag_seconds']['average'], 10, delta=1)
+        self.assertAlmostEqual(health['lag_seconds']['max'], 10, delta=1)
+
+    def test_view_requires_access(self):
+        request = RequestFactory().get('/health')
+        request.user = AnonymousUser()
+        with self.assertRaises(PermissionDenied):
+            WebhookHealthView.as_view()(request)
+        request.user = self.user
+        with self.assertRaises(PermissionDenied):
+            WebhookHealthView.as_view()(request)
+
+    @override_settings(SAAS_METRICS_TOKEN='metrics-token')
+    def test_view_is_cached(self):
+        request = RequestFactory().get('/health', HTTP_AUTHORIZATION='Bearer metrics-token')
+        self.assertEqual(json.loads(WebhookHealthView.as_view()(request).content)['oldest_unprocessed_seconds'], 0)
+        StripeEvent.objects.create(event='customer.updated', object='{}')
+        with self.assertNumQueries(0):
+            response = WebhookHealthView.as_view()(request)
+        self.assertEqual(json.loads(response.content), cached_webhook_health())
+
+
+@override_settings(SAAS_STRIPE_BACKEND='saas.fake_stripe.FakeStripe', SAAS_USE_CHECKOUT=False)
+class PurgeTestCase(TestCase):
+    def user(self, name, days, active=False, customer=True, **info):
+        stripe = get_stripe()
+        customer_id = stripe.Customer.create(email=f'{name}@example.com')['id'] if customer else f'cus_{name}'
+        user = create_user(email=f'{name}@example.com', customer_id=customer_id)
+        get_user_model().objects.filter(pk=user.pk).update(
+            is_active=active, date_joined=timezone.now() - timedelta(days=days))
+        StripeInfo.objects.filter(user=user).update(**info)
+        Acquisition.objects.create(user=user)
+        return user
+
+    def test_purge(self):
+        stale = [self.user(f'stale{i}', 40) for i in range(3)]
+        missing = self.user('missing', 40, customer=False)
+        failing = self.user('failing', 40)
+        kept = [
+            self.user('recent', 10),
+            self.user('active', 40, active=True),
+            self.user('subscriber', 40, previously_subscribed=True),
+        ]
+        User = get_user_model()
+
+        out = StringIO()
+        call_command('purge_users', dry_run=True, stdout=out)
+        self.assertIn('5 users deleted, 5 Stripe customers deleted, 0 failed', out.getvalue())
+        self.assertEqual(User.objects.count(), 8)
+
+        stripe = get_stripe()
+        delete = stripe.Customer.delete
+
+        def flaky(customer_id, **params):
+            if customer_id == failing.stripeinfo.customer_id:
+                raise stripe.error.StripeError('Too many requests')
+            return delete(customer_id, **params)
+
+        with mock.patch.object(stripe.Customer, 'delete', side_effect=flaky):
+            report = purge_unactivated(batch_size=2, concurrency=2, rate=1000)
+        self.assertEqual((report.users_deleted, report.customers_deleted, len(report.failed)), (4, 4, 1))
+        self.assertEqual(set(User.objects.values_list('pk', flat=True)), {failing.pk} | {user.pk for user in kept})
+        self.assertFalse(StripeInfo.objects.filter(user__in=stale + [missing]).exists())
+        self.assertFalse(Acquisition.objects.filter(user__in=stale + [missing]).exists())
+        for user in stale:
+            self.assertIn('deleted', stripe.customers[user.stripeinfo.customer_id])
+
+        # The next run retries the failed customer.
+        self.assertEqual(purge_unactivated().users_deleted, 1)
+        self.assertEqual(User.objects.count(), 3)
+
+
+@override_settings(STORAGES={'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'}})
+class GdprTestCase(WebhookTestMixin, TestCase):
+    def setUp(self):
+        self.user = create_user(email='gdpr@example.com', customer_id='cus_gdpr')
+        self.other = create_user(email='other@example.com', customer_id='cus_other')
+        for user in (self.user, self.other):
+            customer_id = user.stripeinfo.customer_id
+            self.post_event('customer.updated', customer_fixture(user.email, customer_id))
+            self.post_event('invoice.payment_succeeded', invoice_fixture(customer_id))
+
+    def test_events_are_indexed_at_ingest(self):
+        self.assertEqual(StripeEvent.objects.filter(customer_id='cus_gdpr').count(), 2)
+        self.assertEqual(index_events(), 0)
+
+    def test_export(self):
+        request = RequestFactory().get('/export')
+        request.user = self.user
+        response = UserDataExportView.as_view()(request)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(json.loads(archive.read('user.json'))['email'], 'gdpr@example.com')
+            events = [json.loads(line) for line in archive.read('events.jsonl').splitlines()]
+            self.assertEqual([event['event'] for event in events], ['customer.updated', 'invoice.payment_succeeded'])
+            self.assertEqual(events[0]['object']['email'], 'gdpr@example.com')
+            self.assertEqual(len(archive.read('billing.jsonl').splitlines()), 1)
+            self.assertEqual(len(archive.read('customer_snapshots.jsonl').splitlines()), 1)
+            self.assertEqual(archive.read('dunning.jsonl'), b'')
+
+    def test_erase(self):
+        billing = BillingEvent.objects.get(user=self.user)
+        receipt(billing)
+        user_id = self.user.pk
+        out = StringIO()
+        call_command('erase_user_data', 'gdpr@example.com', batch_size=1, stdout=out)
+        self.assertIn('2 Stripe events redacted', out.getvalue())
+        self.assertFalse(get_user_model().objects.filter(pk=user_id).exists())
+        self.assertFalse(StripeInfo.objects.filter(customer_id='cus_gdpr').exists())
+        self.assertFalse(CustomerSnapshot.objects.filter(customer_id='cus_gdpr').exists())
+        self.assertFalse(StripeEvent.objects.filter(object__contains='gdpr@example.com').exists())
+        self.assertEqual(StripeEvent.objects.filter(object__contains='other@example.com').count(), 1)
+        self.assertEqual(StripeEvent.objects.filter(customer_id='').count(), 2)
+        self.assertEqual(receipt_storage().listdir(f'receipts/{user_id}')[1], [])
+        self.assertEqual(erase_user(self.other), 2)
@@ -0,0 +1,258 @@
+"""
+Metered usage.
+
+`record_usage(user, metric, quantity)` only adds to an in-process buffer,
+aggregated per user, metric and period (SAAS_USAGE_PERIOD seconds, 3600 by
+default). The buffer is flushed to UsageRecord when a request finishes and
+it is older than SAAS_USAGE_BUFFER_SECONDS (10 by default), or right away
+once it holds SAAS_USAGE_BUFFER_SIZE entries (1000 by default). Scripts and
+workers call `flush_usage_buffer()` themselves.
+
+`report_usage()` (see the `report_usage` command) then pushes what was not
+reported yet to Stripe, one usage record per subscription item and period,
+billing the usage of organization members to the organization subscription.
+SAAS_USAGE_METRICS maps each metric to the metered price (or plan) id of
+its subscription item:
+
+    SAAS_USAGE_METRICS = {'api_calls': 'price_api_calls'}
+
+Recent versions of the `stripe` package no longer have usage records
+(`SubscriptionItem.create_usage_record`). Metrics of SAAS_USAGE_METERS are
+reported as billing meter events instead, to the meter of the given event
+name, on behalf of the customer of the subscription:
+
+    SAAS_USAGE_METERS = {'api_calls': 'api_calls'}
+
+The quantity being reported is saved before calling Stripe and usage
+records and meter events are sent with an idempotency key derived from the record and that
+quantity. A report interrupted between Stripe and the database sends the
+same usage record with the same key when it is run again, even if more
+usage was recorded meanwhile, so it is not counted twice.
+"""
+import logging
+import threading
+import time
+
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from django.dispatch import receiver
+from django.utils import timezone
+from saas.client import get_stripe
+from saas.models import StripeInfo, UsageRecord
+from saas.tenants import use_tenant
+
+logger = logging.getLogger("saas")
+
+_buffer = {}
+_buffer_since = None
+_lock = threading.Lock()
+
+
+def usage_period():
+    return getattr(settings, 'SAAS_USAGE_PERIOD', 3600)
+
+
+def period_start(timestamp):
+    period = usage_period()
+    return int(timestamp) // period * period
+
+
+def record_usage(user, metric, quantity=1, timestamp=None):
+    """
+    Count `quantity` of `metric` for `user` at `timestamp` (a Unix timestamp,
+    now by default). No I/O happens unless the buffer is full.
+    """
+    global _buffer_since
+    key = (user.pk, metric, period_start(time.time() if timestamp is None else timestamp))
+    with _lock:
+        _buffer[key] = _buffer.get(key, 0) + quantity
+        if _buffer_since is None:
+            _buffer_since = time.monotonic()
+        full = len(_buffer) >= getattr(settings, 'SAAS_USAGE_BUFFER_SIZE', 1000)
+    if full:
+        flush_usage_buffer()
+
+
+def _add(user_id, metric, start, quantity):
+    key = {
+        'user_id': user_id,
+        'metric': metric,
+        'period_start': datetime.fromtimestamp(start, dt_timezone.utc),
+    }
+    updates = {'quantity': F('quantity') + quantity, 'needs_report': True}
+    if UsageRecord.objects.filter(**key).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            UsageRecord.objects.create(quantity=quantity, **key)
+    except IntegrityError:
+        UsageRecord.objects.filter(**key).update(**updates)
+
+
+def flush_usage_buffer():
+    """
+    Add the buffered usage to UsageRecord. Returns the number of records
+    updated.
+    """
+    global _buffer, _buffer_since
+    with _lock:
+        buffered, _buffer, _buffer_since = _buffer, {}, None
+    flushed = 0
+    try:
+        for (user_id, metric, start), quantity in list(buffered.items()):
+            _add(user_id, metric, start, quantity)
+            del buffered[(user_id, metric, start)]
+            flushed += 1
+    finally:
+        if buffered:
+            # Put back what could not be written, for the next flush.
+            with _lock:
+                for key, quantity in buffered.items():
+                    _buffer[key] = _buffer.get(key, 0) + quantity
+                if _buffer_since is None:
+                    _buffer_since = time.monotonic()
+    return flushed
+
+
+@receiver(request_finished)
+def flush_usage_buffer_when_due(**kwargs):
+    since = _buffer_since
+    if since is None or time.monotonic() - since < getattr(settings, 'SAAS_USAGE_BUFFER_SECONDS', 10):
+        return
+    try:
+        flush_usage_buffer()
+    except Exception:
+        logger.exception("Could not flush the usage buffer")
+
+
+def idempotency_key(record_id, quantity):
+    return f'saas-usage-{record_id}-{quantity}'
+
+
+class UsageReport:
+    def __init__(self):
+        self.reported = 0
+        self.skipped = 0
+        self.failed = []
+
+    def __str__(self):
+        return f'{self.reported} usage records reported, {self.skipped} skipped, {len(self.failed)} failed'
+
+
+def subscriptions_of(user_ids):
+    """
+    Return `{user id: (subscription id, tenant)}` for the users of `user_ids`
+    with a subscription: their own or, failing that, the one of their
+    organization ending last (see Customer.active_info).
+    """
+    subscriptions = {
+        user_id: (subscription_id, tenant)
+        for user_id, subscription_id, tenant in StripeInfo.objects.filter(user_id__in=user_ids)
+        .exclude(subscription_id=None)
+        .values_list('user_id', 'subscription_id', 'tenant')
+    }
+    members = set(user_ids) - set(subscriptions)
+    if members:
+        organizations = (
+            StripeInfo.objects.filter(organization__memberships__user_id__in=members)
+            .exclude(subscription_id=None)
+            .order_by(F('subscription_end').asc(nulls_first=True))
+            .values_list('organization__memberships__user_id', 'subscription_id', 'tenant')
+        )
+        # Ordered so that the subscription ending last wins.
+        for user_id, subscription_id, tenant in organizations:
+            subscriptions[user_id] = (subscription_id, tenant)
+    return subscriptions
+
+
+def _create_usage_record(stripe, item_id, **params):
+    if not hasattr(stripe.SubscriptionItem, 'create_usage_record'):
+        raise NotImplementedError('This version of stripe has no usage records, see SAAS_USAGE_METERS')
+    return stripe.SubscriptionItem.create_usage_record(item_id, **params)
+
+def _price_id(item):
+    price = item['price'] if 'price' in item and item['price'] else item['plan']
+    return price['id']
+
+
+def report_usage(batch_size=500):
+    """
+    Push the usage not reported yet to Stripe and return a UsageReport.
+    Usage of users without a subscription is skipped (and never billed).
+    """
+    flush_usage_buffer()
+    metrics = getattr(settings, 'SAAS_USAGE_METRICS', {})
+    meters = getattr(settings, 'SAAS_USAGE_METERS', {})
+    report = UsageReport()
+    subscriptions = {}
+    last_id = None
+    while True:
+        records = UsageRecord.objects.filter(needs_report=True).order_by('id')
+        if last_id is not None:
+            records = records.filter(id__gt=last_id)
+        records = list(records.values_list(
+            'id', 'user_id', 'metric', 'period_start', 'quantity', 'reported_quantity', 'reporting_quantity')[:batch_size])
+        if not records:
+            return report
+        last_id = records[-1][0]
+        subscription_ids = subscriptions_of({record[1] for record in records})
+        for id, user_id, metric, start, quantity, reported_quantity, reporting_quantity in records:
+            subscription_id, tenant = subscription_ids.get(user_id, (None, None))
+            if subscription_id is None:
+                logger.info(f"Skipping usage {id} of user {user_id} without subscription")
+                UsageRecord.objects.filter(id=id, quantity=quantity).update(
+                    reported_quantity=quantity, reporting_quantity=None, needs_report=False)
+                report.skipped += 1
+                continue
+            if reporting_quantity is None:
+                # Saved first: Stripe may accept the usage record and the report not be saved.
+                reporting_quantity = quantity
+                UsageRecord.objects.filter(id=id).update(reporting_quantity=reporting_quantity)
+            try:
+                with use_tenant(tenant):
+                    stripe = get_stripe()
+                    if subscription_id not in subscriptions:
+                        subscriptions[subscription_id] = stripe.Subscription.retrieve(subscription_id)
+                    subscription = subscriptions[subscription_id]
+                    # Usage cannot be recorded before the current period of the subscription.
+                    timestamp = max(int(start.timestamp()), int(subscription['current_period_start']))
+                    if metric in meters:
+                        stripe.billing.MeterEvent.create(
+                            event_name=meters[metric],
+                            payload={
+                                'stripe_customer_id': subscription['customer'],
+                                'value': str(reporting_quantity - reported_quantity),
+                            },
+                            identifier=idempotency_key(id, reporting_quantity),
+                            timestamp=timestamp,
+                        )
+                    else:
+                        items = [
+                            item for item in subscription['items']['data']
+                            if metrics.get(metric) is not None and _price_id(item) == metrics[metric]
+                        ]
+                        if not items:
+                            raise ValueError(f'No subscription item for metric {metric}')
+                        _create_usage_record(
+                            stripe,
+                            items[0]['id'],
+                            quantity=reporting_quantity - reported_quantity,
+                            timestamp=timestamp,
+                            action='increment',
+                            idempotency_key=idempotency_key(id, reporting_quantity),
+                        )
+            except Exception as e:
+                logger.exception(f"Could not report usage {id} of user {user_id}")
+                report.failed.append((id, repr(e)))
+                continue
+            # Usage recorded since the records were read is reported next time.
+            UsageRecord.objects.filter(id=id).update(
+                reported_quantity=reporting_quantity,
+                reporting_quantity=None,
+                needs_report=Case(When(quantity=reporting_quantity, then=Value(False)), default=Value(True)),
+                reported_at=timezone.now(),
+            )
+            report.reported += 1
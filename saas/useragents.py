@@ -0,0 +1,133 @@
+"""
+Parsed and deduplicated User-Agent storage.
+
+Signups share a small number of distinct User-Agent headers, so each one is
+stored once in UserAgent, keyed by its SHA-256, with the browser, OS and
+device family parsed when it is first seen. Parsing is a few regular
+expressions memoized with an LRU cache.
+"""
+import hashlib
+import re
+
+from functools import lru_cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from saas.models import Acquisition, UserAgent
+
+USER_AGENT_CACHE_SIZE = 1024
+
+OTHER = 'Other'
+
+BOT = re.compile(r'bot|crawl|spider|slurp|headless|curl|wget|python-requests', re.IGNORECASE)
+
+# First match wins, so the order matters: Chromium based browsers also
+# advertise Chrome and Safari, and Chrome advertises Safari.
+BROWSERS = [
+    ('Edge', re.compile(r'Edg(e|A|iOS)?/')),
+    ('Opera', re.compile(r'OPR/|Opera')),
+    ('Samsung Internet', re.compile(r'SamsungBrowser/')),
+    ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('Chrome', re.compile(r'Chrome/|CriOS/')),
+    ('Safari', re.compile(r'Version/[\d.]+.*Safari/')),
+    ('Internet Explorer', re.compile(r'MSIE |Trident/')),
+]
+
+OPERATING_SYSTEMS = [
+    ('iOS', re.compile(r'iPhone|iPad|iPod')),
+    ('Android', re.compile(r'Android')),
+    ('Windows', re.compile(r'Windows')),
+    ('Chrome OS', re.compile(r'CrOS')),
+    ('macOS', re.compile(r'Mac OS X|Macintosh')),
+    ('Linux', re.compile(r'Linux')),
+]
+
+TABLET = re.compile(r'iPad|Tablet|Android(?!.*Mobile)')
+MOBILE = re.compile(r'Mobi|iPhone|iPod|Android')
+
+
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def parse_user_agent(agent):
+    """
+    Return the `(browser, os, device)` families of a User-Agent header,
+    device being one of `bot`, `tablet`, `mobile` or `desktop`.
+    """
+    agent = agent or ''
+    if BOT.search(agent):
+        return 'Bot', OTHER, 'bot'
+    browser = next((name for name, pattern in BROWSERS if pattern.search(agent)), OTHER)
+    os = next((name for name, pattern in OPERATING_SYSTEMS if pattern.search(agent)), OTHER)
+    if TABLET.search(agent):
+        device = 'tablet'
+    elif MOBILE.search(agent):
+        device = 'mobile'
+    else:
+        device = 'desktop'
+    return browser, os, device
+
+
+def user_agent_hash(agent):
+    return hashlib.sha256(agent.encode('utf-8')).hexdigest()
+
+
+def intern_user_agent(agent):
+    """
+    Return the UserAgent of a User-Agent header, creating it the first time
+    the header is seen, or None when there is no header.
+    """
+    if not agent:
+        return None
+    key = user_agent_hash(agent)
+    try:
+        return UserAgent.objects.get(hash=key)
+    except UserAgent.DoesNotExist:
+        browser, os, device = parse_user_agent(agent)
+        try:
+            with transaction.atomic():
+                return UserAgent.objects.create(hash=key, agent=agent, browser=browser, os=os, device=device)
+        except IntegrityError:
+            # Created concurrently
+            return UserAgent.objects.get(hash=key)
+
+
+def backfill_user_agents(batch_size=1000):
+    """
+    Move the raw `agent` of Acquisition rows recorded before user agents were
+    interned to UserAgent, one batch of rows at a time. Returns the number of
+    rows updated.
+    """
+    ids = {}
+    updated = 0
+    while True:
+        batch = list(
+            Acquisition.objects.filter(user_agent=None).exclude(agent=None)
+            .only('id', 'agent')[:batch_size]
+        )
+        if not batch:
+            return updated
+        for acquisition in batch:
+            if acquisition.agent not in ids:
+                user_agent = intern_user_agent(acquisition.agent)
+                ids[acquisition.agent] = user_agent.id if user_agent else None
+            acquisition.user_agent_id = ids[acquisition.agent]
+            acquisition.agent = None
+        Acquisition.objects.bulk_update(batch, ['user_agent', 'agent'])
+        updated += len(batch)
+
+
+def conversions_by(field='device', start=None, end=None):
+    """
+    Return the number of signups and conversions of the acquisitions created
+    between `start` and `end`, grouped by a UserAgent field (`browser`, `os`
+    or `device`).
+    """
+    acquisitions = Acquisition.objects.all()
+    if start is not None:
+        acquisitions = acquisitions.filter(created_at__gte=start)
+    if end is not None:
+        acquisitions = acquisitions.filter(created_at__lt=end)
+    group = f'user_agent__{field}'
+    return (
+        acquisitions.values(group)
+        .annotate(signups=Count('id'), conversions=Count('converted_at'))
+        .order_by(group)
+    )
@@ -1,46 +1,61 @@
+import hmac
 import logging
-import stripe
-import warnings
 
 from datetime import datetime
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth import login, get_user_model
-from django.http import HttpResponse, Http404
+from django.core import signing
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.decorators import method_decorator
 
 try:
     from django.utils.encoding import force_text as force_str
 except ImportError:
     from django.utils.encoding import force_str
-from django.utils.http import urlsafe_base64_decode
+from django.utils.http import http_date, parse_etags, quote_etag, urlsafe_base64_decode
 from django.utils.translation import gettext_lazy as _
 from django.utils.timezone import make_aware
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.base import View, TemplateView
 from django.views.generic.edit import FormView
+from saas.analytics import record_payment, record_signup, record_trial_started
+from saas.billing import DEFAULT_PAGE_SIZE, billing_history, billing_page
+from saas.client import get_stripe
+from saas.dunning import close_dunning, open_dunning
+from saas.entitlements import features_from_stripe, sync_plan, sync_product
+from saas.exports import EXPORTS, FORMATS, export_filename
 from saas.forms import CreateUserForm
+from saas.gdpr import export_user
+from saas.health import cached_webhook_health
+from saas.instrumentation import get_metrics_backend, instrumented, timed
 from saas.mailer import send_multi_mail
-from saas.models import StripeInfo, BillingEvent, StripeEvent, Acquisition
+from saas.models import StripeInfo, BillingEvent, StripeEvent, Acquisition, CustomerSnapshot, Dunning, PaymentMethod, Organization, stripe_customer_id
+from saas.ratelimit import check_rate_limits
+from saas.receipts import CONTENT_TYPES, receipt, receipt_filename
+from saas.revenue import record_subscription
+from saas.routers import pin_primary
 from saas.subscription import Customer
+from saas.tenants import current_tenant, tenant_for_account, tenant_setting, tenants, use_tenant
+from saas.useragents import intern_user_agent
 
 User = get_user_model()
 
-if hasattr(settings, "STRIPE_SECRET_KEY"):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-else:
-    warnings.warn(
-        """
-        In order for django-saas to function properly, you need to set STRIPE_SECRET_KEY in settings.py
-    """
-    )
+logger = logging.getLogger("saas")
 
 
-logger = logging.getLogger("saas")
+def rate_limited(request, template_name=None):
+    if template_name is None:
+        return HttpResponse("Too many requests, please try again later.", status=429)
+    return render(request, template_name, status=429)
 
 
 class RegisterView(FormView):
@@ -55,6 +70,14 @@ class RegisterView(FormView):
     title = _("Register")
     token_generator = default_token_generator
     mailer = None
+    rate_limited_template_name = None
+
+    def post(self, request, *args, **kwargs):
+        # Before validating the form, which verifies the captcha, creates the
+        # Stripe customer and sends the activation email.
+        if not check_rate_limits("register", request, email=request.POST.get("email")):
+            return rate_limited(request, self.rate_limited_template_name)
+        return super().post(request, *args, **kwargs)
 
     def form_valid(self, form):
         opts = {
@@ -72,13 +95,14 @@ class RegisterView(FormView):
         user = form.save(**opts)
 
         # acquisition information
-        Acquisition.objects.create(
+        acquisition = Acquisition.objects.create(
             user=user,
-            agent=self.request.headers["User-Agent"],
+            user_agent=intern_user_agent(self.request.headers.get("User-Agent")),
             referer=self.request.session.get("referer", None),
             campaign=self.request.session.get("campaign", None),
             content=self.request.session.get("content", None),
         )
+        record_signup(acquisition)
 
         messages.success(
             self.request,
@@ -96,8 +120,11 @@ class ActivateView(View):
     success_url = reverse_lazy("index")
     failure_url = reverse_lazy("login")
     expired_token_template_name = "registration/activating.html"
+    rate_limited_template_name = None
 
     def get(self, request, uidb64, token):
+        if not check_rate_limits("activate", request):
+            return rate_limited(request, self.rate_limited_template_name)
         try:
             uid = force_str(urlsafe_base64_decode(uidb64))
             user = User.objects.get(pk=uid)
@@ -126,13 +153,15 @@ class SubscribeView(LoginRequiredMixin, View):
     success_url = reverse_lazy("index")
 
     def get(self, request, *args, **kwargs):
+        stripe = get_stripe()
         plans = stripe.Plan.list()
         context = {}
         context["plans"] = plans
-        context["STRIPE_PUBLISHABLE_KEY"] = settings.STRIPE_PUBLISHABLE_KEY
+        context["STRIPE_PUBLISHABLE_KEY"] = tenant_setting("publishable_key")
         return render(request, self.template_name, context)
 
     def post(self, request, *args, **kwargs):
+        stripe = get_stripe()
         token = request.POST.get("stripeToken", None)
         info = request.user.stripeinfo
         # Set default payment method
@@ -165,6 +194,7 @@ class StripePortalView(View):
     return_url = reverse_lazy("index")
 
     def get(self, request, *args, **kwargs):
+        stripe = get_stripe()
         info = request.user.stripeinfo
         url = "{}://{}{}".format(
             request.scheme, request.META["HTTP_HOST"], self.return_url
@@ -177,6 +207,33 @@ class StripePortalView(View):
         return redirect(session["url"])
 
 
+class CheckoutView(LoginRequiredMixin, View):
+    price_id = None
+    success_url = reverse_lazy("index")
+    cancel_url = reverse_lazy("index")
+
+    def get_price_id(self):
+        return self.price_id or settings.SAAS_CHECKOUT_PRICE_ID
+
+    def post(self, request, *args, **kwargs):
+        stripe = get_stripe()
+        params = {
+            "mode": "subscription",
+            "line_items": [{"price": self.get_price_id(), "quantity": 1}],
+            # Lets checkout.session.completed find the user by primary key.
+            "client_reference_id": str(request.user.pk),
+            "success_url": request.build_absolute_uri(self.success_url),
+            "cancel_url": request.build_absolute_uri(self.cancel_url),
+        }
+        info = Customer.of(request.user).info
+        if info is not None and info.customer_id:
+            params["customer"] = info.customer_id
+        else:
+            params["customer_email"] = request.user.email
+        session = stripe.checkout.Session.create(**params)
+        return redirect(session["url"])
+
+
 # Checkout Sequence
 #   charge.succeeded
 #   checkout.session.completed ()
@@ -203,6 +260,8 @@ class StripePortalView(View):
 
 class StripeView(View):
     endpoint_secret = None
+    # Stripe account of this endpoint, see saas.tenants.
+    tenant = None
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
@@ -211,14 +270,30 @@ class StripeView(View):
     def handle_stripe_event(self, request, event, stripe_object):
         pass
 
-    def post(self, request):
+    def get_tenant(self, request):
+        tenant = self.kwargs.get("tenant", self.tenant)
+        header = getattr(settings, "SAAS_STRIPE_ACCOUNT_HEADER", None)
+        if tenant is None and header and header in request.headers:
+            tenant = tenant_for_account(request.headers[header])
+        return tenant
+
+    def post(self, request, *args, **kwargs):
+        tenant = self.get_tenant(request)
+        if tenant is not None and tenant not in tenants():
+            logger.warning(f"Unknown Stripe tenant {tenant}")
+            return HttpResponse(status=404)
+        with use_tenant(tenant):
+            return self.receive(request)
+
+    def receive(self, request):
+        stripe = get_stripe()
         payload = request.body
         sig_header = request.META["HTTP_STRIPE_SIGNATURE"]
         event = None
 
         endpoint_secret = self.endpoint_secret
         if endpoint_secret is None:
-            endpoint_secret = settings.STRIPE_ENDPOINT_SECRET
+            endpoint_secret = tenant_setting("endpoint_secret")
 
         try:
             event = stripe.Webhook.construct_event(
@@ -241,10 +316,26 @@ class StripeView(View):
 
         stripe_object = event["data"]["object"]
 
-        self.handle_stripe_event(request, event, stripe_object)
+        self.stripe_event = None
+        try:
+            with timed("handle_stripe_event", event=event["type"]), pin_primary():
+                self.handle_stripe_event(request, event, stripe_object)
+        except Exception:
+            self.stripe_event_handled(failed=True)
+            raise
+        self.stripe_event_handled()
 
         return HttpResponse(status=200)
 
+    def stripe_event_handled(self, failed=False):
+        # Set by StripeWebhook.record_stripe_event, None for replayed events.
+        if self.stripe_event is not None:
+            events = Q(pk=self.stripe_event.pk)
+            if not failed and self.stripe_event.event_id:
+                # Earlier deliveries that crashed before being marked are done too, see saas.health.
+                events |= Q(event_id=self.stripe_event.event_id, processed_at=None)
+            StripeEvent.objects.filter(events).update(processed_at=timezone.now(), failed=failed)
+
 
 class StripeWebhook(StripeView):
     from_email = None
@@ -252,6 +343,7 @@ class StripeWebhook(StripeView):
     payment_succeeded_email_template_name = None
     payment_succeeded_subject_template_name = None
     html_payment_succeeded_email_template_name = None
+    payment_succeeded_attach_receipt = True
     # Payment Failed
     payment_failed_email_template_name = None
     payment_failed_subject_template_name = None
@@ -272,6 +364,10 @@ class StripeWebhook(StripeView):
     # Mailer Overwrite
     mailer = None
 
+    # Analytics, revenue history and dunning updates, turned off when replaying events.
+    side_effects = True
+
+    @instrumented("customer_user_info")
     def customer_user_info(self, stripe_object):
         customer_id = None
         user = None
@@ -280,7 +376,7 @@ class StripeWebhook(StripeView):
         if "customer" in stripe_object:
             customer_id = stripe_object["customer"]
             try:
-                info = StripeInfo.objects.get(customer_id=customer_id)
+                info = StripeInfo.objects.get(customer_id=customer_id, tenant=current_tenant())
                 user = info.user
             except StripeInfo.DoesNotExist:
                 logger.info(f"Could not find StripeInfo for customer {customer_id}")
@@ -289,20 +385,72 @@ class StripeWebhook(StripeView):
 
         return customer_id, user, info
 
-    def handle_stripe_event(self, request, event, stripe_object):
-        # Record Event
-        StripeEvent.objects.create(
+    def record_stripe_event(self, event, stripe_object):
+        return StripeEvent.objects.create(
             event_id=event["id"],
             event=event["type"],
             object_id=stripe_object["id"] if "id" in stripe_object else None,
             object=stripe_object,
+            stripe_created_at=self.event_time(event),
+            customer_id=stripe_customer_id(event["type"], stripe_object) or "",
+            tenant=current_tenant(),
+        )
+
+    def is_redelivery(self, event):
+        """
+        Whether an earlier delivery of `event` was already handled, Stripe
+        sending events again when they are not acknowledged in time.
+        """
+        if self.stripe_event is None or not self.stripe_event.event_id:
+            return False
+        return (
+            StripeEvent.objects.filter(event_id=self.stripe_event.event_id, failed=False)
+            .exclude(pk=self.stripe_event.pk)
+            .exclude(processed_at=None)
+            .exists()
         )
 
+    def handle_stripe_event(self, request, event, stripe_object):
+        # Record Event
+        self.stripe_event = self.record_stripe_event(event, stripe_object)
+
         if event["type"] == "customer.created" or event["type"] == "customer.updated":
             # This event could happen when using CHECKOUT as customers are created automatically.
             # Or when subscription is cancelled through Portal.
-            StripeInfo.sync_with_customer(stripe_object)
+            StripeInfo.sync_with_customer(stripe_object, record_history=self.side_effects)
+            CustomerSnapshot.sync_with_customer(stripe_object)
+            PaymentMethod.sync_with_customer(stripe_object)
+        elif event["type"] == "checkout.session.completed":
+            subscription = None
+            if "subscription" in stripe_object and stripe_object["subscription"]:
+                # Subscription events may have been delivered before the customer was linked.
+                subscription = get_stripe().Subscription.retrieve(stripe_object["subscription"])
+            info = StripeInfo.sync_with_checkout_session(stripe_object, subscription)
+            if info is None:
+                logger.info(f"Could not find the user of checkout session {stripe_object['id']}")
+            elif subscription is not None:
+                CustomerSnapshot.sync_with_subscription(subscription)
+                self.sync_seats(info, subscription)
+        elif event["type"] in (
+            "payment_method.attached",
+            "payment_method.updated",
+            "payment_method.automatically_updated",
+            "payment_method.detached",
+            "customer.source.created",
+            "customer.source.updated",
+            "customer.source.expiring",
+        ):
+            PaymentMethod.sync_with_payment_method(stripe_object)
+        elif event["type"] == "customer.source.deleted":
+            PaymentMethod.objects.filter(payment_method_id=stripe_object["id"]).delete()
+        elif event["type"] in ("product.created", "product.updated"):
+            if features_from_stripe():
+                sync_product(stripe_object)
+        elif event["type"] in ("plan.created", "plan.updated", "plan.deleted"):
+            if features_from_stripe():
+                sync_plan(stripe_object, deleted=event["type"] == "plan.deleted")
         elif event["type"] == "customer.subscription.deleted":
+            CustomerSnapshot.sync_with_subscription(stripe_object, deleted=True)
             customer, user, info = self.customer_user_info(stripe_object)
             if info is not None:
                 logger.info(f"User {user.id} ({customer}) subscription deleted")
@@ -311,16 +459,19 @@ class StripeWebhook(StripeView):
                 info.subscription_end = None
                 info.plan_id = None
                 info.save()
+                if self.side_effects:
+                    record_subscription(user.id, stripe_object, deleted=True, at=self.event_time(event))
+                    close_dunning(user, Dunning.CANCELED)
         elif event["type"] == "invoice.payment_succeeded":
             customer, user, _ = self.customer_user_info(stripe_object)
             if user is not None:
                 logger.info(f"User {user.id} ({customer}) payment succeeded")
-                billing = BillingEvent.objects.create(
-                    user=user,
-                    stripe_object=stripe_object,
-                )
+                billing, created = BillingEvent.record(user, stripe_object)
+                if created and self.side_effects:
+                    record_payment(user, stripe_object)
+                    close_dunning(user)
                 # Do not email trial emails where amount_due and amount_paid are both 0
-                if (
+                if created and (
                     stripe_object["amount_due"] != 0
                     or stripe_object["amount_paid"] != 0
                 ):
@@ -329,12 +480,11 @@ class StripeWebhook(StripeView):
             customer, user, _ = self.customer_user_info(stripe_object)
             if user is not None:
                 logger.info(f"User {user.id} ({customer}) payment failed")
-                billing = BillingEvent.objects.create(
-                    user=user,
-                    success=False,
-                    stripe_object=stripe_object,
-                )
-                self.on_payment_failed(request, user, billing, stripe_object)
+                billing, created = BillingEvent.record(user, stripe_object, success=False)
+                if created:
+                    if self.side_effects:
+                        open_dunning(user, stripe_object)
+                    self.on_payment_failed(request, user, billing, stripe_object)
         elif event["type"] == "invoice.payment_action_required":
             customer, user, _ = self.customer_user_info(stripe_object)
             if user is not None:
@@ -346,6 +496,7 @@ class StripeWebhook(StripeView):
                 logger.info(f"User {user.id} ({customer}) invoice incoming")
                 self.on_invoice_incoming(request, user, stripe_object)
         elif event["type"] == "customer.subscription.updated":
+            CustomerSnapshot.sync_with_subscription(stripe_object)
             customer, user, info = self.customer_user_info(stripe_object)
             if info is not None:
                 subscription_id = stripe_object["id"]
@@ -360,12 +511,16 @@ class StripeWebhook(StripeView):
                 info.subscription_end = subscription_end
                 info.plan_id = plan_id
                 info.save()
+                if self.side_effects:
+                    record_subscription(user.id, stripe_object, at=self.event_time(event))
+                self.sync_seats(info, stripe_object)
         elif event["type"] == "customer.subscription.trial_will_end":
             customer, user, _ = self.customer_user_info(stripe_object)
             if user is not None:
                 logger.info(f"User {user.id} ({customer}) trial will end")
                 self.on_trial_will_end(request, user, stripe_object)
         elif event["type"] == "customer.subscription.created":
+            CustomerSnapshot.sync_with_subscription(stripe_object)
             customer, user, info = self.customer_user_info(stripe_object)
             if info is not None:
                 subscription_id = stripe_object["id"]
@@ -380,6 +535,25 @@ class StripeWebhook(StripeView):
                 info.subscription_end = subscription_end
                 info.plan_id = plan_id
                 info.save()
+                if self.side_effects:
+                    record_subscription(user.id, stripe_object, at=self.event_time(event))
+                self.sync_seats(info, stripe_object)
+                if (
+                    self.side_effects
+                    and "status" in stripe_object
+                    and stripe_object["status"] == "trialing"
+                    and not self.is_redelivery(event)
+                ):
+                    record_trial_started(user)
+
+    def event_time(self, event):
+        return make_aware(datetime.fromtimestamp(int(event["created"]))) if "created" in event else None
+
+    def sync_seats(self, info, subscription):
+        if info.organization_id is not None:
+            Organization.objects.filter(pk=info.organization_id).update(
+                seats=Organization.seats_of(subscription)
+            )
 
     def on_payment_succeeded(self, request, user, billing, stripe_object):
         if self.mailer is not None:
@@ -399,6 +573,16 @@ class StripeWebhook(StripeView):
             "protocol": request.scheme,
             "domain": request.META["HTTP_HOST"],
         }
+        attachments = None
+        if self.payment_succeeded_attach_receipt:
+            try:
+                attachments = [{
+                    "name": receipt_filename(billing, "pdf"),
+                    "content": receipt(billing, "pdf"),
+                    "type": CONTENT_TYPES["pdf"],
+                }]
+            except Exception:
+                logger.exception(f"Could not render the receipt of {billing.id}")
         send_multi_mail(
             self.payment_succeeded_subject_template_name,
             self.payment_succeeded_email_template_name,
@@ -406,6 +590,7 @@ class StripeWebhook(StripeView):
             self.from_email,
             user.email,
             html_email_template_name=self.html_payment_succeeded_email_template_name,
+            attachments=attachments,
         )
 
     def on_payment_failed(self, request, user, billing, stripe_object):
@@ -518,18 +703,184 @@ class StripeHook(StripeWebhook):
     pass
 
 
+class MetricsAccessMixin:
+    """
+    Restrict a monitoring view to active staff members and to requests with
+    an `Authorization: Bearer <SAAS_METRICS_TOKEN>` header, e.g. a scraper.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        if not self.has_metrics_access(request):
+            raise PermissionDenied
+        return super().dispatch(request, *args, **kwargs)
+
+    def has_metrics_access(self, request):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_active and user.is_staff:
+            return True
+        token = getattr(settings, "SAAS_METRICS_TOKEN", None)
+        if not token:
+            return False
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        return hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+
+
+class MetricsView(MetricsAccessMixin, View):
+    """
+    Expose the measurements of SAAS_INSTRUMENTATION in the Prometheus text
+    format. Only available with a backend implementing `prometheus_text`, such
+    as the default InMemoryBackend, to staff members and SAAS_METRICS_TOKEN.
+    """
+    prefix = "saas"
+
+    def get(self, request):
+        backend = get_metrics_backend()
+        if not hasattr(backend, "prometheus_text"):
+            raise Http404
+        return HttpResponse(
+            backend.prometheus_text(prefix=self.prefix),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
+class WebhookHealthView(MetricsAccessMixin, View):
+    """
+    Report the webhook backlog, throughput, failures and lag as JSON, see
+    saas.health. Cached for a few seconds, so it can be scraped often by
+    staff members and SAAS_METRICS_TOKEN.
+    """
+    def get(self, request):
+        return JsonResponse(cached_webhook_health())
+
+
+class ExportView(PermissionRequiredMixin, View):
+    """
+    Stream the billing history (`dataset = "billing"`) or the Stripe event log
+    (`dataset = "events"`) filtered by the `start`, `end`, `user` and `type`
+    (repeatable) query parameters, as `format=csv` or `format=jsonl`, gzipped
+    with `gzip=1`. Requires the view permission of the exported model.
+    """
+    dataset = "billing"
+    chunk_size = 2000
+
+    def get_permission_required(self):
+        if (self.kwargs.get("dataset") or self.dataset) == "events":
+            return ("saas.view_stripeevent",)
+        return ("saas.view_billingevent",)
+
+    def get(self, request, dataset=None):
+        dataset = dataset or self.dataset
+        if dataset not in EXPORTS:
+            raise Http404
+        export_format = request.GET.get("format", "csv")
+        compress = request.GET.get("gzip") in ("1", "true")
+        try:
+            export = EXPORTS[dataset](
+                start=request.GET.get("start"),
+                end=request.GET.get("end"),
+                user=request.GET.get("user"),
+                types=request.GET.getlist("type"),
+                chunk_size=self.chunk_size,
+            )
+            chunks = export.stream(export_format, compress=compress)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        response = StreamingHttpResponse(
+            chunks,
+            content_type="application/gzip" if compress else FORMATS[export_format],
+        )
+        filename = export_filename(dataset, export_format, compress)
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+
+class UserDataExportView(LoginRequiredMixin, View):
+    """
+    Stream a zip of everything django-saas keeps about the user, see
+    saas.gdpr.export_user.
+    """
+    chunk_size = 2000
+
+    def get(self, request):
+        response = StreamingHttpResponse(
+            export_user(request.user, chunk_size=self.chunk_size),
+            content_type="application/zip",
+        )
+        filename = export_filename("user-data", "zip")
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+
 class BillingView(View):
     template_name = "subscription/billing.html"
+    cache_max_age = 24 * 3600
+    # Bump to invalidate the ETags already handed out, e.g. when the template changes.
+    etag_version = 1
+
+    def get_etag(self, billing_id, user_id, modified_at):
+        # Signed so that a matching If-None-Match only needs modified_at to be checked.
+        value = f"{self.etag_version}:{billing_id}:{user_id}:{int(modified_at.timestamp())}"
+        return quote_etag(signing.Signer(salt="saas.BillingView").sign(value))
+
+    def matches_etag(self, request, billing_id):
+        matches = {}
+        for etag in parse_etags(request.headers.get("If-None-Match", "")):
+            try:
+                version, etag_billing_id, user_id, modified = signing.Signer(salt="saas.BillingView").unsign(
+                    etag.strip('"')).split(":")
+            except (signing.BadSignature, ValueError):
+                continue
+            if (version, etag_billing_id, user_id) == (str(self.etag_version), str(billing_id), str(request.user.pk)):
+                matches[modified] = etag
+        if not matches:
+            return None
+        # Only modified_at is read, the bill is neither loaded nor rendered.
+        modified_at = (
+            BillingEvent.objects.filter(pk=billing_id, user_id=request.user.pk)
+            .values_list("modified_at", flat=True)
+            .first()
+        )
+        if modified_at is None:
+            return None
+        return matches.get(str(int(modified_at.timestamp())))
+
+    def cache_headers(self, response, etag, modified_at=None):
+        response["ETag"] = etag
+        if modified_at is not None:
+            response["Last-Modified"] = http_date(modified_at.timestamp())
+        patch_cache_control(response, private=True, max_age=self.cache_max_age)
+        return response
 
     def get(self, request, billing_id):
-        billing = get_object_or_404(BillingEvent, pk=billing_id)
-        if billing.user != request.user:
+        etag = self.matches_etag(request, billing_id) if request.user.is_authenticated else None
+        if etag is not None:
+            return self.cache_headers(HttpResponseNotModified(), etag)
+
+        # Ownership is checked on user_id, the user row is not loaded.
+        billing = get_object_or_404(BillingEvent, pk=billing_id, user_id=request.user.pk)
+        billing.user = request.user
+        etag = self.get_etag(billing.id, billing.user_id, billing.modified_at)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=int(billing.modified_at.timestamp()))
+        if response is None:
+            context = {}
+            context["billing"] = billing
+            response = render(request, self.template_name, context)
+        return self.cache_headers(response, etag, billing.modified_at)
+
+
+class ReceiptView(LoginRequiredMixin, View):
+    # Receipts never change once rendered.
+    cache_max_age = 365 * 24 * 3600
+
+    def get(self, request, billing_id, format="pdf"):
+        if format not in CONTENT_TYPES:
             raise Http404
-
-        context = {}
-        context["billing"] = billing
-
-        return render(request, self.template_name, context)
+        billing = get_object_or_404(BillingEvent, pk=billing_id, user=request.user)
+        response = HttpResponse(receipt(billing, format), content_type=CONTENT_TYPES[format])
+        response["Content-Disposition"] = f'inline; filename="{receipt_filename(billing, format)}"'
+        patch_cache_control(response, private=True, max_age=self.cache_max_age, immutable=True)
+        return response
 
 
 class UpdatePaymentView(LoginRequiredMixin, View):
@@ -538,18 +889,25 @@ class UpdatePaymentView(LoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
         context = {}
-        context["STRIPE_PUBLISHABLE_KEY"] = settings.STRIPE_PUBLISHABLE_KEY
+        context["STRIPE_PUBLISHABLE_KEY"] = tenant_setting("publishable_key")
+        context["card"] = PaymentMethod.default_for(request.user.stripeinfo.customer_id)
         return render(request, self.template_name, context)
 
     def post(self, request, *args, **kwargs):
+        stripe = get_stripe()
         info = request.user.stripeinfo
         customer = stripe.Customer.modify(
             info.customer_id, source=request.POST.get("stripeToken")
         )
-        stripe.Subscription.modify(
-            info.subscription_id,
-            default_source=customer["sources"]["data"][0]["id"],
-        )
+        # The new source becomes the customer's default source, the
+        # subscription only needs updating when there is one.
+        if info.subscription_id is not None:
+            stripe.Subscription.modify(
+                info.subscription_id,
+                default_source=customer["default_source"],
+            )
+        # Show the new card right away, without waiting for the webhooks.
+        PaymentMethod.sync_with_customer(customer)
         return redirect(self.success_url)
 
 
@@ -559,10 +917,11 @@ class UpdatePlanView(LoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
         context = {}
-        context["STRIPE_PUBLISHABLE_KEY"] = settings.STRIPE_PUBLISHABLE_KEY
+        context["STRIPE_PUBLISHABLE_KEY"] = tenant_setting("publishable_key")
         return render(request, self.template_name, context)
 
     def post(self, request, *args, **kwargs):
+        stripe = get_stripe()
         info = request.user.stripeinfo
         stripe.Subscription.modify(
             info.subscription_id,
@@ -577,31 +936,65 @@ class UpdatePlanView(LoginRequiredMixin, View):
 
 
 class SubscriptionView(LoginRequiredMixin, TemplateView):
+    """
+    Customer and subscription come from the CustomerSnapshot, and card from
+    the default PaymentMethod, both kept up to date by StripeWebhook; Stripe is
+    only called for customers without a snapshot.
+    `billing` is the first `paginate_by` billing events, `billing_next` the
+    cursor of the next page (see BillingHistoryView).
+    """
+    paginate_by = DEFAULT_PAGE_SIZE
+
+    def get_snapshot(self, info):
+        snapshot = CustomerSnapshot.objects.filter(customer_id=info.customer_id).first()
+        if snapshot is None or snapshot.customer_object is None:
+            stripe = get_stripe()
+            customer = stripe.Customer.retrieve(info.customer_id, expand=["subscriptions"])
+            CustomerSnapshot.sync_with_customer(customer)
+            PaymentMethod.sync_with_customer(customer)
+            snapshot = CustomerSnapshot.objects.get(customer_id=info.customer_id)
+        return snapshot
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         info = self.request.user.stripeinfo
-        customer = stripe.Customer.retrieve(info.customer_id, expand=["subscriptions"])
-        card = None
-        subscription = None
-        if len(customer["sources"]["data"]) > 0:
-            card = customer["sources"]["data"][0]
-        if len(customer["subscriptions"]["data"]) > 0:
-            subscription = customer["subscriptions"]["data"][0]
-        for billing in BillingEvent.objects.filter(user=self.request.user).order_by(
-            "-created_at"
-        ):
-            context["billing"].append(billing)
+        snapshot = self.get_snapshot(info)
+        try:
+            billing, next_cursor = billing_page(
+                self.request.user, self.request.GET.get("cursor"), self.paginate_by
+            )
+        except ValueError:
+            raise Http404
 
-        context["customer"] = customer
-        context["card"] = card
-        context["subscription"] = subscription
+        context["customer"] = snapshot.customer
+        context["card"] = PaymentMethod.default_for(info.customer_id)
+        context["subscription"] = snapshot.subscription
+        context["billing"] = billing
+        context["billing_next"] = next_cursor
         return context
 
 
+class BillingHistoryView(LoginRequiredMixin, View):
+    """
+    JSON billing history of the logged in user, most recent first, paginated
+    with the `cursor` returned as `next` and `limit` query parameters.
+    """
+    paginate_by = DEFAULT_PAGE_SIZE
+
+    def get(self, request):
+        try:
+            limit = int(request.GET.get("limit", self.paginate_by))
+            page = billing_history(request.user, request.GET.get("cursor"), limit)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        return JsonResponse(page)
+
+
 class CancelSubscriptionView(LoginRequiredMixin, View):
     success_url = reverse_lazy("index")
 
     def get(self, request):
+        stripe = get_stripe()
         info = request.user.stripeinfo
         if info.subscription_id is not None:
             cancel_at_period_end = (